@@ -1,13 +1,179 @@
-from fastapi import FastAPI, BackgroundTasks
-from typing import Dict
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Optional
 
-app = FastAPI()
+from fastapi import Depends, FastAPI, File, Form, HTTPException, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
-async def process_pdf_background(file_path: str, notify_email: str):
-    result = await process_pdf_async(file_path, notify_email)
-    # Send email with results
+from job_manager import Job, JobManager, JobQueueFull
+from metrics import get_metrics
+from transaction_store import TransactionStore
+
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Allowance for the multipart boundaries and form fields around the PDF
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Built here rather than at import so importing the app needs no API keys
+    manager = JobManager()
+    manager.start()
+    app.state.manager = manager
+    yield
+    await manager.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+def get_manager(connection: HTTPConnection) -> JobManager:
+    return connection.app.state.manager
+
+@app.middleware("http")
+async def refuse_uploads_early(request: Request, call_next):
+    """Turn an upload away before its body is read when the queue is full or it is too large.
+
+    FastAPI reads the whole multipart body before create_job runs, so these
+    checks can't live in the handler. _save_upload still enforces the PDF size.
+    """
+    if request.method == "POST" and request.url.path == "/jobs":
+        manager = get_manager(request)
+        if manager.queue is not None and manager.queue.full():
+            return JSONResponse(status_code=429, content={"detail": "Too many jobs queued"},
+                                headers={"Retry-After": "5"})
+        max_bytes = manager.runtime.config.max_pdf_bytes
+        length = request.headers.get("content-length", "")
+        if max_bytes and length.isdigit() and int(length) > max_bytes + MULTIPART_OVERHEAD_BYTES:
+            return JSONResponse(status_code=413, content={"detail": f"PDF is larger than {max_bytes} bytes"})
+    return await call_next(request)
+
+def _submit(manager: JobManager, file_path: str, notify_email: Optional[str], job_id: Optional[str] = None,
+            owns_file: bool = False, account: Optional[str] = None) -> JSONResponse:
+    try:
+        job = manager.submit(file_path, notify_email, job_id=job_id, owns_file=owns_file, account=account)
+    except JobQueueFull as e:
+        if owns_file:
+            Path(manager.runtime.config.upload_dir, file_path).unlink(missing_ok=True)
+        raise HTTPException(status_code=429, detail=f"Too many jobs queued: {str(e)}",
+                            headers={"Retry-After": "5"})
+    return JSONResponse(status_code=202, content={"job_id": job.id, "status": job.status})
+
+def _get_job(manager: JobManager, job_id: str) -> Job:
+    job = manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+def _save_upload(upload: UploadFile, path: Path, max_bytes: Optional[int]) -> None:
+    """Copy an upload to disk in chunks, refusing it once it passes max_bytes"""
+    size = 0
+    with open(path, 'wb') as f:
+        while chunk := upload.file.read(UPLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"PDF is larger than {max_bytes} bytes")
+            f.write(chunk)
+
+@app.post("/jobs")
+async def create_job(file: UploadFile = File(...), notify_email: Optional[str] = Form(None),
+                     account: Optional[str] = Form(None), manager: JobManager = Depends(get_manager)):
+    """Upload a statement and queue it; returns the job id to poll or stream"""
+    config = manager.runtime.config
+    job_id = manager.new_job_id()
+    file_path = f"jobs/{job_id}.pdf"
+    path = config.upload_dir / file_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        await asyncio.to_thread(_save_upload, file, path, config.max_pdf_bytes)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return _submit(manager, file_path, notify_email, job_id=job_id, owns_file=True, account=account)
 
 @app.post("/process-pdf")
-async def process_pdf(file_path: str, notify_email: str, background_tasks: BackgroundTasks):
-    background_tasks.add_task(process_pdf_background, file_path, notify_email)
-    return {"status": "Processing started"} 
\ No newline at end of file
+async def process_pdf(file_path: str, notify_email: Optional[str] = None, account: Optional[str] = None,
+                      manager: JobManager = Depends(get_manager)):
+    """Queue a statement that is already in the uploads directory"""
+    upload_dir = manager.runtime.config.upload_dir.resolve()
+    path = (upload_dir / file_path).resolve()
+    if not path.is_relative_to(upload_dir):
+        raise HTTPException(status_code=400, detail="file_path must be inside the uploads directory")
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="PDF file not found")
+    return _submit(manager, str(path.relative_to(upload_dir)), notify_email, account=account)
+
+@app.get("/metrics")
+async def metrics():
+    """Latency, token, cost, cache and retry metrics in the Prometheus text format"""
+    return PlainTextResponse(get_metrics().render_prometheus(), media_type="text/plain; version=0.0.4")
+
+def _store(manager: JobManager = Depends(get_manager)) -> TransactionStore:
+    store = manager.runtime.store
+    if store is None:
+        raise HTTPException(status_code=404, detail="The transaction store is disabled")
+    return store
+
+@app.get("/history/statements")
+async def history_statements(account: Optional[str] = None, store: TransactionStore = Depends(_store)):
+    """Statements saved in the transaction store"""
+    records = await asyncio.to_thread(store.statements, account)
+    return [asdict(record) for record in records]
+
+@app.get("/history/spend")
+async def history_spend(account: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None,
+                        store: TransactionStore = Depends(_store)):
+    """Charges per account, month (YYYY-MM, inclusive) and merchant from the stored history"""
+    spend = await asyncio.to_thread(store.monthly_spend, account, start, end)
+    return spend.to_dict(orient='records')
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, manager: JobManager = Depends(get_manager)) -> Dict[str, Any]:
+    return _get_job(manager, job_id).summary()
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str, manager: JobManager = Depends(get_manager)):
+    job = _get_job(manager, job_id)
+    if not job.finished:
+        return JSONResponse(status_code=202, content=job.summary())
+    return job.result
+
+async def _events(job: Job) -> AsyncIterator[Dict[str, Any]]:
+    """A job's events from the start, ending after its final status"""
+    queue = job.subscribe()
+    try:
+        while True:
+            message = await queue.get()
+            yield message
+            if message["event"] in ('succeeded', 'failed'):
+                return
+    finally:
+        job.unsubscribe(queue)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, manager: JobManager = Depends(get_manager)):
+    """Server-sent events: queued, running, one per analyzed merchant, then succeeded or failed"""
+    job = _get_job(manager, job_id)
+
+    async def stream() -> AsyncIterator[str]:
+        async for message in _events(job):
+            yield f"event: {message['event']}\ndata: {json.dumps(message)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/jobs/{job_id}/ws")
+async def job_websocket(websocket: WebSocket, job_id: str, manager: JobManager = Depends(get_manager)):
+    """The same events as /jobs/{job_id}/events, one JSON message each"""
+    job = manager.get(job_id)
+    if job is None:
+        await websocket.close(code=4404)
+        return
+    await websocket.accept()
+    try:
+        async for message in _events(job):
+            await websocket.send_json(message)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
@@ -0,0 +1,279 @@
+import asyncio
+import os
+import weakref
+from typing import Callable, List, Dict, Optional, Tuple, Union, TYPE_CHECKING
+
+import httpx
+
+from brave_search import BraveSearchClient
+from merchant_analyzer import MerchantAnalyzer, company_fields
+from merchant_cache import MerchantCache
+from merchant_index import MerchantIndex
+from metrics import get_metrics
+from models import MerchantInfo
+from rate_limiter import RateLimitExceeded, RateLimitScheduler, estimate_message_tokens, get_rate_limiter
+from structured_output import STRUCTURED_OUTPUT_RETRIES, StructuredOutputError, parse_tool_response, retry_params
+
+if TYPE_CHECKING:
+    import anthropic
+
+class SharedAsyncClients:
+    """Anthropic and Brave HTTP clients shared by every analysis on one event loop"""
+
+    def __init__(self, anthropic_api_key: Optional[str]):
+        # Imported on first use rather than at module level to keep cold starts fast
+        import anthropic
+        max_connections = int(os.getenv('BRAVE_MAX_CONNECTIONS', '100'))
+        # Retries are owned by the rate limit scheduler, not the SDK
+        self.anthropic = anthropic.AsyncAnthropic(api_key=anthropic_api_key, max_retries=0)
+        self.http = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections)
+        )
+
+    async def aclose(self) -> None:
+        await self.http.aclose()
+        await self.anthropic.close()
+
+# httpx pools are bound to the loop they were first used on, so clients are
+# shared per loop. A warm Lambda container calling asyncio.run() again gets
+# fresh clients instead of connections owned by a closed loop.
+_clients_by_loop: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, SharedAsyncClients]" = \
+    weakref.WeakKeyDictionary()
+
+def get_shared_clients(anthropic_api_key: Optional[str] = None) -> SharedAsyncClients:
+    """Return the clients for the running event loop, creating them on first use"""
+    loop = asyncio.get_running_loop()
+    clients = _clients_by_loop.get(loop)
+    if clients is None:
+        clients = SharedAsyncClients(anthropic_api_key or os.getenv('ANTHROPIC_API_KEY'))
+        _clients_by_loop[loop] = clients
+    return clients
+
+class AsyncMerchantAnalyzer(MerchantAnalyzer):
+    """MerchantAnalyzer that awaits Brave and Claude directly instead of blocking a thread"""
+
+    def __init__(self, verbose: bool = False, cache: Optional[MerchantCache] = None,
+                 rate_limiter: Optional[RateLimitScheduler] = None, analysis_mode: Optional[str] = None,
+                 merchant_index: Optional[MerchantIndex] = None,
+                 search_client: Optional[BraveSearchClient] = None):
+        # No clients are built here; they are looked up per event loop on use
+        self._configure(verbose, cache, analysis_mode, merchant_index, search_client)
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+
+    @property
+    def clients(self) -> SharedAsyncClients:
+        return get_shared_clients(self.claude_api_key)
+
+    @property
+    def client(self) -> 'anthropic.AsyncAnthropic':
+        return self.clients.anthropic
+
+    async def search_brave(self, merchant_name: str) -> List[Dict]:
+        """Search Brave for merchant information"""
+        return await self.search_client.search_async(merchant_name, self._fetch_search)
+
+    async def _fetch_search(self, url: str, headers: Dict, params: Dict) -> httpx.Response:
+        return await self.rate_limiter.call(
+            'brave', lambda: self.clients.http.get(url, headers=headers, params=params)
+        )
+
+    async def _create_message(self, operation: str, **params):
+        """Send a Messages request through the rate limiter and return the parsed message"""
+        estimated_tokens = estimate_message_tokens(params)
+        metrics = get_metrics()
+        with metrics.timer('claude_message', operation=operation):
+            raw = await self.rate_limiter.call(
+                'anthropic',
+                lambda: self.client.messages.with_raw_response.create(**params),
+                tokens=estimated_tokens
+            )
+            message = raw.parse()
+        metrics.record_message(operation, params['model'], message.usage)
+        self.rate_limiter.settle('anthropic', estimated_tokens, message.usage.input_tokens)
+        return message
+
+    async def _structured_message(self, operation: str, **params) -> Dict:
+        """Send a request answered through its tool and return the checked tool input"""
+        for attempt in range(STRUCTURED_OUTPUT_RETRIES + 1):
+            message = await self._create_message(operation, **params)
+            try:
+                return parse_tool_response(message, params['tools'][0])
+            except StructuredOutputError as e:
+                self._structured_retry(operation, attempt, e)
+                params = retry_params(params, message, e)
+
+    async def _identify(self, merchant_code: str, merchant_context: str) -> Dict[str, str]:
+        """Ask Claude who the merchant is, returning the company fields"""
+        self.logger.debug("Sending merchant info prompt to Claude")
+        company = await self._structured_message(
+            'identify', **self._merchant_request(merchant_code, merchant_context)
+        )
+        return company_fields(company)
+
+    async def _analyze_competitors(self, merchant_code: str, transaction_amount: float,
+                                   company: Dict[str, str]) -> MerchantInfo:
+        merchant_name = company['company_name']
+        self.logger.debug("Identified merchant name: %s", merchant_name)
+
+        self.logger.debug("Sending competitor analysis prompt to Claude")
+        competitors = await self._structured_message(
+            'competitor', **self._competitor_request(merchant_name, merchant_code, transaction_amount)
+        )
+        return self._build_merchant_info(merchant_code, transaction_amount, company, competitors)
+
+    async def _search_context(self, merchant_code: str) -> str:
+        cleaned_merchant = self._clean_merchant_code(merchant_code)
+        self.logger.debug("Cleaned merchant code: %s", cleaned_merchant)
+
+        search_results = await self.search_brave(cleaned_merchant)
+        self.logger.debug("Got %d search results from Brave", len(search_results))
+        return self._build_merchant_context(search_results)
+
+    async def analyze_merchant(self, merchant_code: str, transaction_amount: float) -> MerchantInfo:
+        """Analyze a single merchant using Brave search and Claude"""
+        self.logger.info("Starting analysis for merchant: %s (amount: $%.2f)",
+                        merchant_code, transaction_amount)
+
+        cached = self._get_cached(merchant_code, transaction_amount)
+        if cached is not None:
+            return cached
+
+        indexed = self._indexed_company(merchant_code)
+        if indexed is not None:
+            return await self._analyze_competitors(merchant_code, transaction_amount, indexed)
+
+        merchant_context = await self._search_context(merchant_code)
+
+        if self.analysis_mode == 'combined':
+            self.logger.debug("Sending combined analysis prompt to Claude")
+            analysis = await self._structured_message(
+                'combined', **self._combined_request(merchant_code, merchant_context, transaction_amount)
+            )
+            return self._build_merchant_info(merchant_code, transaction_amount,
+                                             company_fields(analysis), analysis)
+
+        if self.analysis_mode == 'speculative':
+            # Ask for competitors using the cleaned code while identification runs
+            cleaned_merchant = self._clean_merchant_code(merchant_code)
+            self.logger.debug("Sending speculative competitor prompt to Claude")
+            company, competitors = await asyncio.gather(
+                self._identify(merchant_code, merchant_context),
+                self._structured_message('competitor', **self._competitor_request(
+                    cleaned_merchant or merchant_code, merchant_code, transaction_amount
+                ))
+            )
+            return self._build_merchant_info(merchant_code, transaction_amount, company, competitors)
+
+        company = await self._identify(merchant_code, merchant_context)
+        return await self._analyze_competitors(merchant_code, transaction_amount, company)
+
+    async def _identify_batch(self, entries: List[Tuple[str, str]]) -> List[Optional[Dict[str, str]]]:
+        """Identify several merchants in one request; None marks merchants the reply left out"""
+        import anthropic
+        try:
+            payload = await self._structured_message('identify_batch', **self._batch_merchant_request(entries))
+            companies = self._batch_companies(payload, len(entries))
+        except RateLimitExceeded:
+            raise
+        except (anthropic.APIError, StructuredOutputError) as e:
+            self.logger.warning("Batch identification of %d merchants failed: %s", len(entries), str(e))
+            companies = {}
+        return [companies.get(index) for index in range(len(entries))]
+
+    async def analyze_merchants(self, batch: List[Tuple[str, float]], return_exceptions: bool = False,
+                                on_result: Optional[Callable[[int, MerchantInfo], None]] = None
+                                ) -> List[Union[MerchantInfo, BaseException]]:
+        """Analyze many (merchant_code, transaction_amount) pairs, identifying them in batches.
+
+        Identification for up to batch_size merchants goes out in a single
+        Claude request. Any merchant the batch reply leaves out falls back to
+        the single-merchant prompt. Results line up with the input; with
+        return_exceptions=True a failed merchant yields its exception, like
+        asyncio.gather. on_result(index, info) is called as each merchant
+        finishes, without waiting for the rest of the batch.
+        """
+        def done(index: int, info: MerchantInfo) -> MerchantInfo:
+            if on_result is not None:
+                on_result(index, info)
+            return info
+
+        if self.analysis_mode != 'sequential':
+            # Batching only applies to the separate identification prompt
+            async def analyze_one(index: int, merchant_code: str, amount: float) -> MerchantInfo:
+                return done(index, await self.analyze_merchant(merchant_code, amount))
+
+            return await asyncio.gather(
+                *(analyze_one(index, merchant_code, amount) for index, (merchant_code, amount) in enumerate(batch)),
+                return_exceptions=return_exceptions
+            )
+
+        results: List[Union[MerchantInfo, BaseException, None]] = [
+            self._get_cached(merchant_code, amount) for merchant_code, amount in batch
+        ]
+        for index, result in enumerate(results):
+            if result is not None:
+                done(index, result)
+        pending = [index for index, result in enumerate(results) if result is None]
+        # Indexed merchants only need the competitor request
+        indexed = {index: self._indexed_company(batch[index][0]) for index in pending}
+        indexed = {index: company for index, company in indexed.items() if company is not None}
+        self.logger.info("Analyzing %d merchants (%d cached, %d indexed) in batches of %d",
+                         len(batch), len(batch) - len(pending), len(indexed), self.batch_size)
+        pending = [index for index in pending if index not in indexed]
+
+        contexts = await asyncio.gather(
+            *(self._search_context(batch[index][0]) for index in pending),
+            return_exceptions=True
+        )
+
+        async def finish(index: int, merchant_context: str, company: Optional[Dict[str, str]]) -> MerchantInfo:
+            merchant_code, amount = batch[index]
+            if company is None:
+                self.logger.info("Falling back to single identification for %s", merchant_code)
+                company = await self._identify(merchant_code, merchant_context)
+            return done(index, await self._analyze_competitors(merchant_code, amount, company))
+
+        async def finish_indexed(index: int, company: Dict[str, str]) -> MerchantInfo:
+            merchant_code, amount = batch[index]
+            return done(index, await self._analyze_competitors(merchant_code, amount, company))
+
+        searched = []
+        for index, context in zip(pending, contexts):
+            if isinstance(context, BaseException):
+                results[index] = context
+            else:
+                searched.append((index, context))
+
+        async def run_chunk(chunk: List[Tuple[int, str]]) -> List[Union[MerchantInfo, BaseException]]:
+            if len(chunk) > 1:
+                companies = await self._identify_batch(
+                    [(batch[index][0], context) for index, context in chunk]
+                )
+            else:
+                companies = [None]
+            return await asyncio.gather(
+                *(finish(index, context, company) for (index, context), company in zip(chunk, companies)),
+                return_exceptions=True
+            )
+
+        size = max(self.batch_size, 1)
+        chunks = [searched[start:start + size] for start in range(0, len(searched), size)]
+        indexed_results, chunk_results = await asyncio.gather(
+            asyncio.gather(*(finish_indexed(index, company) for index, company in indexed.items()),
+                           return_exceptions=True),
+            asyncio.gather(*(run_chunk(chunk) for chunk in chunks), return_exceptions=True)
+        )
+        for index, result in zip(indexed, indexed_results):
+            results[index] = result
+        for chunk, chunk_result in zip(chunks, chunk_results):
+            for position, (index, _) in enumerate(chunk):
+                results[index] = (chunk_result if isinstance(chunk_result, BaseException)
+                                  else chunk_result[position])
+
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+        return results
@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import Config
+from extraction_cache import create_extraction_cache
+from job_journal import JobJournal, create_job_journal
+from local_extractor import LocalExtractionResult, LocalExtractor
+from metrics import get_metrics
+from merchant_analyzer import ANALYSIS_MODES
+from pdf_extractor import PDFExtractor
+from pdf_ingest import PDFSource
+from statement_pipeline import format_merchant_analysis
+from transaction_processor import TransactionProcessor
+from transaction_store import TransactionStore, create_transaction_store, statement_id
+
+STATEMENT_SUFFIXES = ('.pdf', '.json')
+
+_local_extractor: Optional[LocalExtractor] = None
+
+def parse_statement(path: str, max_bytes: Optional[int], max_pages: Optional[int],
+                    local_extraction: bool = True) -> LocalExtractionResult:
+    """Read a statement and parse whatever can be parsed without the API.
+
+    Runs in a worker process. JSON exports are returned as-is; PDFs go
+    through the local text-layer parsers, and a result that isn't confident
+    is left for the parent process to send to Claude.
+    """
+    global _local_extractor
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            return LocalExtractionResult(json.load(f)['transactions'], True, 'json')
+
+    with PDFSource.open(path, max_bytes=max_bytes, max_pages=max_pages) as source:
+        if not local_extraction:
+            return LocalExtractionResult([], False, reason="local extraction disabled")
+        if _local_extractor is None:
+            _local_extractor = LocalExtractor()
+        return _local_extractor.extract(source.stream())
+
+def find_statements(source: Path) -> List[Path]:
+    """List statements in a directory (recursively), or the paths in a manifest file.
+
+    A manifest has one path per line, relative to the manifest's directory;
+    blank lines and lines starting with '#' are ignored. Paths are absolute,
+    since the extractor resolves relative ones against the upload directory.
+    """
+    if source.is_dir():
+        return sorted(path.resolve() for path in source.rglob('*') if path.suffix.lower() in STATEMENT_SUFFIXES)
+
+    statements = []
+    with open(source, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                statements.append((source.parent / line).resolve())
+    return statements
+
+def output_name(statement: Path, root: Path) -> str:
+    """Flatten a statement's path under the input root into a unique output file name"""
+    try:
+        relative = statement.resolve().relative_to(root.resolve())
+    except ValueError:
+        relative = Path(statement.name)
+    return re.sub(r'[\\/]+', '__', str(relative.with_suffix(''))) + '.json'
+
+@dataclass
+class BatchStats:
+    total: int
+    succeeded: int = 0
+    failed: int = 0
+    transactions: int = 0
+    merchant_results: int = 0
+    started_at: float = 0.0
+
+    @property
+    def done(self) -> int:
+        return self.succeeded + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def throughput(self) -> Dict[str, float]:
+        elapsed = max(self.elapsed, 1e-9)
+        return {
+            "statements_per_second": self.done / elapsed,
+            "transactions_per_second": self.transactions / elapsed,
+        }
+
+class BatchRunner:
+    """Processes many statements at once: local parsing on a process pool, API work on one event loop.
+
+    Every statement shares one TransactionProcessor, and so one merchant
+    cache, merchant index and rate limit scheduler, which keeps the whole run
+    inside the API budget however many statements are in flight. Progress is
+    journaled in the output directory; rerunning an interrupted batch skips
+    finished statements and reuses journaled extractions and merchants.
+
+    In offline mode every statement is extracted first, and then the unique
+    merchants of the whole run are analyzed through the Message Batches API
+    at batch pricing; its state file in the output directory lets a rerun
+    resume the submitted batches.
+
+    Finished statements are also appended to the transaction store under
+    account, and statements already in the store aren't extracted again.
+    """
+
+    def __init__(self, output_dir: Path, workers: Optional[int] = None, max_statements: Optional[int] = None,
+                 verbose: bool = False, analysis_mode: Optional[str] = None, offline: bool = False,
+                 account: Optional[str] = None):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers or os.cpu_count() or 1
+        # Statements extracted or analyzed at the same time; bounds memory as well as API load
+        self.max_statements = max_statements or int(os.getenv('BATCH_MAX_STATEMENTS', str(4 * self.workers)))
+        self.config = Config()
+        self.extractor = PDFExtractor(self.config)
+        self.extraction_cache = create_extraction_cache(self.config)
+        self.processor = TransactionProcessor(verbose=verbose, analysis_mode=analysis_mode)
+        self.journal: Optional[JobJournal] = create_job_journal('journal', self.output_dir)
+        self.store: Optional[TransactionStore] = create_transaction_store(self.config)
+        self.account = account
+        self.offline = offline
+        self.logger = logging.getLogger('BatchRunner')
+
+    def run(self, statements: List[Path], root: Path) -> BatchStats:
+        try:
+            return asyncio.run(self.process_all(statements, root))
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+
+    async def process_all(self, statements: List[Path], root: Path) -> BatchStats:
+        if self.journal is not None:
+            remaining = [statement for statement in statements if not self.journal.is_completed(str(statement))]
+            if len(remaining) < len(statements):
+                self.logger.info("Skipping %d statements already finished by an earlier run",
+                                 len(statements) - len(remaining))
+            statements = remaining
+        stats = BatchStats(total=len(statements), started_at=time.monotonic())
+        semaphore = asyncio.Semaphore(self.max_statements)
+        self.logger.info("Processing %d statements with %d parser processes, up to %d in flight",
+                         len(statements), self.workers, self.max_statements)
+
+        # Spawned rather than forked: the parent already has an event loop and client threads
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            async def run_one(statement: Path) -> None:
+                async with semaphore:
+                    started = time.monotonic()
+                    with get_metrics().statement(statement.name):
+                        result = await self.process_statement(statement, pool)
+                    result["elapsed_seconds"] = round(time.monotonic() - started, 3)
+                    self._write_result(statement, root, result)
+                    if result["success"] and self.journal is not None:
+                        self.journal.record_completed(str(statement))
+                    self._record(stats, statement, result)
+
+            if self.offline:
+                await self.process_offline(statements, root, pool, stats)
+            else:
+                await asyncio.gather(*(run_one(statement) for statement in statements))
+
+        self._log_summary(stats)
+        return stats
+
+    async def process_statement(self, statement: Path, pool: ProcessPoolExecutor) -> Dict[str, Any]:
+        """Extract and analyze one statement, returning its output document"""
+        try:
+            transactions = await self.extract_statement(statement, pool)
+            merchant_results = await self.processor.process_transactions(transactions, self.journal)
+            await self._store(statement, transactions, merchant_results)
+            return self._success(statement, transactions, merchant_results)
+        except Exception as e:
+            self.logger.error("Failed to process %s: %s", statement, str(e))
+            return {"success": False, "file": str(statement), "error": str(e)}
+
+    async def process_offline(self, statements: List[Path], root: Path, pool: ProcessPoolExecutor,
+                              stats: BatchStats) -> None:
+        """Extract every statement, analyze all of their merchants in Message Batches, then write the results"""
+        semaphore = asyncio.Semaphore(self.max_statements)
+        extracted: Dict[Path, Any] = {}
+
+        async def extract_one(statement: Path) -> None:
+            async with semaphore:
+                try:
+                    extracted[statement] = await self.extract_statement(statement, pool)
+                except Exception as e:
+                    self.logger.error("Failed to extract %s: %s", statement, str(e))
+                    extracted[statement] = e
+
+        await asyncio.gather(*(extract_one(statement) for statement in statements))
+
+        # One analysis per merchant and amount bucket across the whole run
+        analyzer = self.processor.analyzer
+        merchants: Dict[str, Tuple[str, float]] = {}
+        groups: Dict[Path, Dict[str, str]] = {}
+        for statement, transactions in extracted.items():
+            if isinstance(transactions, Exception):
+                continue
+            groups[statement] = {}
+            for group_key, group in self.processor.group_by_merchant(transactions).items():
+                key = analyzer.analysis_key(group[0]['merchant'], group[0]['amount'])
+                merchants.setdefault(key, (group[0]['merchant'], group[0]['amount']))
+                groups[statement][group_key] = key
+        results = await self.processor.analyze_offline(list(merchants.values()),
+                                                       self.output_dir / 'message_batches.json', self.journal)
+        analyses = dict(zip(merchants, results))
+
+        for statement in statements:
+            transactions = extracted[statement]
+            if isinstance(transactions, Exception):
+                result = {"success": False, "file": str(statement), "error": str(transactions)}
+            else:
+                merchant_results = self.processor.fan_out(
+                    transactions, {group_key: analyses[key] for group_key, key in groups[statement].items()}
+                )
+                await self._store(statement, transactions, merchant_results)
+                result = self._success(statement, transactions, merchant_results)
+            result["elapsed_seconds"] = round(stats.elapsed, 3)
+            self._write_result(statement, root, result)
+            if result["success"] and self.journal is not None:
+                self.journal.record_completed(str(statement))
+            self._record(stats, statement, result)
+
+    @staticmethod
+    def _success(statement: Path, transactions: List[Dict[str, Any]], merchant_results: List[Any]) -> Dict[str, Any]:
+        return {
+            "success": True,
+            "file": str(statement),
+            "num_transactions": len(transactions),
+            "transactions": transactions,
+            "merchant_analysis": format_merchant_analysis(merchant_results),
+        }
+
+    async def extract_statement(self, statement: Path, pool: ProcessPoolExecutor) -> List[Dict[str, Any]]:
+        """A statement's transactions, from the journal, the extraction cache, the local parsers or Claude"""
+        loop = asyncio.get_running_loop()
+        transactions = None
+        cache_key = None
+        is_pdf = statement.suffix.lower() == '.pdf'
+        if is_pdf and self.journal is not None:
+            transactions = self.journal.extraction(str(statement))
+        if transactions is None and is_pdf and (self.extraction_cache or self.store is not None):
+            stored_id = await asyncio.to_thread(statement_id, statement)
+            cache_key = self.extractor.extraction_key(stored_id)
+            if self.extraction_cache:
+                transactions = self.extraction_cache.get(cache_key)
+            if transactions is None and self.store is not None:
+                transactions = await asyncio.to_thread(self.store.statement_transactions, stored_id, cache_key)
+
+        if transactions is None:
+            parsed = await loop.run_in_executor(
+                pool, parse_statement, str(statement), self.config.max_pdf_bytes,
+                self.config.max_pdf_pages, self.config.local_extraction
+            )
+            if parsed.confident:
+                transactions = parsed.transactions
+            else:
+                self.logger.info("%s needs Claude extraction (%s)", statement.name, parsed.reason)
+                transactions = await asyncio.to_thread(
+                    self.extractor.extract_transactions_from_pdf, str(statement), parsed
+                )
+            if cache_key is not None and self.extraction_cache:
+                self.extraction_cache.set(cache_key, transactions)
+            if is_pdf and self.journal is not None:
+                self.journal.record_extraction(str(statement), transactions)
+        return transactions
+
+    async def _store(self, statement: Path, transactions: List[Dict[str, Any]], merchant_results: List[Any]) -> None:
+        if self.store is None:
+            return
+        stored_id = await asyncio.to_thread(statement_id, statement)
+        extraction_key = self.extractor.extraction_key(stored_id) if statement.suffix.lower() == '.pdf' else None
+        await asyncio.to_thread(self.store.record_statement, self.account, stored_id, str(statement),
+                                transactions, merchant_results, extraction_key)
+
+    def _write_result(self, statement: Path, root: Path, result: Dict[str, Any]) -> None:
+        path = self.output_dir / output_name(statement, root)
+        tmp_path = path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, path)
+
+    def _record(self, stats: BatchStats, statement: Path, result: Dict[str, Any]) -> None:
+        if result["success"]:
+            stats.succeeded += 1
+            stats.transactions += result["num_transactions"]
+            stats.merchant_results += len(result["merchant_analysis"])
+        else:
+            stats.failed += 1
+        throughput = stats.throughput()
+        self.logger.info("[%d/%d] %s %s in %.1fs (%.2f statements/s, %.1f transactions/s)",
+                         stats.done, stats.total, statement.name,
+                         "done" if result["success"] else "FAILED", result["elapsed_seconds"],
+                         throughput["statements_per_second"], throughput["transactions_per_second"])
+
+    def _log_summary(self, stats: BatchStats) -> None:
+        throughput = stats.throughput()
+        self.logger.info("Batch finished: %d succeeded, %d failed, %d transactions in %.1fs "
+                         "(%.2f statements/s, %.1f transactions/s)",
+                         stats.succeeded, stats.failed, stats.transactions, stats.elapsed,
+                         throughput["statements_per_second"], throughput["transactions_per_second"])
+        analyzer = self.processor.analyzer
+        if analyzer.cache is not None:
+            self.logger.info("Merchant cache stats: %s", analyzer.cache.stats())
+        if analyzer.merchant_index is not None:
+            self.logger.info("Merchant index stats: %s", analyzer.merchant_index.stats())
+        self.logger.info("Brave search stats: %s", analyzer.search_client.stats())
+        if self.extraction_cache is not None:
+            self.logger.info("Extraction cache stats: %s", self.extraction_cache.stats())
+        self.logger.info("Rate limiter stats: %s", analyzer.rate_limiter.stats())
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract and analyze a directory or manifest of statements')
+    parser.add_argument('source', help='Directory of PDF/JSON statements, or a manifest file listing them')
+    parser.add_argument('--output-dir', '-o', required=True, help='Directory for per-statement result JSON')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Parser processes (defaults to the number of CPUs)')
+    parser.add_argument('--max-statements', type=int, default=None,
+                        help='Statements in flight at once (defaults to 4 per worker)')
+    parser.add_argument('--analysis-mode', choices=ANALYSIS_MODES, default=None,
+                        help='How identification and competitor prompts are issued')
+    parser.add_argument('--offline', action='store_true',
+                        help='Analyze merchants through the Message Batches API (slower, half the price)')
+    parser.add_argument('--account', default=None,
+                        help='Account the statements are stored under in the transaction store')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    args = parser.parse_args()
+
+    source = Path(args.source)
+    statements = find_statements(source)
+    root = source if source.is_dir() else source.parent
+    runner = BatchRunner(Path(args.output_dir), args.workers, args.max_statements,
+                         args.verbose, args.analysis_mode, args.offline, args.account)
+    stats = runner.run(statements, root)
+
+    throughput = stats.throughput()
+    print("\n" + get_metrics().format_summary())
+    print(f"\nProcessed {stats.done} statements ({stats.failed} failed), {stats.transactions} transactions "
+          f"in {stats.elapsed:.1f}s: {throughput['statements_per_second']:.2f} statements/s, "
+          f"{throughput['transactions_per_second']:.1f} transactions/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""Throughput, latency and memory benchmark against local Anthropic and Brave stubs.
+
+Synthetic statements of each requested size are written as PDFs, and
+stub_servers.py stands in for both APIs in a child process. Each statement
+then goes through PDFExtractor and TransactionProcessor (and so the merchant
+analyzer) exactly as the API's job workers run it. For each size the report
+gives statements/sec, per-statement p50/p99 latency and peak memory.
+
+    python benchmark.py --sizes 10 100 1000 --statements 20
+    python benchmark.py --sizes 10000 --statements 2 --claude-429-rate 0.05 --json results.json
+
+Each size starts with an empty in-memory merchant cache, which warms up over
+its statements, so caching regressions show up as lower throughput. Persistent
+caches, the merchant index and the journal are off. The client-side rate
+limits are lifted so that only the stubs' 429s throttle a run. Any of these
+settings that is already in the environment is left as it is.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List
+
+from stub_servers import StubProcess, add_profile_arguments, profiles_from_args
+
+BENCHMARK_ENV = {
+    'ANTHROPIC_API_KEY': 'benchmark',
+    'BRAVE_API_KEY': 'benchmark',
+    'ANTHROPIC_MODEL': 'claude-3-5-sonnet-20241022',
+    'MERCHANT_CACHE_BACKEND': 'memory',
+    'MERCHANT_INDEX': 'false',
+    'EXTRACTION_CACHE': 'false',
+    'JOB_JOURNAL': 'false',
+    'TRANSACTION_STORE': 'false',
+    'ANTHROPIC_REQUESTS_PER_MINUTE': '1000000',
+    'ANTHROPIC_TOKENS_PER_MINUTE': '1000000000',
+    'BRAVE_REQUESTS_PER_SECOND': '100000',
+    # The stub ends a batch after one request's latency, so poll it often
+    'MESSAGE_BATCH_POLL_SECONDS': '0.1',
+    'MESSAGE_BATCH_MAX_POLL_SECONDS': '1',
+}
+
+LINES_PER_PAGE = 45
+SYLLABLES = ['bel', 'cor', 'dan', 'fen', 'gal', 'hol', 'kin', 'lor', 'mar', 'nov',
+             'pra', 'quin', 'ros', 'sel', 'tar', 'ven', 'wex', 'zor']
+KINDS = ['MARKET', 'COFFEE', 'FUEL', 'PHARMACY', 'BOOKS', 'FITNESS', 'GRILL', 'HARDWARE', 'STREAMING', 'TRAVEL']
+CITIES = ['AUSTIN TX', 'DENVER CO', 'SEATTLE WA', 'BOSTON MA', 'CHICAGO IL', 'PORTLAND OR']
+
+def merchant_pool(count: int, rng: random.Random) -> List[str]:
+    """Distinct, plausible-looking transaction descriptors"""
+    pool, seen = [], set()
+    while len(pool) < count:
+        name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).upper()
+        descriptor = f"{name} {rng.choice(KINDS)} {rng.choice(CITIES)}"
+        if descriptor not in seen:
+            seen.add(descriptor)
+            pool.append(descriptor)
+    return pool
+
+def synthetic_transactions(count: int, pool: List[str], rng: random.Random) -> List[Dict[str, Any]]:
+    """count transactions whose merchants follow a Zipf-like popularity, as real spending does"""
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(len(pool))]
+    merchants = rng.choices(pool, weights=weights, k=count)
+    return [
+        {"date": f"2025-12-{day:02d}", "merchant": merchant,
+         "amount": round(min(rng.lognormvariate(3.4, 0.9), 4999.0), 2)}
+        for merchant, day in zip(merchants, sorted(rng.randint(1, 31) for _ in range(count)))
+    ]
+
+def _pdf_string(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def write_pdf(pages: List[List[str]]) -> bytes:
+    """A minimal PDF with one line of Helvetica text per entry, one page per list"""
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for lines in pages:
+        content = ' '.join(f"({_pdf_string(line)}) Tj 0 -14 Td" for line in lines)
+        stream = f"BT /F1 9 Tf 40 760 Td {content} ET".encode('latin-1')
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % len(objects))
+        kids.append(len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % kid for kid in kids), len(kids))
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(output)
+
+def synthetic_statement(transactions: List[Dict[str, Any]]) -> bytes:
+    """A Chase-style statement PDF whose summary totals match its transaction rows"""
+    purchases = sum(row['amount'] for row in transactions)
+    rows = [f"{row['date'][5:7]}/{row['date'][8:10]} {row['merchant']} {row['amount']:,.2f}"
+            for row in transactions]
+    pages = []
+    for start in range(0, len(rows), LINES_PER_PAGE):
+        header = [f"Chase Benchmark Card - Statement Closing Date: 12/31/2025 - Page {len(pages) + 1}"]
+        if not pages:
+            header += ["ACCOUNT SUMMARY", f"Purchases +${purchases:,.2f}", "ACCOUNT ACTIVITY"]
+        pages.append(header + rows[start:start + LINES_PER_PAGE])
+    return write_pdf(pages)
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+async def run_size(size: int, paths: List[Path], args: argparse.Namespace) -> Dict[str, Any]:
+    """Push one size's statements through the pipeline, args.concurrency at a time"""
+    from config import Config
+    from metrics import get_metrics
+    from pdf_extractor import PDFExtractor
+    from transaction_processor import TransactionProcessor
+
+    config = Config()
+    config.local_extraction = args.extraction == 'local'
+    extractor = PDFExtractor(config)
+    # A fresh processor per size, so each starts with a cold merchant cache
+    processor = TransactionProcessor(analysis_mode=args.analysis_mode)
+    metrics = get_metrics()
+    metrics.reset()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+    failures = 0
+
+    async def run_statement(path: Path) -> None:
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                with metrics.statement(path.name):
+                    if args.pipeline == 'stream':
+                        await processor.process_transaction_stream(extractor.stream_transactions_from_pdf(str(path)))
+                    else:
+                        transactions = await asyncio.to_thread(extractor.extract_transactions_from_pdf, str(path))
+                        await processor.process_transactions(transactions)
+            except Exception as e:
+                failures += 1
+                logging.getLogger('Benchmark').error("Statement %s failed: %s", path.name, str(e))
+            latencies.append(time.perf_counter() - started)
+
+    async def run_offline() -> None:
+        """Extract every statement, then analyze all of their merchants in one Message Batches run"""
+        nonlocal failures
+
+        async def extract(path: Path) -> List[Dict[str, Any]]:
+            async with semaphore:
+                return await asyncio.to_thread(extractor.extract_transactions_from_pdf, str(path))
+
+        extracted = await asyncio.gather(*(extract(path) for path in paths), return_exceptions=True)
+        merchants = {}
+        for transactions in extracted:
+            if isinstance(transactions, BaseException):
+                failures += 1
+                logging.getLogger('Benchmark').error("Extraction failed: %s", str(transactions))
+                continue
+            for group in processor.group_by_merchant(transactions).values():
+                merchants.setdefault(processor.analyzer.analysis_key(group[0]['merchant'], group[0]['amount']),
+                                     (group[0]['merchant'], group[0]['amount']))
+        await processor.analyze_offline(list(merchants.values()), paths[0].parent / f"message_batches_{size}.json")
+        # Every statement is done when the run is
+        latencies.extend([time.perf_counter() - started] * len(paths))
+
+    if args.tracemalloc:
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    if args.pipeline == 'offline':
+        await run_offline()
+    else:
+        await asyncio.gather(*(run_statement(path) for path in paths))
+    elapsed = time.perf_counter() - started
+
+    result = {
+        'transactions_per_statement': size,
+        'statements': len(paths),
+        'failed': failures,
+        'seconds': elapsed,
+        'statements_per_second': len(paths) / elapsed,
+        'transactions_per_second': len(paths) * size / elapsed,
+        'p50_seconds': statistics.median(latencies),
+        'p99_seconds': percentile(latencies, 0.99),
+        'peak_rss_mb': peak_rss_mb(),
+        'claude_requests': metrics.total('claude_requests_total'),
+        'brave_requests': metrics.total('search_requests_total'),
+        'retries': metrics.total('retries_total'),
+        'stage_errors': metrics.total('stage_errors_total'),
+        'merchant_cache_hits': metrics.total('cache_lookups_total', cache='merchant', result='hit'),
+    }
+    if args.tracemalloc:
+        result['peak_python_heap_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    if args.verbose:
+        print(f"\n{size} transactions per statement:\n{metrics.format_summary()}")
+    return result
+
+async def run_benchmark(statements: Dict[int, List[Path]], args: argparse.Namespace) -> List[Dict[str, Any]]:
+    # One event loop for every size, as in the API, so the shared clients and rate limiter carry over
+    return [await run_size(size, paths, args) for size, paths in statements.items()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the statement pipeline against local API stubs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Transactions per synthetic statement; each size is a separate run')
+    parser.add_argument('--statements', type=int, default=10, help='Statements processed per size')
+    parser.add_argument('--merchants', type=int, default=300, help='Distinct merchants the statements draw from')
+    parser.add_argument('--concurrency', type=int, default=4, help='Statements in flight at once')
+    parser.add_argument('--pipeline', choices=['stream', 'batch', 'offline'], default='stream',
+                        help='stream: analyze merchants while extraction runs (the API path); '
+                             'batch: extract fully, then analyze with batched identification; '
+                             'offline: extract every statement, then analyze through Message Batches')
+    parser.add_argument('--extraction', choices=['claude', 'local'], default='claude',
+                        help='Extract through the Anthropic stub or with the local text-layer parsers')
+    parser.add_argument('--analysis-mode', default=None, help='sequential, combined or speculative')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='Also report the peak Python heap per size (slows the run down)')
+    parser.add_argument('--json', default=None, help='Write the results to this file as JSON')
+    parser.add_argument('--verbose', action='store_true', help='Show the pipeline\'s own logging')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    for name, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(name, value)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', force=True)
+    if not args.verbose:
+        # The pipeline's modules raise their own loggers to INFO or DEBUG
+        logging.disable(logging.INFO)
+
+    rng = random.Random(args.seed)
+    pool = merchant_pool(args.merchants, rng)
+    with tempfile.TemporaryDirectory(prefix='cc_benchmark_') as directory, \
+            StubProcess(*profiles_from_args(args), seed=args.seed) as stubs:
+        os.environ['ANTHROPIC_BASE_URL'] = stubs.anthropic_base_url
+        os.environ['BRAVE_SEARCH_URL'] = stubs.brave_search_url
+
+        statements: Dict[int, List[Path]] = {}
+        for size in sorted(args.sizes):
+            statements[size] = []
+            for index in range(args.statements):
+                path = Path(directory, f"statement_{size}_{index}.pdf")
+                path.write_bytes(synthetic_statement(synthetic_transactions(size, pool, rng)))
+                statements[size].append(path)
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        results = asyncio.run(run_benchmark(statements, args))
+
+    print(f"\n{'tx/stmt':>8} {'stmts':>6} {'failed':>6} {'stmt/s':>8} {'tx/s':>9} {'p50 s':>8} {'p99 s':>8} "
+          f"{'peak MB':>8} {'claude':>7} {'brave':>6} {'retries':>7}")
+    for result in results:
+        print(f"{result['transactions_per_statement']:>8} {result['statements']:>6} {result['failed']:>6} "
+              f"{result['statements_per_second']:>8.2f} {result['transactions_per_second']:>9.1f} "
+              f"{result['p50_seconds']:>8.2f} {result['p99_seconds']:>8.2f} {result['peak_rss_mb']:>8.1f} "
+              f"{result['claude_requests']:>7.0f} {result['brave_requests']:>6.0f} {result['retries']:>7.0f}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({'settings': vars(args), 'results': results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from metrics import get_metrics
+from rate_limiter import RateLimitScheduler, get_rate_limiter
+
+BRAVE_SEARCH_URL = "https://api.search.brave.com/res/v1/web/search"
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10000
+
+# (url, headers, params) -> response with status_code and json(); supplied by the async analyzer
+AsyncFetch = Callable[[str, Dict, Dict], Awaitable[Any]]
+
+class BraveSearchClient:
+    """Brave web search with pooled connections, a TTL cache and coalescing of identical queries.
+
+    Results are cached after filtering, keyed on the query sent to Brave, so
+    descriptors that clean to the same name share one search. A query that is
+    already in flight is not sent again; later callers wait for the first
+    one's results. Search traffic therefore scales with unique queries rather
+    than with transactions.
+    """
+
+    def __init__(self, api_key: Optional[str], url: str = BRAVE_SEARCH_URL,
+                 ttl_seconds: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_connections: int = 100, rate_limiter: Optional[RateLimitScheduler] = None):
+        self.api_key = api_key
+        self.url = url
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_connections = max_connections
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.logger = logging.getLogger('BraveSearchClient')
+        self._entries: "OrderedDict[str, Tuple[float, List[Dict]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        # Keyed on the loop too, since an asyncio future can only be awaited on its own loop
+        self._in_flight_async: Dict[Tuple[asyncio.AbstractEventLoop, str], asyncio.Future] = {}
+        self._session = None
+        # Paces sync searches; async ones are paced by the fetch the analyzer passes in
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+
+    @property
+    def session(self):
+        """requests session kept alive between searches, created on first sync search"""
+        with self._lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    def request(self, merchant_name: str) -> Tuple[str, Dict, Dict]:
+        """Build the url, headers and params for a Brave merchant search"""
+        headers = {"X-Subscription-Token": self.api_key or ""}
+
+        # Improve search query to focus on business information
+        cleaned_name = ' '.join(merchant_name.strip().replace('*', '').lower().split())
+        params = {
+            "q": f'"{cleaned_name}" company business contact information',
+            "count": 5
+        }
+        return self.url, headers, params
+
+    def filter_results(self, data: Dict) -> List[Dict]:
+        """Pull web results out of a Brave response, preferring official websites"""
+        results = data.get('web', {}).get('results', [])
+        self.logger.debug("Found %d results from Brave", len(results))
+
+        # Filter results to prioritize official websites
+        filtered_results = []
+        for result in results:
+            url = result.get('url', '').lower()
+            if any(term in url for term in ['.com', '.org', '.net', '.co']):
+                filtered_results.append(result)
+
+        return filtered_results[:5]  # Return top 5 filtered results
+
+    def _cached(self, query: str) -> Optional[List[Dict]]:
+        """Cached results for a query, counting the lookup; call with the lock held"""
+        entry = self._entries.get(query)
+        if entry is not None and time.time() - entry[0] > self.ttl_seconds:
+            del self._entries[query]
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(query)
+        get_metrics().record_cache('brave_search', entry is not None)
+        return None if entry is None else list(entry[1])
+
+    def _store(self, query: str, results: List[Dict]) -> None:
+        with self._lock:
+            self._entries[query] = (time.time(), results)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _coalesced(self, query: str) -> None:
+        self.coalesced += 1
+        get_metrics().record_search_coalesced()
+        self.logger.debug("Waiting for the search already in flight for %s", query)
+
+    def _handle_response(self, query: str, response: Any) -> List[Dict]:
+        get_metrics().record_search(response.status_code)
+        self.logger.debug("Brave API response status: %d", response.status_code)
+        if response.status_code != 200:
+            # Not cached, so the next transaction tries again
+            return []
+        results = self.filter_results(response.json())
+        self._store(query, results)
+        return results
+
+    def search(self, merchant_name: str) -> List[Dict]:
+        """Search Brave for merchant information"""
+        url, headers, params = self.request(merchant_name)
+        query = params['q']
+        with self._lock:
+            cached = self._cached(query)
+            if cached is not None:
+                return cached
+            future = self._in_flight.get(query)
+            leader = future is None
+            if leader:
+                future = self._in_flight[query] = Future()
+            else:
+                self._coalesced(query)
+        if not leader:
+            return list(future.result())
+
+        try:
+            self.logger.debug("Searching Brave for merchant: %s", merchant_name)
+            with get_metrics().timer('brave_search'):
+                response = self.rate_limiter.call_sync(
+                    'brave', lambda: self.session.get(url, headers=headers, params=params, timeout=10)
+                )
+            results = self._handle_response(query, response)
+            future.set_result(results)
+            return list(results)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(query, None)
+
+    async def search_async(self, merchant_name: str, fetch: AsyncFetch) -> List[Dict]:
+        """Async search, sending through fetch(url, headers, params) on a miss"""
+        url, headers, params = self.request(merchant_name)
+        query = params['q']
+        key = (asyncio.get_running_loop(), query)
+        with self._lock:
+            cached = self._cached(query)
+            if cached is not None:
+                return cached
+            future = self._in_flight_async.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight_async[key] = key[0].create_future()
+            else:
+                self._coalesced(query)
+        if not leader:
+            # shield so one cancelled waiter doesn't cancel the search for the others
+            return list(await asyncio.shield(future))
+
+        try:
+            self.logger.debug("Searching Brave for merchant: %s", merchant_name)
+            with get_metrics().timer('brave_search'):
+                response = await fetch(url, headers, params)
+            results = self._handle_response(query, response)
+            future.set_result(results)
+            return list(results)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Waiters that see the exception consume it; this stops "never retrieved" warnings when there are none
+            future.exception()
+            raise
+        finally:
+            with self._lock:
+                self._in_flight_async.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+def create_search_client(api_key: Optional[str] = None) -> BraveSearchClient:
+    """Build a search client configured by the environment"""
+    return BraveSearchClient(
+        api_key if api_key is not None else os.getenv('BRAVE_API_KEY'),
+        # Overridable so the benchmark (or a proxy) can stand in for Brave
+        url=os.getenv('BRAVE_SEARCH_URL', BRAVE_SEARCH_URL),
+        ttl_seconds=float(os.getenv('BRAVE_CACHE_TTL_SECONDS', DEFAULT_TTL_SECONDS)),
+        max_entries=int(os.getenv('BRAVE_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+        max_connections=int(os.getenv('BRAVE_MAX_CONNECTIONS', '100'))
+    )
@@ -0,0 +1,97 @@
+"""Measure Lambda-style cold and warm start latency of the PDF handler.
+
+Each run starts a fresh interpreter (a "cold container"), times importing the
+handler module and building the runtime, then calls lambda_handler several
+times in the same process. The first call is the cold invocation and the rest
+are warm ones.
+
+    python cold_start.py --runs 5
+    python cold_start.py --runs 5 --file statement.pdf --invocations 3
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+def measure_container(file_name: Optional[str], invocations: int) -> Dict[str, Any]:
+    """Time one cold container: import, runtime build and each handler call, in milliseconds"""
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    from runtime import get_runtime
+    get_runtime()
+    built = time.perf_counter()
+
+    calls = []
+    for _ in range(invocations if file_name else 0):
+        call_started = time.perf_counter()
+        result = main.lambda_handler({'file_path': file_name, 'notify_email': None}, None)
+        calls.append({
+            'ms': (time.perf_counter() - call_started) * 1000,
+            'success': result.get('success', False),
+        })
+
+    return {
+        'import_ms': (imported - started) * 1000,
+        'init_ms': (built - imported) * 1000,
+        'invocations': calls,
+    }
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    series = {
+        'import_ms': [run['import_ms'] for run in runs],
+        'init_ms': [run['init_ms'] for run in runs],
+        'cold_start_ms': [run['import_ms'] + run['init_ms'] for run in runs],
+    }
+    cold = [run['invocations'][0]['ms'] for run in runs if run['invocations']]
+    warm = [call['ms'] for run in runs for call in run['invocations'][1:]]
+    if cold:
+        series['cold_invocation_ms'] = cold
+    if warm:
+        series['warm_invocation_ms'] = warm
+    return {
+        name: {'median': statistics.median(values), 'p90': percentile(values, 0.9), 'max': max(values)}
+        for name, values in series.items()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold and warm start latency of the Lambda handler')
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters to start')
+    parser.add_argument('--file', default=None, help='PDF in the uploads directory to process on each invocation')
+    parser.add_argument('--invocations', type=int, default=3,
+                        help='Handler calls per interpreter (the first is cold, the rest warm)')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_container(args.file, args.invocations)))
+        return
+
+    command = [sys.executable, str(Path(__file__).resolve()), '--child', '--invocations', str(args.invocations)]
+    if args.file:
+        command += ['--file', args.file]
+
+    runs = []
+    for index in range(args.runs):
+        output = subprocess.run(command, cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+        run = json.loads(output.stdout.strip().splitlines()[-1])
+        failures = sum(1 for call in run['invocations'] if not call['success'])
+        print(f"Run {index + 1}: import {run['import_ms']:.0f}ms, init {run['init_ms']:.0f}ms, "
+              f"invocations {[round(call['ms']) for call in run['invocations']]}ms"
+              + (f" ({failures} failed)" if failures else ""))
+        runs.append(run)
+
+    print("\nSummary (ms):")
+    for name, stats in summarize(runs).items():
+        print(f"  {name:<20} median {stats['median']:8.1f}  p90 {stats['p90']:8.1f}  max {stats['max']:8.1f}")
+
+if __name__ == "__main__":
+    main()
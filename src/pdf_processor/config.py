@@ -26,6 +26,29 @@ class Config:
         # Model configuration
         self.anthropic_model = os.getenv('ANTHROPIC_MODEL')
         
+        # Try the PDF text layer before sending the statement to Claude
+        self.local_extraction = os.getenv('LOCAL_EXTRACTION', 'true').lower() != 'false'
+        
+        # Long statements are sent to Claude in page chunks, extracted concurrently
+        self.pdf_chunk_pages = int(os.getenv('PDF_CHUNK_PAGES', '5'))
+        self.extraction_concurrency = int(os.getenv('PDF_EXTRACTION_CONCURRENCY', '4'))
+        self.extraction_max_tokens = int(os.getenv('EXTRACTION_MAX_TOKENS', '8192'))
+        
+        # Statements over these limits are rejected before any work is done
+        self.max_pdf_bytes = int(os.getenv('MAX_PDF_BYTES', str(50 * 1024 * 1024)))
+        self.max_pdf_pages = int(os.getenv('MAX_PDF_PAGES', '500'))
+        
+        # Content-addressed cache of extracted transactions, keyed on the PDF hash
+        self.extraction_cache = os.getenv('EXTRACTION_CACHE', 'true').lower() != 'false'
+        self.extraction_cache_dir = Path(os.getenv('EXTRACTION_CACHE_DIR',
+                                                   str(self.project_root / 'cache' / 'extractions')))
+        self.extraction_cache_max_bytes = int(os.getenv('EXTRACTION_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+        
+        # Parquet history of every processed statement, partitioned by account and month
+        self.transaction_store = os.getenv('TRANSACTION_STORE', 'true').lower() != 'false'
+        self.transaction_store_dir = Path(os.getenv('TRANSACTION_STORE_DIR', str(self.project_root / 'store')))
+        self.transaction_store_account = os.getenv('TRANSACTION_STORE_ACCOUNT', 'default')
+        
         # Directories
         self.base_dir = Path(__file__).parent.parent.parent
         self.upload_dir = self.base_dir / 'uploads'
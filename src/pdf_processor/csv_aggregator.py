@@ -0,0 +1,102 @@
+import logging
+import os
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+CSV_DTYPES = {'merchant': 'object', 'amount': 'float64', 'date': 'object'}
+DEFAULT_CHUNK_ROWS = 250_000
+
+AGGREGATE_COLUMNS = ['merchant', 'count', 'total', 'median_amount', 'first_date', 'last_date']
+
+logger = logging.getLogger('CSVAggregator')
+
+def _weighted_median(pair_counts: pd.Series) -> pd.Series:
+    """Median amount per merchant from counts of (merchant, amount_cents) pairs"""
+    frame = pair_counts.rename('size').reset_index().sort_values(['merchant', 'amount_cents'])
+    grouped = frame.groupby('merchant', sort=False)['size']
+    frame['cumulative'] = grouped.cumsum()
+    frame['n'] = grouped.transform('sum')
+    frame['start'] = frame['cumulative'] - frame['size']
+
+    def value_at(position: pd.Series) -> pd.Series:
+        # The row whose [start, cumulative) range covers the 0-based position
+        hit = frame[(frame['start'] <= position) & (position < frame['cumulative'])]
+        return hit.set_index('merchant')['amount_cents']
+
+    lower = value_at((frame['n'] - 1) // 2)
+    upper = value_at(frame['n'] // 2)
+    return (lower + upper) / 200
+
+def aggregate_merchants_csv(csv_path: str, chunk_rows: Optional[int] = None) -> pd.DataFrame:
+    """Per-merchant count, total, median amount and first/last date for a transaction export.
+
+    The file is read in chunks with explicit dtypes. Only running aggregates
+    are kept between chunks: one row per merchant and distinct amount in
+    cents, which the exact median needs. Memory is bounded by the number of
+    those pairs rather than the number of transactions; a merchant with
+    varying charges keeps a row for each of its amounts. Credits and
+    payments (amounts <= 0) are skipped. Returns one row per merchant,
+    highest total spend first.
+    """
+    chunk_rows = chunk_rows or int(os.getenv('CSV_CHUNK_ROWS', str(DEFAULT_CHUNK_ROWS)))
+    # Per-chunk partial aggregates, merged once they add up to a few chunks' worth
+    count_parts: List[pd.Series] = []
+    first_parts: List[pd.Series] = []
+    last_parts: List[pd.Series] = []
+    pending_rows = 0
+    rows = 0
+
+    def compact() -> None:
+        if len(count_parts) > 1:
+            count_parts[:] = [pd.concat(count_parts).groupby(level=[0, 1], sort=False).sum()]
+        if len(first_parts) > 1:
+            first_parts[:] = [pd.concat(first_parts).groupby(level=0, sort=False).min()]
+            last_parts[:] = [pd.concat(last_parts).groupby(level=0, sort=False).max()]
+
+    reader = pd.read_csv(csv_path, usecols=lambda column: column in CSV_DTYPES,
+                         dtype=CSV_DTYPES, chunksize=chunk_rows)
+    for chunk in reader:
+        if 'merchant' not in chunk.columns or 'amount' not in chunk.columns:
+            raise ValueError("CSV must have 'merchant' and 'amount' columns")
+        rows += len(chunk)
+        chunk = chunk[chunk['merchant'].notna() & (chunk['amount'] > 0)]
+
+        cents = np.round(chunk['amount'].to_numpy() * 100).astype(np.int64)
+        counts = chunk.groupby([chunk['merchant'], pd.Series(cents, index=chunk.index, name='amount_cents')],
+                               sort=False).size()
+        count_parts.append(counts)
+        pending_rows += len(counts)
+
+        if 'date' in chunk.columns:
+            dates = pd.to_datetime(chunk['date'], errors='coerce')
+            by_merchant = dates.groupby(chunk['merchant'], sort=False)
+            first_parts.append(by_merchant.min())
+            last_parts.append(by_merchant.max())
+
+        if pending_rows > 4 * chunk_rows:
+            compact()
+            pending_rows = len(count_parts[0])
+
+    compact()
+    pair_counts = count_parts[0] if count_parts else None
+    first_dates = first_parts[0] if first_parts else None
+    last_dates = last_parts[0] if last_parts else None
+    if pair_counts is None or pair_counts.empty:
+        logger.info("No charges found in %d rows of %s", rows, csv_path)
+        return pd.DataFrame(columns=AGGREGATE_COLUMNS)
+
+    pair_counts.index.names = ['merchant', 'amount_cents']
+    cents_spent = pair_counts * pair_counts.index.get_level_values('amount_cents')
+    result = pd.DataFrame({
+        'count': pair_counts.groupby(level='merchant').sum(),
+        'total': cents_spent.groupby(level='merchant').sum() / 100,
+        'median_amount': _weighted_median(pair_counts),
+    })
+    for column, dates in (('first_date', first_dates), ('last_date', last_dates)):
+        result[column] = dates.dt.strftime('%Y-%m-%d') if dates is not None else None
+
+    result = result.rename_axis('merchant').reset_index().sort_values('total', ascending=False, kind='stable')
+    logger.info("Aggregated %d rows into %d merchants", rows, len(result))
+    return result[AGGREGATE_COLUMNS].reset_index(drop=True)
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from metrics import get_metrics
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+def make_extraction_key(pdf_hash: str, model: Optional[str], prompt_version: str) -> str:
+    """Combine the content hash with everything else that changes the extraction output"""
+    return hashlib.sha256(f"{pdf_hash}|{model}|{prompt_version}".encode('utf-8')).hexdigest()
+
+class ExtractionCache:
+    """Content-addressed cache of extracted transaction lists, one JSON file per statement.
+
+    Entries are evicted least-recently-used first (by file mtime, which is
+    refreshed on every hit) once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger('ExtractionCache')
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                transactions = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            get_metrics().record_cache('extraction', False)
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.warning("Discarding unreadable extraction cache entry %s: %s", key, str(e))
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            get_metrics().record_cache('extraction', False)
+            return None
+        self.hits += 1
+        get_metrics().record_cache('extraction', True)
+        self.logger.info("Extraction cache hit for %s", key)
+        return transactions
+
+    def set(self, key: str, transactions: List[Dict]) -> None:
+        # Write to a temporary file and rename so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(transactions, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        total = 0
+        for path in self.directory.glob('*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+def create_extraction_cache(config) -> Optional[ExtractionCache]:
+    """Build the extraction cache described by the config, or None when disabled"""
+    if not config.extraction_cache:
+        return None
+    return ExtractionCache(config.extraction_cache_dir, config.extraction_cache_max_bytes)
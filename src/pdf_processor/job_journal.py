@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import threading
+from dataclasses import replace
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from models import MerchantInfo, merchant_info_from_dict, merchant_info_to_dict
+
+class JobJournal:
+    """Append-only record of a job's finished work, so a restarted job only runs what's left.
+
+    Each finished extraction, merchant analysis and statement is written as one
+    JSON line and flushed (and fsynced, by default) before the work counts as
+    done. On load, a torn final line from a crash mid-write is discarded.
+    """
+
+    def __init__(self, path: Path, fsync: bool = True):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self.extractions: Dict[str, List[Dict[str, Any]]] = {}
+        self.merchants: Dict[str, MerchantInfo] = {}
+        self.completed: Set[str] = set()
+        self.logger = logging.getLogger('JobJournal')
+        self._load()
+        self._lock = threading.Lock()
+        self._file = open(self.path, 'a')
+
+    def _load(self) -> None:
+        try:
+            f = open(self.path, 'rb+')
+        except FileNotFoundError:
+            return
+        with f:
+            valid_bytes = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Torn write from a crash; cut it off so new entries start on a clean line
+                    self.logger.warning("Discarding incomplete final entry in %s", self.path)
+                    f.truncate(valid_bytes)
+                    break
+                valid_bytes += len(line)
+                try:
+                    entry = json.loads(line)
+                    if entry['type'] == 'extraction':
+                        self.extractions[entry['statement']] = entry['transactions']
+                    elif entry['type'] == 'merchant':
+                        self.merchants[entry['key']] = merchant_info_from_dict(entry['info'])
+                    elif entry['type'] == 'completed':
+                        self.completed.add(entry['statement'])
+                except (ValueError, KeyError, TypeError):
+                    self.logger.warning("Skipping unreadable journal entry in %s", self.path)
+        if self.extractions or self.merchants or self.completed:
+            self.logger.info("Resuming from %s: %d extractions, %d merchants, %d statements done",
+                             self.path, len(self.extractions), len(self.merchants), len(self.completed))
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def extraction(self, statement: str) -> Optional[List[Dict[str, Any]]]:
+        return self.extractions.get(statement)
+
+    def record_extraction(self, statement: str, transactions: List[Dict[str, Any]]) -> None:
+        self.extractions[statement] = transactions
+        self._append({"type": "extraction", "statement": statement, "transactions": transactions})
+
+    def merchant(self, key: str, merchant_code: str, transaction_amount: float) -> Optional[MerchantInfo]:
+        """Return a journaled analysis re-labelled for this transaction, or None"""
+        info = self.merchants.get(key)
+        if info is None:
+            return None
+        return replace(info, merchant_code=merchant_code, transaction_amount=transaction_amount)
+
+    def record_merchant(self, key: str, info: MerchantInfo) -> None:
+        if key in self.merchants:
+            return
+        self.merchants[key] = info
+        self._append({"type": "merchant", "key": key, "info": merchant_info_to_dict(info)})
+
+    def is_completed(self, statement: str) -> bool:
+        return statement in self.completed
+
+    def record_completed(self, statement: str) -> None:
+        self.completed.add(statement)
+        self._append({"type": "completed", "statement": statement})
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def discard(self) -> None:
+        """Close and delete the journal once its job has finished and been delivered"""
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+    def __enter__(self) -> 'JobJournal':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def create_job_journal(job_id: str, directory: Optional[Path] = None) -> Optional[JobJournal]:
+    """Open the journal for a job, or return None when JOB_JOURNAL=false"""
+    if os.getenv('JOB_JOURNAL', 'true').lower() in ('0', 'false', 'no', 'off'):
+        return None
+    default_dir = Path(__file__).parent.parent.parent / 'cache' / 'journals'
+    directory = Path(directory or os.getenv('JOB_JOURNAL_DIR', str(default_dir)))
+    fsync = os.getenv('JOB_JOURNAL_FSYNC', 'true').lower() not in ('0', 'false', 'no', 'off')
+    return JobJournal(directory / f"{job_id}.jsonl", fsync=fsync)
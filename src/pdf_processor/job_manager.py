@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from metrics import get_metrics
+from models import MerchantInfo
+from runtime import Runtime, get_runtime
+from statement_pipeline import analyze_statement, format_merchant_analysis, statement_result
+
+JOB_STATUSES = ('queued', 'running', 'succeeded', 'failed')
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity"""
+    pass
+
+@dataclass
+class Job:
+    id: str
+    file_path: str
+    notify_email: Optional[str]
+    status: str = 'queued'
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    merchants_done: int = 0
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    # Uploaded statements are deleted once their job finishes
+    owns_file: bool = False
+    # Transaction store account; None uses the configured default
+    account: Optional[str] = None
+    events: List[Dict[str, Any]] = field(default_factory=list)
+    subscribers: List[asyncio.Queue] = field(default_factory=list)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('succeeded', 'failed')
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "merchants_done": self.merchants_done,
+            "error": self.error,
+        }
+
+    def publish(self, event: str, **data: Any) -> None:
+        """Record an event and hand it to every subscriber"""
+        message = {"event": event, "job_id": self.id, "status": self.status, **data}
+        self.events.append(message)
+        for queue in self.subscribers:
+            queue.put_nowait(message)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Queue of this job's events, starting with the ones already published"""
+        queue: asyncio.Queue = asyncio.Queue()
+        for message in self.events:
+            queue.put_nowait(message)
+        self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        if queue in self.subscribers:
+            self.subscribers.remove(queue)
+
+class JobManager:
+    """Runs statement jobs on a fixed number of workers behind a bounded queue.
+
+    Submitting never starts work directly: a job waits in the queue until a
+    worker is free, and submissions beyond the queue's capacity are refused
+    with JobQueueFull so a burst of uploads can't pile up unbounded work on
+    the event loop. Jobs run the same statement pipeline as the Lambda handler,
+    journal included. Extraction and file I/O run on worker threads; merchant
+    analysis uses the runtime's shared processor, so concurrent jobs share its
+    cache, rate limits and in-flight analyses.
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_queued: Optional[int] = None,
+                 result_ttl: Optional[float] = None, runtime: Optional[Runtime] = None):
+        self.workers = workers or int(os.getenv('API_JOB_WORKERS', '2'))
+        self.max_queued = max_queued or int(os.getenv('API_MAX_QUEUED_JOBS', '20'))
+        # Finished jobs (and their results) are kept this long for polling clients
+        self.result_ttl = result_ttl or float(os.getenv('API_JOB_RESULT_TTL_SECONDS', '3600'))
+        self.runtime = runtime or get_runtime()
+        self.jobs: Dict[str, Job] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self.logger = logging.getLogger('JobManager')
+
+    def start(self) -> None:
+        """Start the workers on the running event loop"""
+        self.queue = asyncio.Queue(maxsize=self.max_queued)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.logger.info("Started %d job workers (queue capacity %d)", self.workers, self.max_queued)
+
+    async def stop(self) -> None:
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def new_job_id(self) -> str:
+        return uuid.uuid4().hex
+
+    def submit(self, file_path: str, notify_email: Optional[str] = None, job_id: Optional[str] = None,
+               owns_file: bool = False, account: Optional[str] = None) -> Job:
+        """Queue a statement for processing, or raise JobQueueFull"""
+        self._prune()
+        job = Job(id=job_id or self.new_job_id(), file_path=file_path,
+                  notify_email=notify_email, owns_file=owns_file, account=account)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFull(f"{self.queue.qsize()} jobs are already waiting")
+        self.jobs[job.id] = job
+        job.publish('queued', position=self.queue.qsize())
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.result_ttl
+        for job_id in [job.id for job in self.jobs.values() if job.finished and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self.queue.get()
+            try:
+                with get_metrics().statement(job.id):
+                    await self.run(job)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job: Job) -> None:
+        job.status = 'running'
+        job.started_at = time.time()
+        job.publish('running')
+        runtime = self.runtime
+
+        def on_result(info: MerchantInfo) -> None:
+            job.merchants_done += 1
+            job.publish('merchant', merchants_done=job.merchants_done,
+                        merchant=format_merchant_analysis([info])[0])
+
+        try:
+            statement_id, transactions, merchant_results = await analyze_statement(
+                job.file_path, runtime, job.account, on_result
+            )
+            job.result = statement_result(statement_id, transactions, merchant_results, job.notify_email)
+            job.status = 'succeeded'
+        except Exception as e:
+            self.logger.error("Job %s failed: %s", job.id, str(e))
+            job.error = str(e)
+            job.result = {"success": False, "error": str(e)}
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            if job.owns_file:
+                Path(runtime.config.upload_dir, job.file_path).unlink(missing_ok=True)
+
+        job.publish(job.status, merchants_done=job.merchants_done, error=job.error)
+        self.logger.info("Job %s %s in %.1fs", job.id, job.status, job.finished_at - job.started_at)
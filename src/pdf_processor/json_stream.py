@@ -0,0 +1,57 @@
+import json
+from typing import Dict, List
+
+class IncrementalJSONArrayParser:
+    """Parses a JSON array of objects as text arrives, returning each object once it is complete.
+
+    Anything before the opening '[' (prose, a ```json fence) is ignored, as is
+    anything after the closing ']'.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+        self.started = False
+        self.finished = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.object_start = None
+
+    def feed(self, text: str) -> List[Dict]:
+        """Add more response text and return any objects completed by it"""
+        self.buffer += text
+        completed = []
+        while self.position < len(self.buffer) and not self.finished:
+            char = self.buffer[self.position]
+            if not self.started:
+                if char == '[':
+                    self.started = True
+            elif self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                if self.depth == 0 and char == '{':
+                    self.object_start = self.position
+                self.depth += 1
+            elif char in '}]':
+                if self.depth == 0 and char == ']':
+                    self.finished = True
+                else:
+                    self.depth -= 1
+                    if self.depth == 0 and self.object_start is not None:
+                        completed.append(json.loads(self.buffer[self.object_start:self.position + 1]))
+                        self.object_start = None
+            self.position += 1
+
+        # Drop text that can no longer be part of an object
+        if self.object_start is None:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+        return completed
@@ -0,0 +1,227 @@
+import io
+import logging
+import re
+from dataclasses import dataclass, field
+from datetime import date
+from typing import BinaryIO, Dict, List, Optional, Type, Union
+
+from PyPDF2 import PdfReader, PdfWriter
+
+MONTHS = {name: number for number, name in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], start=1
+)}
+
+AMOUNT = r'(?P<amount>-?\s?\$?\s?-?[\d,]+\.\d{2})(?:\s*(?P<credit>CR))?'
+
+def parse_amount(text: str, credit: bool = False) -> float:
+    """Parse '$1,234.56', '-$5.00' or '5.00 CR' style amounts; credits are negative"""
+    negative = '-' in text or credit
+    value = float(re.sub(r'[^\d.]', '', text))
+    return -value if negative else value
+
+@dataclass
+class LocalExtractionResult:
+    transactions: List[Dict]
+    confident: bool
+    parser: Optional[str] = None
+    reason: str = ''
+    # Transactions found on each page, so LLM output for other pages can be merged in order
+    page_transactions: List[List[Dict]] = field(default_factory=list)
+    # Pages with no usable text layer (usually scanned images)
+    pages_without_text: List[int] = field(default_factory=list)
+    # Summary totals printed on the statement, to check rows merged in from elsewhere
+    totals: Dict[str, float] = field(default_factory=dict)
+
+class StatementParser:
+    """Line parser for one card issuer's statement layout.
+
+    Subclasses set issuer_pattern (matched against the full statement text to
+    pick the parser) and line_pattern, which must define date, description and
+    amount groups (plus an optional credit group).
+    """
+
+    name = 'generic'
+    issuer_pattern: Optional[re.Pattern] = None
+    line_pattern = re.compile(
+        r'^(?P<date>\d{1,2}/\d{1,2}(?:/\d{2,4})?)\*?\s+'
+        r'(?:\d{1,2}/\d{1,2}(?:/\d{2,4})?\*?\s+)?'
+        r'(?P<description>.+?)\s+' + AMOUNT + r'$'
+    )
+    # Statement summary totals used for the confidence check
+    total_patterns = {
+        'purchases': re.compile(r'^(?:total\s+)?purchases(?:\s+and\s+adjustments)?\s*\+?\s*\$?([\d,]+\.\d{2})',
+                                re.IGNORECASE | re.MULTILINE),
+        'credits': re.compile(r'^(?:total\s+)?(?:payments?,?\s*(?:and\s+)?(?:other\s+)?credits?|credits)'
+                              r'\s*-?\s*\$?-?([\d,]+\.\d{2})', re.IGNORECASE | re.MULTILINE),
+        'fees': re.compile(r'^(?:total\s+)?fees\s+charged\s*\+?\s*\$?([\d,]+\.\d{2})',
+                           re.IGNORECASE | re.MULTILINE),
+        'interest': re.compile(r'^(?:total\s+)?interest\s+charged\s*\+?\s*\$?([\d,]+\.\d{2})',
+                               re.IGNORECASE | re.MULTILINE),
+    }
+    # Closing date of the statement period, used to fill in the year
+    closing_date_pattern = re.compile(
+        r'(?:closing\s+date|statement\s+(?:closing\s+)?date|opening/closing\s+date[^\n]*?-)\s*:?\s*'
+        r'(?P<date>\d{1,2}/\d{1,2}/\d{2,4})',
+        re.IGNORECASE
+    )
+
+    @classmethod
+    def matches(cls, text: str) -> bool:
+        return cls.issuer_pattern is not None and bool(cls.issuer_pattern.search(text))
+
+    def __init__(self, text: str):
+        self.closing_date = self._find_closing_date(text)
+
+    def _find_closing_date(self, text: str) -> Optional[date]:
+        match = self.closing_date_pattern.search(text)
+        if match:
+            month, day, year = match.group('date').split('/')
+            year = int(year) + 2000 if len(year) == 2 else int(year)
+            try:
+                return date(year, int(month), int(day))
+            except ValueError:
+                # An impossible date (02/30) is misread text, not a reason to fail the statement
+                pass
+        years = re.findall(r'\b(20\d{2})\b', text)
+        if years:
+            return date(int(max(years)), 12, 31)
+        return None
+
+    def parse_date(self, text: str) -> Optional[str]:
+        parts = text.rstrip('*').split('/')
+        month, day = int(parts[0]), int(parts[1])
+        if len(parts) == 3:
+            year = int(parts[2]) + 2000 if len(parts[2]) == 2 else int(parts[2])
+        elif self.closing_date is not None:
+            # Statements list MM/DD only; a December row on a January statement is last year
+            year = self.closing_date.year - (1 if month > self.closing_date.month else 0)
+        else:
+            return None
+        try:
+            return date(year, month, day).isoformat()
+        except ValueError:
+            return None
+
+    def parse_line(self, line: str) -> Optional[Dict]:
+        match = self.line_pattern.match(line.strip())
+        if not match:
+            return None
+        transaction_date = self.parse_date(match.group('date'))
+        if transaction_date is None:
+            return None
+        return {
+            "date": transaction_date,
+            "merchant": ' '.join(match.group('description').split()),
+            "amount": parse_amount(match.group('amount'), bool(match.groupdict().get('credit'))),
+        }
+
+    def statement_totals(self, text: str) -> Dict[str, float]:
+        totals = {}
+        for name, pattern in self.total_patterns.items():
+            match = pattern.search(text)
+            if match:
+                totals[name] = parse_amount(match.group(1))
+        return totals
+
+class ChaseParser(StatementParser):
+    name = 'chase'
+    issuer_pattern = re.compile(r'\bchase\b|jpmorgan', re.IGNORECASE)
+
+class AmexParser(StatementParser):
+    name = 'amex'
+    issuer_pattern = re.compile(r'american\s+express|americanexpress\.com', re.IGNORECASE)
+
+class CapitalOneParser(StatementParser):
+    name = 'capital_one'
+    issuer_pattern = re.compile(r'capital\s*one', re.IGNORECASE)
+    # "Jan 5 Jan 6 NETFLIX.COM LOS GATOS CA $15.49" (transaction date, post date)
+    line_pattern = re.compile(
+        r'^(?P<date>[A-Z][a-z]{2}\s+\d{1,2})\s+(?:[A-Z][a-z]{2}\s+\d{1,2}\s+)?'
+        r'(?P<description>.+?)\s+' + AMOUNT + r'$'
+    )
+
+    def parse_date(self, text: str) -> Optional[str]:
+        month_name, day = text.split()
+        month = MONTHS.get(month_name.lower()[:3])
+        if month is None:
+            return None
+        return super().parse_date(f"{month}/{day}")
+
+# Issuer-specific parsers are tried in order; StatementParser is the fallback
+PARSERS: List[Type[StatementParser]] = [ChaseParser, AmexParser, CapitalOneParser]
+
+def register_parser(parser: Type[StatementParser]) -> Type[StatementParser]:
+    """Class decorator that adds an issuer parser ahead of the built-in ones"""
+    PARSERS.insert(0, parser)
+    return parser
+
+class LocalExtractor:
+    """Extracts transactions from a PDF's text layer without calling the LLM"""
+
+    def __init__(self, tolerance: float = 0.01):
+        self.tolerance = tolerance
+        self.logger = logging.getLogger('LocalExtractor')
+
+    def select_parser(self, text: str) -> StatementParser:
+        for parser in PARSERS:
+            if parser.matches(text):
+                return parser(text)
+        return StatementParser(text)
+
+    def extract(self, pdf: Union[str, bytes, BinaryIO]) -> LocalExtractionResult:
+        stream = io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf
+        try:
+            reader = PdfReader(stream)
+            page_texts = [page.extract_text() or '' for page in reader.pages]
+        except Exception as e:
+            self.logger.warning("Could not read PDF text layer: %s", str(e))
+            return LocalExtractionResult([], False, reason=f"unreadable text layer: {e}")
+
+        pages_without_text = [index for index, text in enumerate(page_texts) if len(text.strip()) < 20]
+        full_text = '\n'.join(page_texts)
+        parser = self.select_parser(full_text)
+
+        page_transactions = []
+        for text in page_texts:
+            rows = [row for row in (parser.parse_line(line) for line in text.splitlines()) if row]
+            page_transactions.append(rows)
+        transactions = [row for rows in page_transactions for row in rows]
+
+        totals = parser.statement_totals(full_text)
+        confident, reason = self.check_totals(transactions, totals)
+        if pages_without_text:
+            confident = False
+            reason = f"{len(pages_without_text)} page(s) without a text layer"
+        self.logger.debug("Local %s parser found %d transactions (confident=%s, %s)",
+                          parser.name, len(transactions), confident, reason)
+        return LocalExtractionResult(transactions, confident, parser.name, reason,
+                                     page_transactions, pages_without_text, totals)
+
+    def check_totals(self, transactions: List[Dict], totals: Dict[str, float]):
+        """Check parsed rows against the statement summary totals"""
+        if not transactions:
+            return False, "no transactions found"
+        if 'purchases' not in totals:
+            return False, "no statement totals to verify against"
+
+        charges = sum(row['amount'] for row in transactions if row['amount'] > 0)
+        credits = -sum(row['amount'] for row in transactions if row['amount'] < 0)
+
+        # Fees and interest are listed as rows on some statements and not others
+        extras = [0.0, totals.get('fees', 0.0), totals.get('interest', 0.0),
+                  totals.get('fees', 0.0) + totals.get('interest', 0.0)]
+        if not any(abs(charges - (totals['purchases'] + extra)) <= self.tolerance for extra in extras):
+            return False, f"charges {charges:.2f} do not match purchases total {totals['purchases']:.2f}"
+        if 'credits' in totals and abs(credits - totals['credits']) > self.tolerance:
+            return False, f"credits {credits:.2f} do not match credits total {totals['credits']:.2f}"
+        return True, "statement totals match"
+
+def extract_pages(pdf: Union[bytes, BinaryIO], page_indexes: List[int]) -> bytes:
+    """Build a new PDF containing only the given pages"""
+    reader = PdfReader(io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf)
+    writer = PdfWriter()
+    for index in page_indexes:
+        writer.add_page(reader.pages[index])
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
@@ -1,57 +1,23 @@
 import argparse
-import os
-from config import Config
-from pdf_extractor import PDFExtractor, PDFExtractionError
-from transaction_processor import TransactionProcessor
-from typing import Dict, Any
+from metrics import get_metrics
+from pdf_extractor import PDFExtractionError
+from runtime import Runtime, get_runtime
+from statement_pipeline import analyze_statement, statement_result
+from typing import Dict, Any, Optional
 import sys
-import json
-import asyncio
 
-def process_pdf(file_path: str, notify_email: str) -> Dict[str, Any]:
+def process_pdf(file_path: str, notify_email: str, runtime: Optional[Runtime] = None,
+                account: Optional[str] = None) -> Dict[str, Any]:
+    with get_metrics().statement(file_path):
+        return _process_pdf(file_path, notify_email, runtime, account)
+
+def _process_pdf(file_path: str, notify_email: str, runtime: Optional[Runtime],
+                 account: Optional[str]) -> Dict[str, Any]:
     try:
-        # Initialize config and extractor
-        config = Config()
-        extractor = PDFExtractor(config)
-        
-        # Extract transactions directly from PDF
-        transactions = extractor.extract_transactions_from_pdf(file_path)
-        
-        # Create DataFrame
-        df = extractor.create_dataframe(transactions)
-        
-        # Process transactions asynchronously
-        processor = TransactionProcessor()
-        merchant_results = asyncio.run(processor.process_transactions(transactions))
-        
-        # Build response with analysis results
-        return {
-            "success": True,
-            "num_transactions": len(transactions),
-            "email": notify_email,
-            "transactions": transactions,
-            "merchant_analysis": [
-                {
-                    "merchant_code": result.merchant_code,
-                    "merchant_name": result.merchant,
-                    "website": result.website,
-                    "phone": result.phone,
-                    "product_description": result.product_description,
-                    "price_range": result.price_range,
-                    "likely_purchases": [
-                        {
-                            "name": purchase.name,
-                            "price": purchase.price,
-                            "description": purchase.description,
-                            "confidence": purchase.confidence_score,
-                            "reason": purchase.match_reason
-                        }
-                        for purchase in result.likely_purchases
-                    ]
-                }
-                for result in merchant_results
-            ]
-        }
+        # Config, clients and caches are built once per container and reused
+        runtime = runtime or get_runtime()
+        statement_id, transactions, merchant_results = runtime.run(analyze_statement(file_path, runtime, account))
+        return statement_result(statement_id, transactions, merchant_results, notify_email)
         
     except PDFExtractionError as e:
         return {
@@ -64,23 +30,24 @@ def process_pdf(file_path: str, notify_email: str) -> Dict[str, Any]:
             "error": f"Unexpected error: {str(e)}"
         }
 
-# Lambda handler
+# Lambda handler; the runtime it uses survives between invocations in a warm container
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     file_path = event['file_path']
     notify_email = event['notify_email']
     
-    return process_pdf(file_path, notify_email)
+    return process_pdf(file_path, notify_email, account=event.get('account'))
 
 # Local development entry point
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('file_name', help='Name of the PDF file in uploads directory')
     parser.add_argument('--email', help='Email to notify when complete')
+    parser.add_argument('--account', help='Account the statement is stored under in the transaction store')
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
     
     try:
-        result = process_pdf(args.file_name, args.email)
+        result = process_pdf(args.file_name, args.email, account=args.account)
         
         if not result["success"]:
             print(f"Error: {result['error']}")
@@ -1,48 +1,107 @@
-import pandas as pd
+import asyncio
 import os
-from typing import List, Dict, Tuple
-import anthropic
-import requests
-from dataclasses import dataclass
+from typing import List, Dict, Tuple, Optional
 from dotenv import load_dotenv
 import logging
-import json
-
-@dataclass
-class ProductMatch:
-    name: str
-    price: float
-    description: str
-    confidence_score: float
-    match_reason: str
-
-@dataclass
-class CompetitorProduct:
-    name: str
-    company: str
-    price: str
-    description: str
-    website: str
-    comparison: str
-
-@dataclass
-class MerchantInfo:
-    merchant_code: str      # Original transaction description
-    merchant: str          # Clean company name from website
-    website: str
-    phone: str
-    product_description: str
-    transaction_amount: float
-    competitor_products: List[CompetitorProduct]
-    original_transaction_description: str
+from concurrent.futures import ThreadPoolExecutor
+from models import ProductMatch, CompetitorProduct, MerchantInfo
+from brave_search import BraveSearchClient, create_search_client
+from merchant_cache import MerchantCache, create_merchant_cache, make_cache_key
+from merchant_index import MerchantIndex, create_merchant_index, normalize_descriptor
+from metrics import get_metrics
+from rate_limiter import RateLimitScheduler, estimate_message_tokens, get_rate_limiter
+from structured_output import (COMPANIES_TOOL, COMPANY_TOOL, COMPETITORS_TOOL, MERCHANT_ANALYSIS_TOOL,
+                               STRUCTURED_OUTPUT_RETRIES, StructuredOutputError, parse_tool_response,
+                               company_entry, retry_params, tool_params)
+
+# How the identification and competitor prompts are issued per merchant:
+#   sequential  - identify the merchant, then ask for competitors by name (two round trips)
+#   combined    - one request returning company info and competitors together
+#   speculative - competitor request on the cleaned merchant code, in parallel with identification
+ANALYSIS_MODES = ('sequential', 'combined', 'speculative')
+
+# The static instructions go in the system prompt, ahead of the short
+# per-merchant message. With its tool and the API's tool-use preamble this
+# prefix is about 1,090 tokens, just over the 1,024-token cache minimum of the
+# Sonnet and Opus models, so on those models merchants after the first read it
+# from the prompt cache. Models with a 2,048-token minimum (Haiku) never cache it.
+COMPETITOR_SYSTEM_PROMPT = """You are an AI assistant tasked with identifying less expensive competitor products based on transaction information. You will be given some company information, a transaction description, and a transaction amount. Your goal is to determine 1-3 competitor products that are less expensive than the given transaction.
+
+Follow these steps to complete the task:
+
+1. Analyze the given information:
+   - Identify the company name and any other relevant details from the company info.
+   - Examine the transaction description to understand the type of product or service purchased.
+   - Note the transaction amount as the reference price.
+
+2. Research competitor products:
+   - Based on the company name and transaction description, determine the industry or product category.
+   - Search for similar products or services offered by other companies in the same industry.
+   - Focus on finding options that are less expensive than the given transaction amount.
+
+3. Select 1-3 competitor products:
+   - Choose products that are similar in function or purpose to the original transaction.
+   - Ensure that the selected products are less expensive than the transaction amount.
+   - If possible, try to find options from well-known or reputable companies.
+
+4. Gather information about each competitor product:
+   - Product name
+   - Company offering the product
+   - Price (ensure it's less than the transaction amount)
+   - Brief description of the product
+   - Website or source of information (if available)
+
+5. Present your findings:
+   - Briefly describe the original transaction.
+   - List each competitor product with the gathered information.
+   - Explain how each product compares to the original transaction in terms of features and price.
+
+Record your findings with the record_competitor_products tool, including at least 1 and up to 3 competitor products. If a website is not available, leave that field empty.
+
+Remember to ensure that all competitor products you suggest are less expensive than the original transaction amount. If you cannot find any suitable competitor products that are less expensive, record the closest alternatives and explain why in their comparison."""
+
+COMBINED_SYSTEM_PROMPT = """You are an AI assistant that identifies the merchant behind a credit card transaction and finds 1-3 less expensive competitor products. You will be given the transaction description, the transaction amount and web search results about the merchant.
+
+First, use the search results to identify the official company name, website, phone number and products or services of the merchant. Then determine the product or service that was likely purchased, and find 1-3 similar products or services from other reputable companies that are less expensive than the transaction amount.
+
+Record the result with the record_merchant_analysis tool. If any company information is unknown, use 'Unknown' as the value. If a competitor website is not available, leave that field empty."""
+
+COMPANY_FIELDS = ('company_name', 'website', 'phone', 'products')
+
+def company_fields(payload: Dict) -> Dict[str, str]:
+    """The identification fields of a tool payload, each on one line and 'Unknown' when missing"""
+    return {field: ' '.join(str(payload.get(field) or 'Unknown').split()) for field in COMPANY_FIELDS}
+
+def cached_system_prompt(text: str) -> List[Dict]:
+    """A system prompt marked as a prompt-cache breakpoint.
+
+    The API caches the request prefix up to the marker (tools, then system) for
+    a few minutes, and later requests with the same prefix read it at a tenth
+    of the input price. Prefixes under the model's minimum cacheable length
+    (1024 tokens on most models) are processed normally without being cached.
+    """
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
 
 class MerchantAnalyzer:
-    def __init__(self, verbose: bool = False):
+    def __init__(self, verbose: bool = False, cache: Optional[MerchantCache] = None,
+                 analysis_mode: Optional[str] = None, merchant_index: Optional[MerchantIndex] = None,
+                 search_client: Optional[BraveSearchClient] = None,
+                 rate_limiter: Optional[RateLimitScheduler] = None):
+        # The SDK is imported here rather than at module level to keep cold starts fast
+        import anthropic
+        self._configure(verbose, cache, analysis_mode, merchant_index, search_client)
+        # Retries are owned by the rate limit scheduler, not the SDK
+        self.client = anthropic.Anthropic(api_key=self.claude_api_key, max_retries=0)
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+
+    def _configure(self, verbose: bool, cache: Optional[MerchantCache],
+                   analysis_mode: Optional[str] = None,
+                   merchant_index: Optional[MerchantIndex] = None,
+                   search_client: Optional[BraveSearchClient] = None) -> None:
+        """Load settings, logging and cache shared by the sync and async analyzers"""
         load_dotenv()
-        self.brave_api_key = os.getenv('BRAVE_API_KEY')
         self.claude_api_key = os.getenv('ANTHROPIC_API_KEY')
         self.claude_model = os.getenv('ANTHROPIC_MODEL')
-        self.client = anthropic.Anthropic(api_key=self.claude_api_key)
         
         # Setup logging
         self.logger = logging.getLogger('MerchantAnalyzer')
@@ -52,112 +111,165 @@ class MerchantAnalyzer:
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         )
         
-    def search_brave(self, merchant_name: str) -> List[Dict]:
-        """Search Brave for merchant information"""
-        self.logger.debug("Searching Brave for merchant: %s", merchant_name)
-        url = "https://api.search.brave.com/res/v1/web/search"
-        headers = {"X-Subscription-Token": self.brave_api_key}
+        # Cache of finished analyses, keyed on cleaned merchant code and amount bucket
+        self.cache = cache if cache is not None else create_merchant_cache()
         
-        # Improve search query to focus on business information
-        cleaned_name = merchant_name.strip().replace('*', '').lower()
-        params = {
-            "q": f'"{cleaned_name}" company business contact information',
-            "count": 5  # Increased from 5 to get more results
-        }
+        # Brave searches, cached and coalesced per cleaned query
+        self.search_client = search_client if search_client is not None else create_search_client()
         
-        response = requests.get(url, headers=headers, params=params, timeout=10)
-        self.logger.debug("Brave API response status: %d", response.status_code)
-        
-        if response.status_code == 200:
-            results = response.json().get('web', {}).get('results', [])
-            self.logger.debug("Found %d results from Brave", len(results))
-            
-            # Filter results to prioritize official websites
-            filtered_results = []
-            for result in results:
-                url = result.get('url', '').lower()
-                if any(term in url for term in ['.com', '.org', '.net', '.co']):
-                    filtered_results.append(result)
-            
-            return filtered_results[:5]  # Return top 5 filtered results
-        return []
-
-    def _clean_merchant_code(self, merchant_code: str) -> str:
-        """Clean up merchant code for better search results"""
-        # Remove common transaction prefixes/suffixes
-        cleaned = merchant_code.strip()
-        cleaned = cleaned.split('*')[0]  # Remove everything after asterisk
+        # Known merchants, so recognised descriptors skip search and identification
+        self.merchant_index = merchant_index if merchant_index is not None else create_merchant_index()
         
-        # Remove common transaction patterns
-        patterns = ['TST', 'SQ ', 'SQU ', 'PAYPAL ', 'DEB ', 'ACH ', 'AUTOPAY']
-        for pattern in patterns:
-            cleaned = cleaned.replace(pattern, '')
+        # Number of merchants identified per Claude request in batch mode
+        self.batch_size = int(os.getenv('MERCHANT_BATCH_SIZE', '20'))
         
-        # Remove any non-alphanumeric chars except spaces
-        cleaned = ''.join(c for c in cleaned if c.isalnum() or c.isspace())
+        self.analysis_mode = analysis_mode or os.getenv('ANALYSIS_MODE', 'sequential')
+        if self.analysis_mode not in ANALYSIS_MODES:
+            raise ValueError(f"Unknown analysis mode '{self.analysis_mode}', "
+                             f"expected one of {', '.join(ANALYSIS_MODES)}")
         
-        return cleaned.strip()
+    def search_brave(self, merchant_name: str) -> List[Dict]:
+        """Search Brave for merchant information"""
+        return self.search_client.search(merchant_name)
+
+    def _create_message(self, operation: str, **params):
+        """Send a Messages request through the rate limiter, recording its latency, tokens and cost"""
+        estimated_tokens = estimate_message_tokens(params)
+        metrics = get_metrics()
+        with metrics.timer('claude_message', operation=operation):
+            raw = self.rate_limiter.call_sync(
+                'anthropic', lambda: self.client.messages.with_raw_response.create(**params),
+                tokens=estimated_tokens
+            )
+            message = raw.parse()
+        metrics.record_message(operation, params['model'], message.usage)
+        self.rate_limiter.settle('anthropic', estimated_tokens, message.usage.input_tokens)
+        return message
+
+    def _structured_retry(self, operation: str, attempt: int, error: StructuredOutputError) -> None:
+        """Log and count a reply that didn't fit its schema, raising once the retries are used up"""
+        get_metrics().inc('structured_output_errors_total', help='Replies that did not fit their tool schema',
+                          operation=operation)
+        if attempt >= STRUCTURED_OUTPUT_RETRIES:
+            raise StructuredOutputError(f"{operation} reply still unusable after {attempt} retries: {error}")
+        self.logger.warning("Re-asking for the %s reply: %s", operation, str(error))
+
+    def _structured_message(self, operation: str, **params) -> Dict:
+        """Send a request answered through its tool and return the checked tool input"""
+        for attempt in range(STRUCTURED_OUTPUT_RETRIES + 1):
+            message = self._create_message(operation, **params)
+            try:
+                return parse_tool_response(message, params['tools'][0])
+            except StructuredOutputError as e:
+                self._structured_retry(operation, attempt, e)
+                params = retry_params(params, message, e)
 
-    def analyze_merchant(self, merchant_code: str, transaction_amount: float) -> MerchantInfo:
-        """Analyze a single merchant using Brave search and Claude"""
-        self.logger.info("Starting analysis for merchant: %s (amount: $%.2f)", 
-                        merchant_code, transaction_amount)
-        
-        # Clean up merchant code before searching
+    @staticmethod
+    def _clean_merchant_code(merchant_code: str) -> str:
+        """Clean up merchant code for better search results"""
+        return normalize_descriptor(merchant_code)
+
+    def analysis_key(self, merchant_code: str, transaction_amount: float) -> str:
+        """Key shared by every transaction that gets the same analysis (cache and de-duplication)"""
         cleaned_merchant = self._clean_merchant_code(merchant_code)
-        self.logger.debug("Cleaned merchant code: %s", cleaned_merchant)
-        
-        # Get search results with cleaned merchant name
-        search_results = self.search_brave(cleaned_merchant)
-        self.logger.debug("Got %d search results from Brave", len(search_results))
-        
+        key = make_cache_key(cleaned_merchant or merchant_code, transaction_amount)
+        # Keep results from the experimental modes apart so they can be compared
+        if self.analysis_mode != 'sequential':
+            key = f"{key}|{self.analysis_mode}"
+        return key
+
+    def _get_cached(self, merchant_code: str, transaction_amount: float) -> Optional[MerchantInfo]:
+        if self.cache is None:
+            return None
+        cached = self.cache.get(self.analysis_key(merchant_code, transaction_amount),
+                                merchant_code, transaction_amount)
+        get_metrics().record_cache('merchant', cached is not None)
+        if cached is not None:
+            self.logger.info("Using cached analysis for %s", merchant_code)
+        return cached
+
+    def _indexed_company(self, merchant_code: str) -> Optional[Dict[str, str]]:
+        """Identification for a merchant already in the index, in the same shape as company_fields"""
+        if self.merchant_index is None:
+            return None
+        match = self.merchant_index.lookup(merchant_code)
+        get_metrics().record_cache('merchant_index', match is not None)
+        if match is None:
+            return None
+        self.logger.info("Identified %s as %s from the merchant index (score %.2f)",
+                         merchant_code, match.record.merchant, match.score)
+        company = match.record.as_company()
+        # Tells _build_merchant_info not to learn the index's own match back into it
+        company['indexed'] = True
+        return company
+
+    def _store_cached(self, merchant_info: MerchantInfo) -> None:
+        # Don't cache failed competitor parses, so the next run gets another try
+        if self.cache is not None and (merchant_info.competitor_products or
+                                       merchant_info.original_transaction_description):
+            self.cache.set(self.analysis_key(merchant_info.merchant_code, merchant_info.transaction_amount),
+                           merchant_info)
+
+    def _build_merchant_context(self, search_results: List[Dict]) -> str:
         merchant_context = "\n".join([
             f"URL: {result['url']}\n"
             f"Title: {result['title']}\n"
             f"Description: {result['description']}\n"
             for result in search_results
         ])
-        self.logger.debug("Built merchant context:\n%s", merchant_context)
+        self.logger.debug("Built merchant context from %d results (%d characters)",
+                          len(search_results), len(merchant_context))
+        return merchant_context
 
-        # First prompt to get merchant info
-        self.logger.debug("Sending merchant info prompt to Claude")
-        merchant_prompt = f"""Based on these search results for the transaction '{merchant_code}', extract the company information:
+    def _build_merchant_prompt(self, merchant_code: str, merchant_context: str) -> str:
+        return f"""Based on these search results for the transaction '{merchant_code}', extract the company information:
 
 Search Results:
 {merchant_context}
 
-Format your response exactly like this, with one piece of information per line:
+Record it with the record_company tool. If any information is unknown, use 'Unknown' as the value.
+Focus on finding the official company name, as this will be used for further analysis."""
 
-Company name: [official name only]
-Website URL: [url]
-Phone number: [phone]
-Products or services: [brief description]
+    def _build_batch_merchant_prompt(self, entries: List[Tuple[str, str]]) -> str:
+        """Build one identification prompt for several (merchant_code, merchant_context) pairs"""
+        sections = "\n\n".join(
+            f"<merchant index=\"{index}\">\n"
+            f"Transaction: {merchant_code}\n"
+            f"Search Results:\n{merchant_context}\n"
+            f"</merchant>"
+            for index, (merchant_code, merchant_context) in enumerate(entries)
+        )
+        return f"""Below are {len(entries)} credit card transactions, each with search results about the merchant. For each one, extract the company information.
 
-If any information is unknown, use 'Unknown' as the value.
+{sections}
+
+Record them with the record_companies tool, one entry per merchant. Use the index from each <merchant> tag. If any information is unknown, use 'Unknown' as the value.
 Focus on finding the official company name, as this will be used for further analysis."""
-        
-        merchant_response = self.client.messages.create(
-            model=self.claude_model,
-            max_tokens=1024,
-            temperature=0,
-            messages=[
-                {"role": "user", "content": merchant_prompt}
-            ]
-        )
-        self.logger.debug("Got merchant info response from Claude: %s", 
-                         merchant_response.content[0].text)
 
-        # Parse the first response to get company info
-        merchant_analysis = merchant_response.content[0].text
-        merchant_name = self.extract_field(merchant_analysis, "Company name")
-        self.logger.debug("Extracted merchant name: %s", merchant_name)
+    def _batch_companies(self, payload: Dict, count: int) -> Dict[int, Dict[str, str]]:
+        """Companies from a batch identification, by index.
 
-        # Second prompt for competitor analysis
-        self.logger.debug("Sending competitor analysis prompt to Claude")
-        competitor_price_analysis_prompt = f"""
-You are an AI assistant tasked with identifying less expensive competitor products based on transaction information. You will be given some company information, a transaction description, and a transaction amount. Your goal is to determine 1-3 competitor products that are less expensive than the given transaction.
+        Entries that don't fit the schema or have an index outside the batch
+        are dropped, and merchants without an entry are left out for the
+        caller to identify individually.
+        """
+        companies = {}
+        for position, entry in enumerate(payload['companies']):
+            try:
+                entry = company_entry(entry, f"companies[{position}]")
+            except StructuredOutputError as e:
+                self.logger.warning("Skipping batch entry: %s", str(e))
+                continue
+            if 0 <= entry['index'] < count:
+                companies[entry['index']] = company_fields(entry)
+            else:
+                self.logger.warning("Skipping batch entry with index %d", entry['index'])
+        return companies
 
-Here is the information you will be working with:
+    def _build_competitor_prompt(self, merchant_name: str, merchant_code: str,
+                                 transaction_amount: float) -> str:
+        """Per-merchant part of the competitor request; the instructions are in COMPETITOR_SYSTEM_PROMPT"""
+        return f"""Here is the information you will be working with:
 
 <company_info>
 {merchant_name}
@@ -169,105 +281,162 @@ Here is the information you will be working with:
 
 <transaction_amount>
 {transaction_amount}
-</transaction_amount>
+</transaction_amount>"""
 
-Follow these steps to complete the task:
-
-1. Analyze the given information:
-   - Identify the company name and any other relevant details from the company info.
-   - Examine the transaction description to understand the type of product or service purchased.
-   - Note the transaction amount as the reference price.
-
-2. Research competitor products:
-   - Based on the company name and transaction description, determine the industry or product category.
-   - Search for similar products or services offered by other companies in the same industry.
-   - Focus on finding options that are less expensive than the given transaction amount.
-
-3. Select 1-3 competitor products:
-   - Choose products that are similar in function or purpose to the original transaction.
-   - Ensure that the selected products are less expensive than the transaction amount.
-   - If possible, try to find options from well-known or reputable companies.
-
-4. Gather information about each competitor product:
-   - Product name
-   - Company offering the product
-   - Price (ensure it's less than the transaction amount)
-   - Brief description of the product
-   - Website or source of information (if available)
+    def _build_combined_prompt(self, merchant_code: str, merchant_context: str,
+                               transaction_amount: float) -> str:
+        """Per-merchant part of the combined request; the instructions are in COMBINED_SYSTEM_PROMPT"""
+        return f"""<transaction_description>
+{merchant_code}
+</transaction_description>
 
-5. Present your findings:
-   - Provide a brief introduction summarizing the original transaction and your task.
-   - List each competitor product with the gathered information.
-   - Explain how each product compares to the original transaction in terms of features and price.
+<transaction_amount>
+{transaction_amount}
+</transaction_amount>
 
-Please format your response as a JSON object with the following structure:
+<search_results>
+{merchant_context}
+</search_results>"""
 
-{{
-  "original_transaction": "Briefly describe the original transaction",
-  "competitor_products": [[
-    {{
-      "product_name": "Product Name",
-      "company": "Company Name",
-      "price": "Price",
-      "description": "Brief description",
-      "website": "Website if available",
-      "comparison": "How it compares to the original transaction"
-    }}
-  ]]
-}}
+    def _merchant_request(self, merchant_code: str, merchant_context: str) -> Dict:
+        return dict(
+            model=self.claude_model,
+            max_tokens=1024,
+            temperature=0,
+            messages=[
+                {"role": "user", "content": self._build_merchant_prompt(merchant_code, merchant_context)}
+            ],
+            **tool_params(COMPANY_TOOL)
+        )
 
-Please include at least 1 and up to 3 competitor products in the array. If a website is not available, you may leave that field empty or null. Ensure the response is valid JSON that could be parsed by a program.
+    def _competitor_request(self, merchant_name: str, merchant_code: str, transaction_amount: float) -> Dict:
+        return dict(
+            model=self.claude_model,
+            max_tokens=1024,
+            temperature=0,
+            system=cached_system_prompt(COMPETITOR_SYSTEM_PROMPT),
+            messages=[{"role": "user", "content": self._build_competitor_prompt(
+                merchant_name, merchant_code, transaction_amount
+            )}],
+            **tool_params(COMPETITORS_TOOL)
+        )
 
-Remember to ensure that all competitor products you suggest are less expensive than the original transaction amount. If you cannot find any suitable competitor products that are less expensive, explain why in your answer.
-"""
+    def _combined_request(self, merchant_code: str, merchant_context: str, transaction_amount: float) -> Dict:
+        return dict(
+            model=self.claude_model,
+            max_tokens=1536,
+            temperature=0,
+            # About 830 tokens with the tool and preamble, under every model's cache
+            # minimum, so there's no cache marker
+            system=COMBINED_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": self._build_combined_prompt(
+                merchant_code, merchant_context, transaction_amount
+            )}],
+            **tool_params(MERCHANT_ANALYSIS_TOOL)
+        )
 
-        competitor_price_analysis_response = self.client.messages.create(
+    def _batch_merchant_request(self, entries: List[Tuple[str, str]]) -> Dict:
+        return dict(
             model=self.claude_model,
-            max_tokens=1024,
+            max_tokens=min(4096, 256 * len(entries)),
             temperature=0,
-            messages=[{"role": "user", "content": competitor_price_analysis_prompt}]
+            messages=[{"role": "user", "content": self._build_batch_merchant_prompt(entries)}],
+            **tool_params(COMPANIES_TOOL)
         )
-        self.logger.debug("Got competitor analysis response from Claude: %s", 
-                         competitor_price_analysis_response.content[0].text)
 
-        # Parse responses
-        merchant_analysis = merchant_response.content[0].text
-        competitor_analysis = competitor_price_analysis_response.content[0].text
-        
-        self.logger.debug("Parsing competitor analysis")
-        orig_trans, competitor_products = self._parse_competitor_analysis(competitor_analysis)
+    def _build_merchant_info(self, merchant_code: str, transaction_amount: float,
+                             company: Dict[str, str], competitors: Dict) -> MerchantInfo:
+        """Combine the identification and the competitor tool input into a MerchantInfo"""
+        orig_trans, competitor_products = self._competitor_products(competitors)
         self.logger.debug("Got %d competitor products", len(competitor_products))
         
         self.logger.debug("Creating MerchantInfo object")
         try:
             merchant_info = MerchantInfo(
                 merchant_code=merchant_code,
-                merchant=self.extract_field(merchant_analysis, "Company name"),
-                website=self.extract_field(merchant_analysis, "Website URL"),
-                phone=self.extract_field(merchant_analysis, "Phone number"),
-                product_description=self.extract_field(merchant_analysis, "Products or services"),
+                merchant=company['company_name'],
+                website=company['website'],
+                phone=company['phone'],
+                product_description=company['products'],
                 transaction_amount=transaction_amount,
                 competitor_products=competitor_products,
                 original_transaction_description=orig_trans
             )
             self.logger.info("Successfully created MerchantInfo for %s", merchant_info.merchant)
-            return merchant_info
         except Exception as e:
             self.logger.error("Error creating MerchantInfo object: %s", str(e), exc_info=True)
             raise
+        
+        self._store_cached(merchant_info)
+        if self.merchant_index is not None and not company.get('indexed'):
+            self.merchant_index.learn(merchant_code, merchant_info)
+        return merchant_info
 
-    def extract_field(self, text: str, field: str) -> str:
-        """Extract field value from Claude's response"""
-        try:
-            for line in text.split('\n'):
-                if field.lower() in line.lower():
-                    parts = line.split(':', 1)
-                    if len(parts) > 1:
-                        return parts[1].strip()
-            return "Unknown"
-        except (AttributeError, IndexError) as e:
-            self.logger.error("Error extracting %s: %s", field, str(e))
-            return "Unknown"
+    def _analyze_competitors(self, merchant_code: str, transaction_amount: float,
+                             company: Dict[str, str]) -> MerchantInfo:
+        merchant_name = company['company_name']
+        self.logger.debug("Identified merchant name: %s", merchant_name)
+
+        self.logger.debug("Sending competitor analysis prompt to Claude")
+        competitors = self._structured_message(
+            'competitor', **self._competitor_request(merchant_name, merchant_code, transaction_amount)
+        )
+        return self._build_merchant_info(merchant_code, transaction_amount, company, competitors)
+
+    def analyze_merchant(self, merchant_code: str, transaction_amount: float) -> MerchantInfo:
+        """Analyze a single merchant using Brave search and Claude"""
+        self.logger.info("Starting analysis for merchant: %s (amount: $%.2f)", 
+                        merchant_code, transaction_amount)
+        
+        cached = self._get_cached(merchant_code, transaction_amount)
+        if cached is not None:
+            return cached
+        
+        indexed = self._indexed_company(merchant_code)
+        if indexed is not None:
+            return self._analyze_competitors(merchant_code, transaction_amount, indexed)
+        
+        # Clean up merchant code before searching
+        cleaned_merchant = self._clean_merchant_code(merchant_code)
+        self.logger.debug("Cleaned merchant code: %s", cleaned_merchant)
+        
+        # Get search results with cleaned merchant name
+        search_results = self.search_brave(cleaned_merchant)
+        self.logger.debug("Got %d search results from Brave", len(search_results))
+        merchant_context = self._build_merchant_context(search_results)
+
+        if self.analysis_mode == 'combined':
+            self.logger.debug("Sending combined analysis prompt to Claude")
+            analysis = self._structured_message(
+                'combined', **self._combined_request(merchant_code, merchant_context, transaction_amount)
+            )
+            return self._build_merchant_info(merchant_code, transaction_amount,
+                                             company_fields(analysis), analysis)
+
+        if self.analysis_mode == 'speculative':
+            # Ask for competitors using the cleaned code while identification runs
+            self.logger.debug("Sending speculative competitor prompt to Claude")
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                competitor_future = executor.submit(
+                    self._structured_message, 'competitor',
+                    **self._competitor_request(cleaned_merchant or merchant_code,
+                                               merchant_code, transaction_amount)
+                )
+                company = self._structured_message(
+                    'identify', **self._merchant_request(merchant_code, merchant_context)
+                )
+                competitors = competitor_future.result()
+            return self._build_merchant_info(merchant_code, transaction_amount,
+                                             company_fields(company), competitors)
+
+        # First prompt to get merchant info
+        self.logger.debug("Sending merchant info prompt to Claude")
+        company = self._structured_message(
+            'identify', **self._merchant_request(merchant_code, merchant_context)
+        )
+
+        # Second prompt for competitor analysis, using the company info from the first
+        return self._analyze_competitors(merchant_code, transaction_amount, company_fields(company))
 
     def _parse_product_matches(self, analysis: str) -> List[ProductMatch]:
         matches = []
@@ -326,97 +495,86 @@ Remember to ensure that all competitor products you suggest are less expensive t
             self.logger.error("Error parsing price '%s': %s", price_text, str(e))
             return 0.0
 
-    def _parse_competitor_analysis(self, analysis: str) -> Tuple[str, List[CompetitorProduct]]:
-        """Parse the competitor analysis response from Claude"""
-        try:
-            self.logger.debug("Raw analysis response: %s", analysis)
-            
-            # Find the JSON content
-            try:
-                answer_content = analysis.split('<answer>\n')[1].split('</answer>')[0].strip()
-                self.logger.debug("Extracted content between answer tags: %s", answer_content)
-            except IndexError:
-                self.logger.warning("Could not find <answer> tags, trying to parse entire response")
-                answer_content = analysis.strip()
-            
-            # Parse the JSON
-            try:
-                data = json.loads(answer_content)
-                self.logger.debug("Successfully parsed JSON: %s", json.dumps(data, indent=2))
-            except json.JSONDecodeError as e:
-                self.logger.error("JSON parsing failed: %s\nContent was: %s", str(e), answer_content)
-                return "", []
-            
-            # Extract original transaction description
-            orig_trans = data.get('original_transaction', '')
-            self.logger.debug("Extracted original transaction: %s", orig_trans)
-            
-            # Parse competitor products
-            competitor_products = []
-            for i, product in enumerate(data.get('competitor_products', [])):
-                self.logger.debug("Processing competitor product %d: %s", i + 1, json.dumps(product, indent=2))
-                try:
-                    competitor_products.append(CompetitorProduct(
-                        name=product.get('product_name', ''),
-                        company=product.get('company', ''),
-                        price=str(product.get('price', '')),
-                        description=product.get('description', ''),
-                        website=product.get('website', ''),
-                        comparison=product.get('comparison', '')
-                    ))
-                    self.logger.debug("Successfully processed competitor product %d", i + 1)
-                except Exception as e:
-                    self.logger.error("Error processing competitor product %d: %s\nProduct data: %s", 
-                                    i + 1, str(e), json.dumps(product, indent=2))
-            
-            self.logger.info("Successfully parsed %d competitor products", len(competitor_products))
-            return orig_trans, competitor_products
-            
-        except Exception as e:
-            self.logger.error("Error parsing competitor analysis: %s\nFull analysis: %s", 
-                            str(e), analysis, exc_info=True)
-            return "", []
+    def _competitor_products(self, competitors: Dict) -> Tuple[str, List[CompetitorProduct]]:
+        """The original transaction description and competitor products from a competitor tool input"""
+        competitor_products = [
+            CompetitorProduct(
+                name=product['product_name'],
+                company=product['company'],
+                price=product['price'],
+                description=product.get('description', ''),
+                website=product.get('website', ''),
+                comparison=product.get('comparison', '')
+            )
+            for product in competitors['competitor_products']
+        ]
+        return competitors['original_transaction'], competitor_products
 
     def analyze_transactions(self, csv_path: str, num_transactions: int = 5) -> List[MerchantInfo]:
-        """Analyze merchants from a CSV file"""
-        self.logger.info("Starting analysis of %d transactions from %s", num_transactions, csv_path)
+        """Analyze the highest-spend merchants from a CSV file.
+
+        The CSV is aggregated per merchant in chunks (see csv_aggregator), and
+        the top num_transactions merchants by total spend (all of them when 0)
+        are analyzed concurrently at their median amount.
+        """
+        # Imported here because the async analyzer and processor build on this module,
+        # and so pandas is only loaded by the CSV path
+        import pandas as pd
+        from async_merchant_analyzer import AsyncMerchantAnalyzer
+        from csv_aggregator import aggregate_merchants_csv
+        from transaction_processor import TransactionProcessor
+        
+        self.logger.info("Starting analysis of %d merchants from %s", num_transactions, csv_path)
         
         try:
-            df = pd.read_csv(csv_path)
-            self.logger.debug("Loaded CSV file with %d rows", len(df))
-            
-            merchant_data = df.groupby('merchant')['amount'].first().reset_index()
-            merchant_data = merchant_data.head(num_transactions)
-            self.logger.debug("Processing %d unique merchants", len(merchant_data))
-            
-            results = []
-            for _, row in merchant_data.iterrows():
-                try:
-                    self.logger.info("Processing transaction: %s - $%.2f", row['merchant'], row['amount'])
-                    merchant_info = self.analyze_merchant(row['merchant'], row['amount'])
-                    results.append(merchant_info)
-                except (requests.RequestException, anthropic.APIError) as e:
-                    self.logger.error("Error analyzing merchant %s: %s", row['merchant'], str(e))
-            
-            self.logger.info("Analysis complete. Processed %d merchants successfully", len(results))
-            return results
-            
-        except (pd.errors.EmptyDataError, FileNotFoundError, pd.errors.ParserError) as e:
+            merchant_data = aggregate_merchants_csv(csv_path)
+        except (pd.errors.EmptyDataError, FileNotFoundError, pd.errors.ParserError, ValueError) as e:
             self.logger.error("Error processing CSV file: %s", str(e))
             raise
+        
+        if num_transactions:
+            merchant_data = merchant_data.head(num_transactions)
+        self.logger.debug("Processing %d unique merchants", len(merchant_data))
+        for row in merchant_data.itertuples(index=False):
+            self.logger.info("Queueing merchant: %s (%d transactions, $%.2f total, median $%.2f)",
+                             row.merchant, row.count, row.total, row.median_amount)
+        
+        analyzer = AsyncMerchantAnalyzer(verbose=self.logger.isEnabledFor(logging.DEBUG), cache=self.cache,
+                                         analysis_mode=self.analysis_mode, merchant_index=self.merchant_index,
+                                         search_client=self.search_client)
+        processor = TransactionProcessor(analysis_mode=self.analysis_mode, analyzer=analyzer)
+        merchants = list(zip(merchant_data['merchant'].tolist(), merchant_data['median_amount'].tolist()))
+        outcomes = asyncio.run(processor.analyze_unique_merchants(merchants))
+        
+        results = []
+        for (merchant, _), outcome in zip(merchants, outcomes):
+            if isinstance(outcome, Exception):
+                self.logger.error("Error analyzing merchant %s: %s", merchant, str(outcome))
+            else:
+                results.append(outcome)
+        
+        self.logger.info("Analysis complete. Processed %d merchants successfully", len(results))
+        if self.cache is not None:
+            self.logger.info("Merchant cache stats: %s", self.cache.stats())
+        if self.merchant_index is not None:
+            self.logger.info("Merchant index stats: %s", self.merchant_index.stats())
+        self.logger.info("Brave search stats: %s", self.search_client.stats())
+        return results
 
 def main():
     import argparse
     parser = argparse.ArgumentParser(description='Analyze merchant information from credit card transactions')
     parser.add_argument('csv_path', help='Path to the CSV file containing transactions')
     parser.add_argument('--num-transactions', type=int, default=5, 
-                        help='Number of transactions to analyze')
+                        help='Number of highest-spend merchants to analyze (0 for all)')
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Enable verbose logging')
+    parser.add_argument('--analysis-mode', choices=ANALYSIS_MODES, default=None,
+                        help='How identification and competitor prompts are issued')
     
     args = parser.parse_args()
     
-    analyzer = MerchantAnalyzer(verbose=args.verbose)
+    analyzer = MerchantAnalyzer(verbose=args.verbose, analysis_mode=args.analysis_mode)
     results = analyzer.analyze_transactions(args.csv_path, args.num_transactions)
     
     # Print results
@@ -437,6 +595,8 @@ def main():
             print(f"  Description: {product.description}")
             print(f"  Website: {product.website}")
             print(f"  Comparison: {product.comparison}")
+    
+    print("\n" + get_metrics().format_summary())
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,213 @@
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import replace
+from pathlib import Path
+from typing import Optional, Tuple
+
+from models import MerchantInfo, merchant_info_to_dict, merchant_info_from_dict
+
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10000
+
+def amount_bucket(amount: float) -> str:
+    """Bucket an amount on a half-octave log scale so similar charges share an entry"""
+    if amount is None or amount <= 0:
+        return 'na'
+    return str(math.floor(math.log2(amount) * 2))
+
+def make_cache_key(normalized_merchant: str, amount: float) -> str:
+    """Build the cache key from a cleaned merchant code and transaction amount"""
+    merchant = ' '.join(normalized_merchant.lower().split())
+    return f"{merchant}|{amount_bucket(amount)}"
+
+class MerchantCache(ABC):
+    """Base class for merchant analysis caches with TTL expiry and LRU eviction"""
+
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def get(self, key: str, merchant_code: str, transaction_amount: float) -> Optional[MerchantInfo]:
+        """Return the cached analysis re-labelled for this transaction, or None"""
+        info = self._get(key)
+        if info is None:
+            self.misses += 1
+            self.logger.debug("Cache miss for %s", key)
+            return None
+        self.hits += 1
+        self.logger.debug("Cache hit for %s", key)
+        return replace(info, merchant_code=merchant_code, transaction_amount=transaction_amount)
+
+    def set(self, key: str, info: MerchantInfo) -> None:
+        self._set(key, info)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self),
+        }
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[MerchantInfo]:
+        ...
+
+    @abstractmethod
+    def _set(self, key: str, info: MerchantInfo) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+class InMemoryMerchantCache(MerchantCache):
+    """Process-local cache, mainly for tests and short-lived runs"""
+
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES):
+        super().__init__(ttl_seconds, max_entries)
+        self._entries: "OrderedDict[str, Tuple[float, MerchantInfo]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[MerchantInfo]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, info = entry
+            if self._expired(stored_at):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return info
+
+    def _set(self, key: str, info: MerchantInfo) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class SQLiteMerchantCache(MerchantCache):
+    """On-disk cache that survives across runs and processes"""
+
+    def __init__(self, path: Path, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        super().__init__(ttl_seconds, max_entries)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS merchant_cache (
+                   key TEXT PRIMARY KEY,
+                   value TEXT NOT NULL,
+                   stored_at REAL NOT NULL,
+                   accessed_at REAL NOT NULL
+               )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_merchant_cache_accessed ON merchant_cache (accessed_at)"
+        )
+
+    def _get(self, key: str) -> Optional[MerchantInfo]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, stored_at FROM merchant_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, stored_at = row
+            if self._expired(stored_at):
+                self._conn.execute("DELETE FROM merchant_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute(
+                "UPDATE merchant_cache SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+        try:
+            return merchant_info_from_dict(json.loads(value))
+        except (ValueError, TypeError) as e:
+            self.logger.warning("Discarding unreadable cache entry %s: %s", key, str(e))
+            with self._lock:
+                self._conn.execute("DELETE FROM merchant_cache WHERE key = ?", (key,))
+            return None
+
+    def _set(self, key: str, info: MerchantInfo) -> None:
+        value = json.dumps(merchant_info_to_dict(info))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO merchant_cache (key, value, stored_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        if self.ttl_seconds is not None:
+            self._conn.execute(
+                "DELETE FROM merchant_cache WHERE stored_at < ?", (time.time() - self.ttl_seconds,)
+            )
+        count = self._conn.execute("SELECT COUNT(*) FROM merchant_cache").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM merchant_cache WHERE key IN ("
+                "SELECT key FROM merchant_cache ORDER BY accessed_at ASC LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM merchant_cache")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM merchant_cache").fetchone()[0]
+
+def create_merchant_cache() -> Optional[MerchantCache]:
+    """Build the merchant cache configured by the environment.
+
+    MERCHANT_CACHE_BACKEND is one of 'sqlite' (default), 'memory' or 'none'.
+    """
+    backend = os.getenv('MERCHANT_CACHE_BACKEND', 'sqlite').lower()
+    ttl_seconds = float(os.getenv('MERCHANT_CACHE_TTL_SECONDS', DEFAULT_TTL_SECONDS))
+    max_entries = int(os.getenv('MERCHANT_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return InMemoryMerchantCache(ttl_seconds, max_entries)
+
+    default_path = Path(__file__).parent.parent.parent / 'cache' / 'merchant_cache.sqlite3'
+    path = Path(os.getenv('MERCHANT_CACHE_PATH', str(default_path)))
+    return SQLiteMerchantCache(path, ttl_seconds, max_entries)
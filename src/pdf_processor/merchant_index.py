@@ -0,0 +1,279 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from models import MerchantInfo
+
+# Payment processor and aggregator prefixes in front of the real merchant name,
+# e.g. "SQ *JOES COFFEE", "TST* PIZZERIA", "PAYPAL *SPOTIFY", "DD *DOORDASH THAI"
+PROCESSOR_PREFIX = re.compile(
+    r'^(?:(?:SQ|SQU|TST|PAYPAL|PP|DD|SP|PY|IC|GOOGLE|BT|CKE|EB|FS|LS|WPY)\s*\*\s*'
+    r'|(?:SQ|SQU|TST|PAYPAL|DEB|ACH|POS|AUTOPAY|RECURRING)\s+)+',
+    re.IGNORECASE
+)
+# After the first remaining asterisk comes an order or reference code, except
+# that a leading all-letter word names the service ("UBER *EATS", "LYFT *RIDE")
+REFERENCE_SUFFIX = re.compile(r'\s*\*\s*(?:([A-Za-z]+)\b(?![\w-]))?.*$')
+PHONE_NUMBER = re.compile(r'\b\d{3}[-.]\d{3}[-.]\d{4}\b')
+STORE_NUMBER = re.compile(r'#\s*\S*|\b\d{3,}\b')
+DOMAIN_SUFFIX = re.compile(r'\.(?:com|net|org|co)\b', re.IGNORECASE)
+NON_ALPHANUMERIC = re.compile(r'[^\w\s]|_')
+WHITESPACE = re.compile(r'\s+')
+
+DEFAULT_MIN_SCORE = 0.9
+# Prefix matches whose leftover tokens aren't noise score below any sensible min_score
+UNCERTAIN_PREFIX_SCORE = 0.6
+
+US_STATES = frozenset((
+    'al', 'ak', 'az', 'ar', 'ca', 'co', 'ct', 'de', 'dc', 'fl', 'ga', 'hi', 'id', 'il', 'in', 'ia', 'ks', 'ky',
+    'la', 'me', 'md', 'ma', 'mi', 'mn', 'ms', 'mo', 'mt', 'ne', 'nv', 'nh', 'nj', 'nm', 'ny', 'nc', 'nd', 'oh',
+    'ok', 'or', 'pa', 'ri', 'sc', 'sd', 'tn', 'tx', 'ut', 'vt', 'va', 'wa', 'wv', 'wi', 'wy', 'pr',
+))
+# Words that say nothing about which business it is
+NOISE_WORDS = frozenset((
+    'us', 'usa', 'store', 'stores', 'inc', 'llc', 'ltd', 'corp', 'co', 'online', 'www', 'purchase',
+    'pending', 'recurring', 'payment', 'bill', 'subscription', 'membership',
+))
+# First words of two-word city names ("san jose ca", "new york ny")
+CITY_PREFIXES = frozenset(('san', 'santa', 'los', 'las', 'new', 'st', 'saint', 'fort', 'ft', 'el', 'la', 'port'))
+
+def is_location_noise(tokens: List[str]) -> bool:
+    """Whether the tokens after a known merchant name are only location or store noise.
+
+    Accepts noise words, single letters left over from store codes, state
+    codes, and a city of one word (or two, starting with a word like "san" or
+    "new") right before a state code. Anything else, such as "web services"
+    after "amazon", may name a different business.
+    """
+    remaining = [token for token in tokens if token not in NOISE_WORDS and len(token) > 1]
+    if remaining and remaining[-1] in US_STATES:
+        remaining.pop()
+        if len(remaining) == 2 and remaining[0] in CITY_PREFIXES:
+            remaining = []
+        elif len(remaining) == 1:
+            remaining = []
+    return all(token in US_STATES for token in remaining)
+
+def normalize_descriptor(descriptor: str) -> str:
+    """Strip processor prefixes, reference codes and store numbers from a statement descriptor"""
+    cleaned = PROCESSOR_PREFIX.sub('', descriptor.strip())
+    cleaned = REFERENCE_SUFFIX.sub(lambda match: f" {match.group(1) or ''}", cleaned)
+    cleaned = PHONE_NUMBER.sub(' ', cleaned)
+    cleaned = STORE_NUMBER.sub(' ', cleaned)
+    cleaned = DOMAIN_SUFFIX.sub('', cleaned)
+    cleaned = NON_ALPHANUMERIC.sub('', cleaned)
+    return WHITESPACE.sub(' ', cleaned).strip()
+
+def index_key(descriptor: str) -> str:
+    return normalize_descriptor(descriptor).casefold()
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+@dataclass
+class MerchantRecord:
+    """Canonical identification for one merchant, shared by all of its descriptors"""
+    merchant: str
+    website: str = 'Unknown'
+    phone: str = 'Unknown'
+    product_description: str = 'Unknown'
+    aliases: List[str] = field(default_factory=list)
+
+    def as_company(self) -> Dict[str, str]:
+        """Render in the same shape as the identification tool's input"""
+        return {'company_name': self.merchant, 'website': self.website,
+                'phone': self.phone, 'products': self.product_description}
+
+@dataclass
+class IndexMatch:
+    record: MerchantRecord
+    alias: str
+    score: float
+
+# Well-known merchants whose descriptors rarely resemble their names
+SEED_MERCHANTS = (
+    MerchantRecord('Amazon', 'https://www.amazon.com', 'Unknown', 'Online retail marketplace',
+                   ['amazon', 'amzn', 'amzn mktp', 'amzn mktp us', 'amazon mktplace', 'amazon mktpl']),
+    MerchantRecord('Amazon Prime', 'https://www.amazon.com/prime', 'Unknown', 'Shipping and streaming membership',
+                   ['amazon prime', 'prime video', 'amzn prime']),
+    MerchantRecord('Apple', 'https://www.apple.com', 'Unknown', 'Apps, subscriptions and electronics',
+                   ['apple', 'apple.com/bill', 'itunes']),
+    MerchantRecord('Netflix', 'https://www.netflix.com', 'Unknown', 'Video streaming subscription',
+                   ['netflix']),
+    MerchantRecord('Spotify', 'https://www.spotify.com', 'Unknown', 'Music streaming subscription',
+                   ['spotify', 'spotify usa']),
+    MerchantRecord('Hulu', 'https://www.hulu.com', 'Unknown', 'Video streaming subscription', ['hulu']),
+    MerchantRecord('Disney+', 'https://www.disneyplus.com', 'Unknown', 'Video streaming subscription',
+                   ['disney plus', 'disneyplus']),
+    MerchantRecord('YouTube', 'https://www.youtube.com', 'Unknown', 'Video streaming and YouTube Premium',
+                   ['youtube', 'youtube premium', 'youtubepremium']),
+    MerchantRecord('Uber', 'https://www.uber.com', 'Unknown', 'Ride hailing', ['uber', 'uber trip']),
+    MerchantRecord('Uber Eats', 'https://www.ubereats.com', 'Unknown', 'Food delivery', ['uber eats', 'ubereats']),
+    MerchantRecord('Lyft', 'https://www.lyft.com', 'Unknown', 'Ride hailing', ['lyft', 'lyft ride']),
+    MerchantRecord('DoorDash', 'https://www.doordash.com', 'Unknown', 'Food delivery',
+                   ['doordash', 'doordash dashpass']),
+    MerchantRecord('Starbucks', 'https://www.starbucks.com', 'Unknown', 'Coffee shop', ['starbucks']),
+    MerchantRecord('Walmart', 'https://www.walmart.com', 'Unknown', 'Retail store',
+                   ['walmart', 'wal-mart', 'wm supercenter']),
+    MerchantRecord('Target', 'https://www.target.com', 'Unknown', 'Retail store', ['target']),
+    MerchantRecord('Costco', 'https://www.costco.com', 'Unknown', 'Warehouse club',
+                   ['costco', 'costco whse', 'costco gas']),
+)
+
+class MerchantIndex:
+    """Maps raw statement descriptors to canonical merchants without any API calls.
+
+    Lookups try the exact normalized descriptor, then its longest known token
+    prefix ("starbucks seattle wa" -> "starbucks"), then a character-trigram
+    match. A prefix only counts when what follows it is location or store
+    noise; "target optical" is not Target. The index grows as analyses
+    finish; learned entries are appended to a JSON-lines file so the next run
+    starts with them.
+    """
+
+    def __init__(self, path: Optional[Path] = None, min_score: float = DEFAULT_MIN_SCORE,
+                 seed: bool = True):
+        self.path = Path(path) if path else None
+        self.min_score = min_score
+        self.hits = 0
+        self.misses = 0
+        self._records: List[MerchantRecord] = []
+        self._aliases: Dict[str, int] = {}
+        self._trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self._gram_counts: Dict[str, int] = {}
+        self._by_name: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('MerchantIndex')
+
+        if seed:
+            for record in SEED_MERCHANTS:
+                self._add(MerchantRecord(**asdict(record)))
+        if self.path is not None:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        self._add(MerchantRecord(**json.loads(line)))
+                    except (ValueError, TypeError):
+                        continue
+        except FileNotFoundError:
+            return
+        self.logger.debug("Loaded %d merchants (%d aliases) from %s",
+                          len(self._records), len(self._aliases), self.path)
+
+    def _add(self, record: MerchantRecord) -> List[str]:
+        """Merge a record into the index, returning the aliases that were new"""
+        name_key = record.merchant.casefold()
+        position = self._by_name.get(name_key)
+        if position is None:
+            position = len(self._records)
+            self._records.append(MerchantRecord(record.merchant, record.website, record.phone,
+                                                record.product_description))
+            self._by_name[name_key] = position
+        existing = self._records[position]
+        for attribute in ('website', 'phone', 'product_description'):
+            if getattr(existing, attribute) in ('', 'Unknown') and getattr(record, attribute):
+                setattr(existing, attribute, getattr(record, attribute))
+
+        added = []
+        for alias in record.aliases:
+            alias = index_key(alias)
+            if len(alias) < 3 or alias in self._aliases:
+                continue
+            self._aliases[alias] = position
+            existing.aliases.append(alias)
+            grams = trigrams(alias)
+            self._gram_counts[alias] = len(grams)
+            for gram in grams:
+                self._trigrams[gram].add(alias)
+            added.append(alias)
+        return added
+
+    def lookup(self, descriptor: str) -> Optional[IndexMatch]:
+        """Return the best match scoring at least min_score, or None"""
+        key = index_key(descriptor)
+        match = self._match(key) if key else None
+        if match is None or match.score < self.min_score:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return match
+
+    def _match(self, key: str) -> Optional[IndexMatch]:
+        position = self._aliases.get(key)
+        if position is not None:
+            return IndexMatch(self._records[position], key, 1.0)
+
+        # Longest known token prefix: drops trailing city, state and store noise
+        best = None
+        tokens = key.split(' ')
+        for count in range(len(tokens) - 1, 0, -1):
+            prefix = ' '.join(tokens[:count])
+            position = self._aliases.get(prefix)
+            if position is not None and len(prefix) >= 4:
+                coverage = len(prefix) / len(key)
+                if is_location_noise(tokens[count:]):
+                    return IndexMatch(self._records[position], prefix, 0.9 + 0.1 * coverage)
+                best = IndexMatch(self._records[position], prefix, UNCERTAIN_PREFIX_SCORE * coverage)
+                break
+
+        # Trigram (Dice) similarity for misspelt or truncated descriptors
+        grams = trigrams(key)
+        counts = Counter(alias for gram in grams for alias in self._trigrams.get(gram, ()))
+        for alias, common in counts.items():
+            score = 2 * common / (len(grams) + self._gram_counts[alias])
+            if best is None or score > best.score:
+                best = IndexMatch(self._records[self._aliases[alias]], alias, score)
+        return best
+
+    def learn(self, merchant_code: str, info: MerchantInfo) -> None:
+        """Record a finished identification so later descriptors for it skip the APIs.
+
+        Only for identifications from search and Claude; learning the index's
+        own matches would turn one wrong match into a permanent alias.
+        """
+        if not info.merchant or info.merchant == 'Unknown':
+            return
+        record = MerchantRecord(info.merchant, info.website, info.phone, info.product_description,
+                                [merchant_code, info.merchant])
+        with self._lock:
+            added = self._add(record)
+            if added and self.path is not None:
+                record.aliases = added
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(asdict(record)) + '\n')
+        if added:
+            self.logger.debug("Indexed %s as %s", ', '.join(added), info.merchant)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "merchants": len(self._records),
+            "aliases": len(self._aliases),
+        }
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+def create_merchant_index() -> Optional[MerchantIndex]:
+    """Build the merchant index configured by the environment, or None when MERCHANT_INDEX=false"""
+    if os.getenv('MERCHANT_INDEX', 'true').lower() in ('0', 'false', 'no', 'off'):
+        return None
+    default_path = Path(__file__).parent.parent.parent / 'cache' / 'merchant_index.jsonl'
+    path = Path(os.getenv('MERCHANT_INDEX_PATH', str(default_path)))
+    min_score = float(os.getenv('MERCHANT_INDEX_MIN_SCORE', str(DEFAULT_MIN_SCORE)))
+    return MerchantIndex(path, min_score)
@@ -0,0 +1,269 @@
+"""Offline merchant analysis through the Anthropic Message Batches API.
+
+For bulk reprocessing where nobody waits on the answer. Every identification
+and competitor prompt of a run goes out in Message Batches, billed at half
+the interactive price and outside the interactive rate limits, instead of one
+Messages request at a time. Prompts that depend on each other go in rounds:
+all identifications first, then the competitor prompts built from their
+answers (combined mode needs one round; speculative mode sends both in the
+first).
+
+Progress is kept in a JSON state file that is replaced atomically after
+every step: the merchants, their answers so far, the requests of the current
+round and the ids of the batches holding them. A run that is restarted with
+the same state file picks up where it stopped, polling batches that were
+already submitted rather than paying for them again.
+"""
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+
+from async_merchant_analyzer import AsyncMerchantAnalyzer
+from merchant_analyzer import company_fields
+from metrics import BATCH_PRICE_FACTOR, get_metrics
+from models import MerchantInfo, merchant_info_from_dict, merchant_info_to_dict
+from structured_output import STRUCTURED_OUTPUT_RETRIES, StructuredOutputError, parse_tool_response, retry_params
+
+if TYPE_CHECKING:
+    import anthropic
+
+STATE_VERSION = 1
+# The API accepts up to 100,000 requests (and 256 MB) per batch
+MAX_BATCH_REQUESTS = 100000
+
+class MessageBatchError(Exception):
+    """Raised for a merchant whose batch requests failed or never produced a usable answer"""
+    pass
+
+class MessageBatchAnalysis:
+    """Analyzes merchants through Message Batches, resumable from a state file"""
+
+    def __init__(self, analyzer: AsyncMerchantAnalyzer, state_path: Path,
+                 poll_seconds: Optional[float] = None, max_poll_seconds: Optional[float] = None,
+                 max_requests: Optional[int] = None, max_retries: Optional[int] = None):
+        self.analyzer = analyzer
+        self.state_path = Path(state_path)
+        # Polling starts at poll_seconds and doubles up to max_poll_seconds while batches run
+        self.poll_seconds = poll_seconds or float(os.getenv('MESSAGE_BATCH_POLL_SECONDS', '30'))
+        self.max_poll_seconds = max_poll_seconds or float(os.getenv('MESSAGE_BATCH_MAX_POLL_SECONDS', '600'))
+        self.max_requests = min(max_requests or int(os.getenv('MESSAGE_BATCH_MAX_REQUESTS', '10000')),
+                                MAX_BATCH_REQUESTS)
+        # Resubmissions of a request that errored or expired inside a batch
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('MESSAGE_BATCH_RETRIES', '2'))
+        self.logger = logging.getLogger('MessageBatchAnalysis')
+        self._client: Optional['anthropic.AsyncAnthropic'] = None
+
+    @property
+    def client(self) -> 'anthropic.AsyncAnthropic':
+        """Batch calls are few and not rate limited like Messages calls, so the SDK's own retries apply"""
+        if self._client is None:
+            import anthropic
+            self._client = anthropic.AsyncAnthropic(api_key=self.analyzer.claude_api_key)
+        return self._client
+
+    async def run(self, merchants: List[Tuple[str, float]]) -> List[Union[MerchantInfo, BaseException]]:
+        """Analyze (merchant_code, transaction_amount) pairs, returning a MerchantInfo or exception for each.
+
+        The state file is removed once every merchant has an answer.
+        """
+        state = self._load()
+        positions = await self._add_merchants(state, merchants)
+        while True:
+            if not state['batches']:
+                self._queue_ready(state)
+            if not state['requests']:
+                break
+            await self._submit(state)
+            await self._wait(state)
+            await self._collect(state)
+
+        results = [self._result(state['merchants'][position]) for position in positions]
+        self.state_path.unlink(missing_ok=True)
+        return results
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {"version": STATE_VERSION, "merchants": [], "requests": {}, "batches": []}
+        if state.get('version') != STATE_VERSION:
+            raise MessageBatchError(f"{self.state_path} was written by an incompatible version")
+        self.logger.info("Resuming from %s: %d merchants, %d requests in %d batches", self.state_path,
+                         len(state['merchants']), len(state['requests']), len(state['batches']))
+        return state
+
+    def _save(self, state: Dict[str, Any]) -> None:
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_suffix(self.state_path.suffix + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    async def _add_merchants(self, state: Dict[str, Any], merchants: List[Tuple[str, float]]) -> List[int]:
+        """Positions of the merchants in the state, adding (and searching for) the ones it doesn't have"""
+        known = {(entry['merchant_code'], entry['transaction_amount']): position
+                 for position, entry in enumerate(state['merchants'])}
+        positions = []
+        new = []
+        for merchant_code, amount in merchants:
+            position = known.get((merchant_code, amount))
+            if position is None:
+                position = known[(merchant_code, amount)] = len(state['merchants'])
+                state['merchants'].append({"merchant_code": merchant_code, "transaction_amount": amount,
+                                           "info": None, "company": None, "competitors": None, "error": None})
+                new.append(position)
+            positions.append(position)
+        if not new:
+            return positions
+
+        analyzer = self.analyzer
+        searches: Dict[int, str] = {}
+        for position in new:
+            entry = state['merchants'][position]
+            cached = analyzer._get_cached(entry['merchant_code'], entry['transaction_amount'])
+            if cached is not None:
+                entry['info'] = merchant_info_to_dict(cached)
+                continue
+            entry['company'] = analyzer._indexed_company(entry['merchant_code'])
+            if entry['company'] is None:
+                searches[position] = entry['merchant_code']
+        self.logger.info("Searching for %d of %d new merchants before queueing their prompts",
+                         len(searches), len(new))
+
+        contexts = await asyncio.gather(*(analyzer._search_context(code) for code in searches.values()),
+                                        return_exceptions=True)
+        for position, context in zip(searches, contexts):
+            entry = state['merchants'][position]
+            if isinstance(context, BaseException):
+                entry['error'] = f"Search failed: {str(context)}"
+                continue
+            code, amount = entry['merchant_code'], entry['transaction_amount']
+            if analyzer.analysis_mode == 'combined':
+                self._queue(state, position, 'combined', analyzer._combined_request(code, context, amount))
+                continue
+            self._queue(state, position, 'identify', analyzer._merchant_request(code, context))
+            if analyzer.analysis_mode == 'speculative':
+                cleaned = analyzer._clean_merchant_code(code)
+                self._queue(state, position, 'competitor',
+                            analyzer._competitor_request(cleaned or code, code, amount))
+        self._save(state)
+        return positions
+
+    @staticmethod
+    def _queue(state: Dict[str, Any], position: int, kind: str, params: Dict[str, Any], attempt: int = 0) -> None:
+        """Add a request to the next batch submission"""
+        # custom_id must match ^[a-zA-Z0-9_-]{1,64}$
+        state['requests'][f"{kind}-{position}-{attempt}"] = {
+            "merchant": position, "kind": kind, "attempt": attempt, "params": params
+        }
+
+    def _queue_ready(self, state: Dict[str, Any]) -> None:
+        """Queue the competitor prompt of every identified merchant still waiting for one"""
+        queued = {request['merchant'] for request in state['requests'].values() if request['kind'] == 'competitor'}
+        for position, entry in enumerate(state['merchants']):
+            if (entry['company'] is not None and entry['competitors'] is None and entry['error'] is None
+                    and position not in queued):
+                self._queue(state, position, 'competitor', self.analyzer._competitor_request(
+                    entry['company']['company_name'], entry['merchant_code'], entry['transaction_amount']
+                ))
+        self._save(state)
+
+    async def _submit(self, state: Dict[str, Any]) -> None:
+        """Submit the round's requests that aren't in a batch yet"""
+        unsent = [custom_id for custom_id, request in state['requests'].items() if 'batch' not in request]
+        for start in range(0, len(unsent), self.max_requests):
+            chunk = unsent[start:start + self.max_requests]
+            batch = await self.client.messages.batches.create(requests=[
+                {"custom_id": custom_id, "params": state['requests'][custom_id]['params']} for custom_id in chunk
+            ])
+            get_metrics().inc('message_batches_total', help='Message Batches submitted')
+            self.logger.info("Submitted batch %s with %d requests", batch.id, len(chunk))
+            # Saved straight away, so a restart polls this batch instead of submitting it again
+            state['batches'].append(batch.id)
+            for custom_id in chunk:
+                state['requests'][custom_id]['batch'] = batch.id
+            self._save(state)
+
+    async def _wait(self, state: Dict[str, Any]) -> None:
+        """Poll until every batch of the round has ended, backing off between polls"""
+        delay = self.poll_seconds
+        pending = list(state['batches'])
+        while True:
+            batches = await asyncio.gather(*(self.client.messages.batches.retrieve(batch_id)
+                                             for batch_id in pending))
+            pending = [batch.id for batch in batches if batch.processing_status != 'ended']
+            if not pending:
+                return
+            counts = [batch.request_counts for batch in batches if batch.processing_status != 'ended']
+            self.logger.info("%d batches still running (%d requests processing); next check in %.0fs",
+                             len(pending), sum(count.processing for count in counts), delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_seconds)
+
+    async def _collect(self, state: Dict[str, Any]) -> None:
+        """Apply the results of the round's batches, queueing retries for the next round"""
+        submitted = state['requests']
+        state['requests'] = {}
+        metrics = get_metrics()
+        for batch_id in state['batches']:
+            async for response in await self.client.messages.batches.results(batch_id):
+                request = submitted.pop(response.custom_id, None)
+                if request is None:
+                    continue
+                result = response.result
+                if result.type == 'succeeded':
+                    metrics.record_message(f"batch_{request['kind']}", request['params']['model'],
+                                           result.message.usage, price_factor=BATCH_PRICE_FACTOR)
+                    self._apply(state, request, result.message)
+                else:
+                    error = getattr(getattr(result, 'error', None), 'error', None)
+                    self._retry(state, request, request['params'], self.max_retries,
+                                f"{result.type}{': ' + error.message if error is not None else ''}")
+        for request in submitted.values():
+            self._retry(state, request, request['params'], self.max_retries, "no result in the batch")
+        state['batches'] = []
+        self._save(state)
+
+    def _apply(self, state: Dict[str, Any], request: Dict[str, Any], message: Any) -> None:
+        entry = state['merchants'][request['merchant']]
+        try:
+            payload = parse_tool_response(message, request['params']['tools'][0])
+        except StructuredOutputError as e:
+            get_metrics().inc('structured_output_errors_total', help='Replies that did not fit their tool schema',
+                              operation=f"batch_{request['kind']}")
+            self._retry(state, request, retry_params(request['params'], message, e),
+                        STRUCTURED_OUTPUT_RETRIES, str(e))
+            return
+        if request['kind'] in ('identify', 'combined'):
+            entry['company'] = company_fields(payload)
+        if request['kind'] in ('competitor', 'combined'):
+            entry['competitors'] = payload
+
+    def _retry(self, state: Dict[str, Any], request: Dict[str, Any], params: Dict[str, Any],
+               max_retries: int, reason: str) -> None:
+        """Queue a request again for the next round, or fail its merchant once the retries are used up"""
+        entry = state['merchants'][request['merchant']]
+        if request['attempt'] >= max_retries:
+            self.logger.warning("Giving up on the %s prompt for %s: %s", request['kind'],
+                                entry['merchant_code'], reason)
+            entry['error'] = f"{request['kind']} request failed after {request['attempt'] + 1} attempts: {reason}"
+            return
+        self.logger.info("Retrying the %s prompt for %s: %s", request['kind'], entry['merchant_code'], reason)
+        self._queue(state, request['merchant'], request['kind'], params, request['attempt'] + 1)
+
+    def _result(self, entry: Dict[str, Any]) -> Union[MerchantInfo, BaseException]:
+        if entry['info'] is not None:
+            return merchant_info_from_dict(entry['info'])
+        if entry['error'] is not None:
+            return MessageBatchError(entry['error'])
+        try:
+            return self.analyzer._build_merchant_info(entry['merchant_code'], entry['transaction_amount'],
+                                                      entry['company'], entry['competitors'])
+        except Exception as e:
+            return e
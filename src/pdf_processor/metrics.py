@@ -0,0 +1,298 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+COST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# USD per million input and output tokens, matched on the longest model name prefix.
+# ANTHROPIC_INPUT_PRICE / ANTHROPIC_OUTPUT_PRICE override these for every model.
+MODEL_PRICES = {
+    'claude-3-haiku': (0.25, 1.25),
+    'claude-3-5-haiku': (0.80, 4.00),
+    'claude-3-5-sonnet': (3.00, 15.00),
+    'claude-3-7-sonnet': (3.00, 15.00),
+    'claude-sonnet-4': (3.00, 15.00),
+    'claude-3-opus': (15.00, 75.00),
+    'claude-opus-4': (15.00, 75.00),
+}
+# Prompt caching: writes cost 25% more than plain input, reads 10% of it
+CACHE_WRITE_PRICE_FACTOR = 1.25
+CACHE_READ_PRICE_FACTOR = 0.1
+# Message Batches requests are billed at half the interactive price
+BATCH_PRICE_FACTOR = 0.5
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Histogram:
+    """Fixed-bucket histogram; quantiles are estimated by interpolating within a bucket"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+@dataclass
+class StatementUsage:
+    """Spend attributed to the statement being processed"""
+    cost_usd: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    claude_requests: int = 0
+    search_requests: int = 0
+
+_current_statement: contextvars.ContextVar[Optional[StatementUsage]] = \
+    contextvars.ContextVar('current_statement', default=None)
+
+class Metrics:
+    """Process-wide latency, token, cost, cache and retry metrics.
+
+    Recording is a dictionary update under a lock, cheap enough to leave on
+    around every API call. Spend is also added to the statement active in the
+    current context (see statement()), so asyncio tasks and to_thread calls
+    started while processing a statement are charged to it.
+    """
+
+    def __init__(self, namespace: str = 'cc_analyzer'):
+        self.namespace = namespace
+        self.brave_cost_per_request = float(os.getenv('BRAVE_COST_PER_REQUEST', '0'))
+        self._input_price = os.getenv('ANTHROPIC_INPUT_PRICE')
+        self._output_price = os.getenv('ANTHROPIC_OUTPUT_PRICE')
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._help: Dict[str, str] = {}
+        self.logger = logging.getLogger('Metrics')
+
+    def inc(self, name: str, amount: float = 1, help: str = '', **labels: Any) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+            if help:
+                self._help.setdefault(name, help)
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                help: str = '', **labels: Any) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+            if help:
+                self._help.setdefault(name, help)
+
+    @contextmanager
+    def timer(self, stage: str, **labels: Any) -> Iterator[None]:
+        """Time a pipeline stage (stage_seconds) and count the ones that raise (stage_errors_total)"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc('stage_errors_total', help='Stage calls that raised', stage=stage, **labels)
+            raise
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started,
+                         help='Latency of each pipeline stage', stage=stage, **labels)
+
+    def model_prices(self, model: str) -> Tuple[float, float]:
+        """USD per million input and output tokens for a model"""
+        if self._input_price is not None and self._output_price is not None:
+            return float(self._input_price), float(self._output_price)
+        matches = [prefix for prefix in MODEL_PRICES if (model or '').startswith(prefix)]
+        if not matches:
+            return 0.0, 0.0
+        return MODEL_PRICES[max(matches, key=len)]
+
+    def record_message(self, operation: str, model: str, usage: Any, price_factor: float = 1.0) -> float:
+        """Record a Messages response's token usage and return its cost in USD"""
+        input_tokens = getattr(usage, 'input_tokens', 0) or 0
+        output_tokens = getattr(usage, 'output_tokens', 0) or 0
+        cache_read = getattr(usage, 'cache_read_input_tokens', 0) or 0
+        cache_write = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+        input_price, output_price = self.model_prices(model)
+        cost = (input_tokens * input_price + output_tokens * output_price +
+                cache_read * input_price * CACHE_READ_PRICE_FACTOR +
+                cache_write * input_price * CACHE_WRITE_PRICE_FACTOR) * price_factor / 1_000_000
+
+        token_help = 'Anthropic tokens by kind'
+        self.inc('claude_requests_total', help='Anthropic Messages requests', operation=operation, model=model)
+        self.inc('tokens_total', input_tokens, token_help, operation=operation, model=model, kind='input')
+        self.inc('tokens_total', output_tokens, token_help, operation=operation, model=model, kind='output')
+        if cache_read:
+            self.inc('tokens_total', cache_read, token_help, operation=operation, model=model, kind='cache_read')
+        if cache_write:
+            self.inc('tokens_total', cache_write, token_help, operation=operation, model=model, kind='cache_write')
+        self.inc('cost_usd_total', cost, help='Estimated API spend in USD', provider='anthropic', operation=operation)
+
+        statement = _current_statement.get()
+        if statement is not None:
+            # Extraction chunks of one statement record from several threads
+            with self._lock:
+                statement.cost_usd += cost
+                statement.input_tokens += input_tokens + cache_read + cache_write
+                statement.output_tokens += output_tokens
+                statement.claude_requests += 1
+        return cost
+
+    def record_search(self, status_code: int) -> None:
+        self.inc('search_requests_total', help='Brave search requests', status=status_code)
+        self.inc('cost_usd_total', self.brave_cost_per_request, help='Estimated API spend in USD',
+                 provider='brave', operation='search')
+        statement = _current_statement.get()
+        if statement is not None:
+            with self._lock:
+                statement.cost_usd += self.brave_cost_per_request
+                statement.search_requests += 1
+
+    def record_search_coalesced(self) -> None:
+        self.inc('search_coalesced_total', help='Brave searches answered by an identical query already in flight')
+
+    def record_cache(self, cache: str, hit: bool) -> None:
+        self.inc('cache_lookups_total', help='Cache and index lookups by result',
+                 cache=cache, result='hit' if hit else 'miss')
+
+    def record_retry(self, provider: str) -> None:
+        self.inc('retries_total', help='Throttled requests retried after backoff', provider=provider)
+
+    @contextmanager
+    def statement(self, name: str = '') -> Iterator[StatementUsage]:
+        """Attribute spend recorded inside the block to one statement"""
+        usage = StatementUsage()
+        token = _current_statement.set(usage)
+        started = time.perf_counter()
+        try:
+            yield usage
+        finally:
+            _current_statement.reset(token)
+            elapsed = time.perf_counter() - started
+            self.observe('statement_seconds', elapsed, help='End-to-end time per statement')
+            self.observe('statement_cost_usd', usage.cost_usd, COST_BUCKETS, help='Estimated spend per statement')
+            self.logger.info("Statement %s: %.1fs, $%.4f (%d Claude requests, %d input / %d output tokens, "
+                             "%d searches)", name, elapsed, usage.cost_usd, usage.claude_requests,
+                             usage.input_tokens, usage.output_tokens, usage.search_requests)
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                full_name = f"{self.namespace}_{name}"
+                if name in self._help:
+                    lines.append(f"# HELP {full_name} {self._help[name]}")
+                lines.append(f"# TYPE {full_name} counter")
+                for key, value in series.items():
+                    lines.append(f"{full_name}{_format_labels(key)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                full_name = f"{self.namespace}_{name}"
+                if name in self._help:
+                    lines.append(f"# HELP {full_name} {self._help[name]}")
+                lines.append(f"# TYPE {full_name} histogram")
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                        lines.append(f"{full_name}_bucket{_format_labels(key, ('le', le))} {cumulative}")
+                    lines.append(f"{full_name}_sum{_format_labels(key)} {histogram.sum:g}")
+                    lines.append(f"{full_name}_count{_format_labels(key)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def total(self, name: str, **match: str) -> float:
+        """Sum of a counter over every series whose labels include the given ones"""
+        with self._lock:
+            return sum(value for key, value in self._counters.get(name, {}).items()
+                       if all((label, wanted) in key for label, wanted in match.items()))
+
+    def format_summary(self) -> str:
+        """Human-readable summary for the end of a CLI run"""
+        with self._lock:
+            stages = sorted(self._histograms.get('stage_seconds', {}).items())
+            cache_keys = list(self._counters.get('cache_lookups_total', {}))
+            statement_costs = self._histograms.get('statement_cost_usd', {}).get((), None)
+
+        lines = ["Stage latency (s):"]
+        for key, histogram in stages:
+            labels = dict(key)
+            label = ' '.join([labels.pop('stage', '')] + list(labels.values()))
+            lines.append(f"  {label:<32} n={histogram.count:<6} total {histogram.sum:8.2f}  "
+                         f"mean {histogram.sum / histogram.count:6.3f}  p50 {histogram.quantile(0.5):6.3f}  "
+                         f"p99 {histogram.quantile(0.99):6.3f}")
+
+        total = self.total
+        cache_read = total('tokens_total', kind='cache_read')
+        cache_write = total('tokens_total', kind='cache_write')
+        prompt_tokens = total('tokens_total', kind='input') + cache_read + cache_write
+        lines.append(f"Tokens: {total('tokens_total', kind='input'):.0f} input, "
+                     f"{total('tokens_total', kind='output'):.0f} output, "
+                     f"{cache_read:.0f} cache read, {cache_write:.0f} cache write "
+                     f"({cache_read / max(prompt_tokens, 1):.0%} of prompt tokens read from the prompt cache)")
+        lines.append(f"Requests: {total('claude_requests_total'):.0f} Claude, "
+                     f"{total('search_requests_total'):.0f} Brave "
+                     f"({total('search_coalesced_total'):.0f} coalesced), {total('retries_total'):.0f} retries")
+        caches = sorted({dict(key)['cache'] for key in cache_keys})
+        for cache in caches:
+            hits = total('cache_lookups_total', cache=cache, result='hit')
+            misses = total('cache_lookups_total', cache=cache, result='miss')
+            lines.append(f"Cache {cache}: {hits:.0f} hits / {hits + misses:.0f} lookups "
+                         f"({hits / max(hits + misses, 1):.0%})")
+        lines.append(f"Estimated cost: ${total('cost_usd_total'):.4f}")
+        if statement_costs is not None and statement_costs.count:
+            lines.append(f"  per statement: mean ${statement_costs.sum / statement_costs.count:.4f} "
+                         f"over {statement_costs.count} statements")
+        return '\n'.join(lines)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+_metrics: Optional[Metrics] = None
+_metrics_lock = threading.Lock()
+
+def get_metrics() -> Metrics:
+    """Return the process-wide metrics registry"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
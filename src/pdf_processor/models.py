@@ -0,0 +1,60 @@
+from dataclasses import dataclass, asdict
+from typing import List, Dict, Any, Optional, Tuple
+
+# Results are held per transaction, for every statement in a batch, so the
+# records declare __slots__ rather than carrying a __dict__ each
+
+@dataclass
+class ProductMatch:
+    __slots__ = ('name', 'price', 'description', 'confidence_score', 'match_reason')
+    name: str
+    price: float
+    description: str
+    confidence_score: float
+    match_reason: str
+
+@dataclass
+class CompetitorProduct:
+    __slots__ = ('name', 'company', 'price', 'description', 'website', 'comparison')
+    name: str
+    company: str
+    price: str
+    description: str
+    website: str
+    comparison: str
+
+@dataclass
+class MerchantInfo:
+    __slots__ = ('merchant_code', 'merchant', 'website', 'phone', 'product_description',
+                 'transaction_amount', 'competitor_products', 'original_transaction_description')
+    merchant_code: str      # Original transaction description
+    merchant: str          # Clean company name from website
+    website: str
+    phone: str
+    product_description: str
+    transaction_amount: float
+    competitor_products: List[CompetitorProduct]
+    original_transaction_description: str
+
+@dataclass
+class StoredStatement:
+    """A statement saved in the transaction store"""
+    __slots__ = ('statement_id', 'account', 'source', 'extraction_key', 'months', 'num_transactions',
+                 'num_merchants', 'stored_at')
+    statement_id: str       # SHA-256 of the statement file
+    account: str
+    source: str
+    extraction_key: Optional[str]  # PDF hash, model and prompt version the rows were extracted with
+    months: Tuple[str, ...]  # Month partitions holding its transactions
+    num_transactions: int
+    num_merchants: int
+    stored_at: float
+
+def merchant_info_to_dict(info: MerchantInfo) -> Dict[str, Any]:
+    """Convert a MerchantInfo (including competitor products) to plain JSON-safe data"""
+    return asdict(info)
+
+def merchant_info_from_dict(data: Dict[str, Any]) -> MerchantInfo:
+    """Rebuild a MerchantInfo from the output of merchant_info_to_dict"""
+    products = [CompetitorProduct(**product) for product in data.get('competitor_products', [])]
+    return MerchantInfo(**{**data, 'competitor_products': products})
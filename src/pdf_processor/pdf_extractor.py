@@ -1,12 +1,41 @@
-import anthropic
-import pandas as pd
-from typing import List, Dict
-import base64
-import os
+from typing import List, Dict, Iterator, Optional, TYPE_CHECKING
+import contextvars
 import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from local_extractor import LocalExtractionResult, LocalExtractor, extract_pages
+from json_stream import IncrementalJSONArrayParser
+from extraction_cache import make_extraction_key
+from metrics import get_metrics
+from pdf_ingest import PDFInput, PDFIngestError, PDFSource
+from rate_limiter import estimate_message_tokens, get_rate_limiter
+from structured_output import (STRUCTURED_OUTPUT_RETRIES, TRANSACTIONS_TOOL, StructuredOutputError, conform,
+                               parse_tool_response, retry_params, tool_params)
+
+if TYPE_CHECKING:
+    import anthropic
+    import pandas as pd
 
 logging.basicConfig(level=logging.DEBUG, 
                    format='%(asctime)s - %(levelname)s - %(message)s')
+# The SDKs' debug logs include every request body (whole prompts and base64 PDFs)
+for _name in ('anthropic', 'httpx', 'httpcore'):
+    logging.getLogger(_name).setLevel(logging.INFO)
+
+# Bump whenever the extraction prompt or local parsers change what gets extracted,
+# so cached extractions from the old version are not reused
+EXTRACTION_PROMPT_VERSION = '2'
+
+# Rough input tokens per PDF page, for pacing the shared token budget
+TOKENS_PER_PDF_PAGE = 1500
+
+EXTRACTION_SYSTEM_PROMPT = """You are a helpful assistant that extracts credit card transactions from statements.
+Extract all transactions and record them with the record_transactions tool, in statement order.
+Use YYYY-MM-DD dates, the merchant description as printed, and negative amounts for payments and credits."""
+
+TRANSACTION_SCHEMA = TRANSACTIONS_TOOL['input_schema']['properties']['transactions']['items']
 
 class PDFExtractionError(Exception):
     """Custom exception for PDF extraction errors"""
@@ -14,71 +43,358 @@ class PDFExtractionError(Exception):
 
 class PDFExtractor:
     def __init__(self, config):
-        self.client = anthropic.Anthropic(
-            api_key=config.anthropic_api_key,
-            # Enable PDF support beta
-            default_headers={"anthropic-beta": "pdfs-2024-09-25"}
-        )
         self.config = config
+        self.local_extractor = LocalExtractor()
+        self._client: Optional['anthropic.Anthropic'] = None
+        self._client_lock = threading.Lock()
+        # Shared with the merchant analyzers, so extraction threads count against the same limits
+        self.rate_limiter = get_rate_limiter()
+
+    @property
+    def client(self) -> 'anthropic.Anthropic':
+        """Anthropic client, created on first use so statements parsed locally never import the SDK"""
+        with self._client_lock:
+            if self._client is None:
+                import anthropic
+                self._client = anthropic.Anthropic(
+                    api_key=self.config.anthropic_api_key,
+                    # Retries are owned by the rate limit scheduler, not the SDK
+                    max_retries=0,
+                    # Enable PDF support beta
+                    default_headers={"anthropic-beta": "pdfs-2024-09-25"}
+                )
+            return self._client
         
-    def extract_transactions_from_pdf(self, file_path: str) -> List[Dict]:
-        """Extract transactions directly from PDF using Claude"""
+    def open_pdf(self, pdf: PDFInput) -> PDFSource:
+        """Open a PDF (a path relative to the upload directory, bytes or a file object) within the limits"""
         try:
-            # Construct full path
-            full_path = self.config.upload_dir / file_path
-            logging.debug(f"Processing PDF: {full_path}")
-            
-            if not full_path.exists():
-                raise PDFExtractionError(f"PDF file not found: {file_path}")
+            return PDFSource.open(pdf, base_dir=self.config.upload_dir,
+                                  max_bytes=self.config.max_pdf_bytes,
+                                  max_pages=self.config.max_pdf_pages)
+        except PDFIngestError as e:
+            raise PDFExtractionError(str(e)) from e
+
+    def content_hash(self, pdf: PDFInput) -> str:
+        """SHA-256 of the statement, which also identifies it in the transaction store"""
+        with self.open_pdf(pdf) as source:
+            return source.sha256()
+
+    def extraction_key(self, pdf_hash: str) -> str:
+        return make_extraction_key(pdf_hash, self.config.anthropic_model, EXTRACTION_PROMPT_VERSION)
+
+    def cache_key(self, pdf: PDFInput) -> str:
+        """Content-addressed key for a statement's extracted transactions"""
+        return self.extraction_key(self.content_hash(pdf))
+
+    def extract_transactions_from_pdf(self, pdf: PDFInput,
+                                      local: Optional[LocalExtractionResult] = None) -> List[Dict]:
+        """Extract transactions from a PDF, using the text layer when possible and Claude otherwise.
+
+        local is the statement's local parse when the caller already has one,
+        so the text layer isn't parsed a second time.
+        """
+        try:
+            logging.debug("Processing PDF: %s", pdf if isinstance(pdf, str) else type(pdf).__name__)
+            with get_metrics().timer('extract_pdf'), self.open_pdf(pdf) as source:
+                return self._extract(source, local)
+        except PDFExtractionError:
+            raise
+        except Exception as e:
+            raise PDFExtractionError(f"Failed to extract transactions from PDF: {str(e)}")
+
+    def _extract(self, source: PDFSource, local: Optional[LocalExtractionResult] = None) -> List[Dict]:
+        if not self.config.local_extraction:
+            return self._extract_with_claude(source)
+        
+        if local is None:
+            local = self.local_extractor.extract(source.stream())
+        if local.confident:
+            logging.info("Extracted %d transactions locally with the %s parser",
+                         len(local.transactions), local.parser)
+            return local.transactions
+        
+        transactions = self._extract_mixed(source, local)
+        if transactions is not None:
+            return transactions
+        
+        logging.info("Local extraction not usable (%s), falling back to Claude", local.reason)
+        return self._extract_with_claude(source)
+
+    def _extract_mixed(self, source: PDFSource, local: LocalExtractionResult) -> Optional[List[Dict]]:
+        """Local rows with Claude's rows spliced in for the pages without text, if the result adds up.
+
+        The merged rows are checked against the statement totals like a local
+        extraction; None means they don't match and the whole statement needs Claude.
+        """
+        if not (local.pages_without_text and local.transactions):
+            return None
+        # Only the pages without a text layer need the LLM
+        logging.info("Sending %d page(s) without text to Claude", len(local.pages_without_text))
+        llm_rows = {}
+        for run in self._page_runs(local.pages_without_text):
+            rows = self._extract_with_claude(self._pages(source, run))
+            llm_rows[run[0]] = rows
+            for index in run[1:]:
+                llm_rows[index] = []
+        transactions = []
+        for index, rows in enumerate(local.page_transactions):
+            transactions.extend(llm_rows.get(index, rows))
+        
+        confident, reason = self.local_extractor.check_totals(transactions, local.totals)
+        if not confident:
+            logging.info("Rows merged from Claude don't add up (%s)", reason)
+            return None
+        return transactions
+
+    @staticmethod
+    def _pages(source: PDFSource, pages: List[int]) -> PDFSource:
+        """A new in-memory PDF holding only the given pages"""
+        return PDFSource.open(extract_pages(source.stream(), pages))
+
+    @staticmethod
+    def _page_runs(pages: List[int]) -> List[List[int]]:
+        """Split sorted page indexes into runs of consecutive pages"""
+        runs = []
+        for page in pages:
+            if runs and page == runs[-1][-1] + 1:
+                runs[-1].append(page)
+            else:
+                runs.append([page])
+        return runs
+
+    def _extract_with_claude(self, source: PDFSource) -> List[Dict]:
+        """Extract transactions with Claude, splitting long statements into page chunks"""
+        page_count = source.page_count
+        chunk_pages = self.config.pdf_chunk_pages
+        if page_count <= chunk_pages:
+            return self._extract_chunk(source, page_count)
+        
+        ranges = [list(range(start, min(start + chunk_pages, page_count)))
+                  for start in range(0, page_count, chunk_pages)]
+        logging.info("Extracting %d pages in %d chunks", page_count, len(ranges))
+        
+        def extract_range(pages: List[int]) -> List[Dict]:
+            return self._extract_chunk(self._pages(source, pages), len(pages))
+        
+        with ThreadPoolExecutor(max_workers=self.config.extraction_concurrency) as executor:
+            # Each chunk runs in the caller's context so its cost is charged to the statement
+            futures = [executor.submit(contextvars.copy_context().run, extract_range, pages) for pages in ranges]
+            chunks = [future.result() for future in futures]
+        # The chunks are disjoint page ranges, so identical rows on either side of
+        # a boundary are separate charges (two transit fares on the same day)
+        return [row for chunk in chunks for row in chunk]
+
+    def _extract_chunk(self, source: PDFSource, page_count: int) -> List[Dict]:
+        """Extract one chunk, halving it if the response runs out of tokens"""
+        params = self._extraction_params(source)
+        for attempt in range(STRUCTURED_OUTPUT_RETRIES + 1):
+            response = self._request_extraction(params, page_count)
+            if response.stop_reason == 'max_tokens':
+                break
+            try:
+                return parse_tool_response(response, TRANSACTIONS_TOOL)['transactions']
+            except StructuredOutputError as e:
+                get_metrics().inc('structured_output_errors_total', help='Replies that did not fit their tool schema',
+                                  operation='extraction')
+                if attempt >= STRUCTURED_OUTPUT_RETRIES:
+                    raise PDFExtractionError(f"Extraction reply still unusable after {attempt} retries: {str(e)}")
+                logging.warning("Re-asking for the extraction of %d pages: %s", page_count, str(e))
+                params = retry_params(params, response, e)
+        
+        if page_count > 1:
+            logging.info("Extraction of %d pages was truncated, splitting the chunk", page_count)
+            half = page_count // 2
+            first = self._extract_chunk(self._pages(source, list(range(half))), half)
+            second = self._extract_chunk(self._pages(source, list(range(half, page_count))),
+                                         page_count - half)
+            return first + second
+        
+        logging.warning("Extraction of a single page was truncated, keeping the complete rows")
+        return self._salvage_rows(response)
+
+    @staticmethod
+    def _salvage_rows(response) -> List[Dict]:
+        """The complete, valid rows from a response that was cut off mid-row"""
+        rows = []
+        for block in response.content:
+            if block.type == 'tool_use' and isinstance(block.input, dict):
+                rows.extend(block.input.get('transactions') or [])
+            elif block.type == 'text':
+                rows.extend(IncrementalJSONArrayParser().feed(block.text))
+        salvaged = []
+        for row in rows:
+            try:
+                salvaged.append(conform(row, TRANSACTION_SCHEMA))
+            except StructuredOutputError:
+                pass
+        return salvaged
+
+    def _estimated_tokens(self, params: Dict, page_count: int) -> int:
+        return estimate_message_tokens(params) + page_count * TOKENS_PER_PDF_PAGE
+
+    def _request_extraction(self, params: Dict, page_count: int):
+        """Send a PDF (or page chunk) to Claude for direct transaction extraction"""
+        estimated_tokens = self._estimated_tokens(params, page_count)
+        metrics = get_metrics()
+        with metrics.timer('claude_message', operation='extraction'):
+            raw = self.rate_limiter.call_sync(
+                'anthropic', lambda: self.client.messages.with_raw_response.create(**params),
+                tokens=estimated_tokens
+            )
+            response = raw.parse()
+        metrics.record_message('extraction', self.config.anthropic_model, response.usage)
+        self.rate_limiter.settle('anthropic', estimated_tokens, response.usage.input_tokens)
+        return response
+
+    def _extraction_params(self, source: PDFSource) -> Dict:
+        pdf_data = source.base64()
+        
+        return dict(
+            model=self.config.anthropic_model,
+            max_tokens=self.config.extraction_max_tokens,
+            temperature=0,
+            # Not marked for the prompt cache: the tool and system prompt ahead of the
+            # per-statement document are far below the minimum cacheable prefix
+            system=EXTRACTION_SYSTEM_PROMPT,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "Extract all transactions from this credit card statement."
+                        },
+                        {
+                            "type": "document",
+                            "source": {
+                                "type": "base64",
+                                "media_type": "application/pdf",
+                                "data": pdf_data
+                            }
+                        }
+                    ]
+                }
+            ],
+            **tool_params(TRANSACTIONS_TOOL)
+        )
+    
+    def stream_transactions_from_pdf(self, pdf: PDFInput) -> Iterator[Dict]:
+        """Yield transactions as soon as each one is extracted.
+
+        Statements the local parsers handle are yielded straight away, as are
+        statements whose scanned pages alone needed Claude. Otherwise each page
+        chunk is streamed from Claude in order, and every row is yielded as soon
+        as its JSON object is complete.
+        """
+        metrics = get_metrics()
+        started = time.perf_counter()
+        try:
+            with self.open_pdf(pdf) as source:
+                if self.config.local_extraction:
+                    local = self.local_extractor.extract(source.stream())
+                    if local.confident:
+                        logging.info("Extracted %d transactions locally with the %s parser",
+                                     len(local.transactions), local.parser)
+                        yield from local.transactions
+                        return
+                    # Checked against the totals before anything is yielded, as in _extract
+                    transactions = self._extract_mixed(source, local)
+                    if transactions is not None:
+                        yield from transactions
+                        return
                 
-            if os.path.getsize(full_path) == 0:
-                raise PDFExtractionError(f"File is empty: {file_path}")
-            
-            # Read PDF file and encode as base64
-            with open(full_path, 'rb') as file:
-                pdf_data = base64.b64encode(file.read()).decode('utf-8')
+                page_count = source.page_count
+                chunk_pages = self.config.pdf_chunk_pages
+                if page_count <= chunk_pages:
+                    yield from self._stream_chunk(source, page_count)
+                    return
                 
-            # Send to Claude for direct transaction extraction
-            system_prompt = """You are a helpful assistant that extracts credit card transactions from statements.
-            Extract all transactions and return them in this JSON format:
-            [{"date": "YYYY-MM-DD", "merchant": "Merchant Name", "amount": 123.45}, ...]
-            Only include the JSON array in your response, no other text."""
-            
-            response = self.client.messages.create(
-                model=self.config.anthropic_model,
-                max_tokens=4096,
-                temperature=0,
-                system=system_prompt,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Extract all transactions from this credit card statement and return them in JSON format."
-                            },
-                            {
-                                "type": "document",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "application/pdf",
-                                    "data": pdf_data
-                                }
-                            }
-                        ]
-                    }
-                ]
-            )
-            
-            # Parse the response into Python objects
-            import json
-            transactions = json.loads(response.content[0].text)
-            return transactions
+                # Chunks are disjoint page ranges, streamed one after another
+                for start in range(0, page_count, chunk_pages):
+                    pages = list(range(start, min(start + chunk_pages, page_count)))
+                    yield from self._stream_chunk(self._pages(source, pages), len(pages))
             
+        except PDFExtractionError:
+            metrics.inc('stage_errors_total', stage='extract_pdf')
+            raise
         except Exception as e:
+            metrics.inc('stage_errors_total', stage='extract_pdf')
             raise PDFExtractionError(f"Failed to extract transactions from PDF: {str(e)}")
-    
-    def create_dataframe(self, transactions: List[Dict]) -> pd.DataFrame:
+        finally:
+            # Includes time the consumer spent between rows, which is small for the analysis pipeline
+            metrics.observe('stage_seconds', time.perf_counter() - started, stage='extract_pdf')
+
+    def _stream_chunk(self, source: PDFSource, page_count: int) -> Iterator[Dict]:
+        """Stream one chunk from Claude, yielding rows as the model emits them"""
+        parser = IncrementalJSONArrayParser()
+        emitted: List[Dict] = []
+        metrics = get_metrics()
+        started = time.perf_counter()
+        params = self._extraction_params(source)
+        estimated_tokens = self._estimated_tokens(params, page_count)
+        # Entering the stream sends the request, so a throttled one is retried by the scheduler
+        with self.rate_limiter.call_sync('anthropic', lambda: self.client.messages.stream(**params).__enter__(),
+                                         tokens=estimated_tokens) as stream:
+            try:
+                for event in stream:
+                    if event.type != 'content_block_delta':
+                        continue
+                    # The tool input arrives as {"transactions": [...]}; the parser starts at the '['
+                    if event.delta.type == 'input_json_delta':
+                        text = event.delta.partial_json
+                    elif event.delta.type == 'text_delta':
+                        text = event.delta.text
+                    else:
+                        continue
+                    for row in parser.feed(text):
+                        row = conform(row, TRANSACTION_SCHEMA)
+                        emitted.append(row)
+                        yield row
+                stop_reason = stream.get_final_message().stop_reason
+            except (ValueError, StructuredOutputError) as e:
+                # json.JSONDecodeError is a ValueError; the rest of the chunk is re-asked below
+                metrics.inc('structured_output_errors_total', help='Replies that did not fit their tool schema',
+                            operation='extraction')
+                logging.warning("Streamed extraction row %d was unusable (%s), re-extracting",
+                                len(emitted) + 1, str(e))
+                stop_reason = 'invalid'
+                stream.close()
+            final_message = stream.current_message_snapshot
+        metrics.observe('stage_seconds', time.perf_counter() - started, stage='claude_message', operation='extraction')
+        metrics.record_message('extraction', self.config.anthropic_model, final_message.usage)
+        self.rate_limiter.settle('anthropic', estimated_tokens, final_message.usage.input_tokens)
+        
+        if stop_reason == 'max_tokens':
+            # Re-extract the chunk in smaller pieces and emit only the rows not yet sent
+            logging.info("Streamed extraction was truncated after %d rows, re-extracting", len(emitted))
+        if stop_reason in ('max_tokens', 'invalid'):
+            yield from self._unsent_rows(self._extract_chunk(source, page_count), emitted)
+
+    @staticmethod
+    def _unsent_rows(rows: List[Dict], emitted: List[Dict]) -> List[Dict]:
+        """The rows of a re-extraction that weren't already emitted from the first attempt.
+
+        The second extraction is a new request and may not line up with the
+        first by position, so each emitted row cancels one row with the same
+        date, merchant and amount; repeat charges beyond those emitted are kept.
+        """
+        def row_key(row: Dict):
+            return (row.get('date'), row.get('merchant'), row.get('amount'))
+        
+        sent = Counter(row_key(row) for row in emitted)
+        unsent = []
+        for row in rows:
+            key = row_key(row)
+            if sent[key]:
+                sent[key] -= 1
+            else:
+                unsent.append(row)
+        if sum(sent.values()):
+            logging.warning("%d streamed rows were missing from the re-extraction", sum(sent.values()))
+        return unsent
+
+    def create_dataframe(self, transactions: List[Dict]) -> 'pd.DataFrame':
         """Convert transactions to pandas DataFrame"""
+        import pandas as pd
         df = pd.DataFrame(transactions)
         return df
\ No newline at end of file
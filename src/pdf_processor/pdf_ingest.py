@@ -0,0 +1,196 @@
+import binascii
+import hashlib
+import io
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Optional, Union
+
+from PyPDF2 import PdfReader
+
+PDFInput = Union[str, Path, bytes, bytearray, memoryview, BinaryIO]
+
+# Multiple of 3 so each chunk base64-encodes without padding
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+
+class PDFIngestError(Exception):
+    """Raised when a PDF is missing, empty or over the configured limits"""
+    pass
+
+class MemoryViewStream(io.RawIOBase):
+    """Read-only, seekable stream over a memoryview, so PyPDF2 can read without a copy.
+
+    Every call to PDFSource.stream() gets its own position, so readers on
+    different threads don't interfere.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._view[self._position:self._position + len(buffer)]
+        size = len(data)
+        buffer[:size] = data
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = len(self._view) + offset
+        self._position = max(0, self._position)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+class PDFSource:
+    """A PDF opened for extraction from a path, bytes or a file-like object.
+
+    Files are memory-mapped rather than read, bytes are wrapped without
+    copying, and unseekable streams are spooled to a temporary file first.
+    Open with PDFSource.open(...) and use it as a context manager.
+    """
+
+    def __init__(self, view: memoryview, name: str, file: Optional[BinaryIO] = None,
+                 mapping: Optional[mmap.mmap] = None):
+        self.view = view
+        self.name = name
+        self._file = file
+        self._mapping = mapping
+        self._page_count: Optional[int] = None
+        self.logger = logging.getLogger('PDFSource')
+
+    @classmethod
+    def open(cls, pdf: PDFInput, base_dir: Optional[Path] = None,
+             max_bytes: Optional[int] = None, max_pages: Optional[int] = None) -> 'PDFSource':
+        """Open a PDF and check the size and page limits before any other work"""
+        if isinstance(pdf, PDFSource):
+            source = pdf
+        elif isinstance(pdf, (str, Path)):
+            source = cls._from_path(Path(base_dir) / pdf if base_dir else Path(pdf), str(pdf))
+        elif isinstance(pdf, (bytes, bytearray, memoryview)):
+            source = cls(memoryview(pdf).cast('B'), '<bytes>')
+        elif hasattr(pdf, 'read'):
+            source = cls._from_file(pdf)
+        else:
+            raise PDFIngestError(f"Unsupported PDF input: {type(pdf).__name__}")
+
+        try:
+            source.check_limits(max_bytes, max_pages)
+        except Exception:
+            source.close()
+            raise
+        return source
+
+    @classmethod
+    def _from_path(cls, path: Path, name: str) -> 'PDFSource':
+        if not path.exists():
+            raise PDFIngestError(f"PDF file not found: {name}")
+        if path.stat().st_size == 0:
+            raise PDFIngestError(f"File is empty: {name}")
+        file = open(path, 'rb')
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(memoryview(mapping), name, file, mapping)
+
+    @classmethod
+    def _from_file(cls, file: BinaryIO) -> 'PDFSource':
+        name = getattr(file, 'name', '<stream>')
+        if hasattr(file, 'getbuffer'):
+            # io.BytesIO: share its buffer instead of copying it
+            return cls(file.getbuffer(), str(name))
+        try:
+            fileno = file.fileno()
+            if os.fstat(fileno).st_size == 0:
+                raise PDFIngestError(f"File is empty: {name}")
+            mapping = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            return cls(memoryview(mapping), str(name), mapping=mapping)
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+        # Unseekable streams (sockets, S3 bodies) are spooled to disk in chunks
+        spool = tempfile.TemporaryFile()
+        shutil.copyfileobj(file, spool, BASE64_CHUNK_SIZE)
+        spool.flush()
+        if spool.tell() == 0:
+            spool.close()
+            raise PDFIngestError(f"File is empty: {name}")
+        mapping = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(memoryview(mapping), str(name), spool, mapping)
+
+    @property
+    def size(self) -> int:
+        return len(self.view)
+
+    @property
+    def page_count(self) -> int:
+        if self._page_count is None:
+            self._page_count = len(PdfReader(self.stream()).pages)
+        return self._page_count
+
+    def check_limits(self, max_bytes: Optional[int], max_pages: Optional[int]) -> None:
+        if self.size == 0:
+            raise PDFIngestError(f"File is empty: {self.name}")
+        if max_bytes is not None and self.size > max_bytes:
+            raise PDFIngestError(f"PDF {self.name} is {self.size} bytes, over the {max_bytes} byte limit")
+        if max_pages is not None and self.page_count > max_pages:
+            raise PDFIngestError(f"PDF {self.name} has {self.page_count} pages, over the {max_pages} page limit")
+
+    def stream(self) -> BinaryIO:
+        """Independent read-only stream over the PDF"""
+        return io.BufferedReader(MemoryViewStream(self.view))
+
+    def base64(self, chunk_size: int = BASE64_CHUNK_SIZE) -> str:
+        """Base64-encode in chunks into one preallocated buffer.
+
+        The source bytes are never duplicated. The encoded buffer and the str
+        decoded from it briefly coexist, so the peak is twice the encoded size.
+        """
+        output = bytearray(4 * ((self.size + 2) // 3))
+        position = 0
+        for start in range(0, self.size, chunk_size):
+            encoded = binascii.b2a_base64(self.view[start:start + chunk_size], newline=False)
+            output[position:position + len(encoded)] = encoded
+            position += len(encoded)
+        # The SDK only takes the document as a str, which can't be filled in place,
+        # and it serializes the whole JSON body again when sending it
+        return output.decode('ascii')
+
+    def sha256(self, chunk_size: int = 1024 * 1024) -> str:
+        digest = hashlib.sha256()
+        for start in range(0, self.size, chunk_size):
+            digest.update(self.view[start:start + chunk_size])
+        return digest.hexdigest()
+
+    def close(self) -> None:
+        try:
+            self.view.release()
+        except BufferError:
+            pass
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError:
+                # A stream still references the mapping; it is unmapped once collected
+                self.logger.debug("Deferring unmap of %s until its readers are released", self.name)
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self) -> 'PDFSource':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional
+
+from metrics import get_metrics
+
+# Status codes that mean "slow down" rather than "this request is bad"
+THROTTLE_STATUS_CODES = {429, 503, 529}
+
+class RateLimitExceeded(Exception):
+    """Raised when a call is still throttled after every retry"""
+    pass
+
+class TokenBucket:
+    """Token bucket with an adjustable rate.
+
+    Callers reserve tokens up front (the balance may go negative) and then sleep
+    until the reservation is covered, outside the lock, so the bucket can be
+    shared by event loops and threads alike.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, min_rate: Optional[float] = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 20
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """Take tokens and return how many seconds the caller must wait before using them"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            return max(0.0, self.blocked_until - now, -self.tokens / self.rate)
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def adjust(self, amount: float) -> None:
+        """Correct an earlier reservation once the real cost is known"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+    def set_limit(self, rate: float) -> None:
+        """Adopt a limit reported by the provider"""
+        with self._lock:
+            self.max_rate = rate
+            self.rate = min(self.rate, rate)
+            self.min_rate = min(self.min_rate, rate)
+            self.capacity = max(rate, 1.0)
+
+    def pause_until(self, until: float) -> None:
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, until)
+
+    def throttled(self) -> None:
+        # Multiplicative decrease on every throttle...
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self) -> None:
+        # ...and additive increase back towards the known limit on success
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class ProviderBudget:
+    """Request and optional token budgets for one API provider"""
+
+    def __init__(self, name: str, requests_per_second: float,
+                 tokens_per_second: Optional[float] = None):
+        self.name = name
+        self.requests = TokenBucket(requests_per_second)
+        self.tokens = TokenBucket(tokens_per_second) if tokens_per_second else None
+        self.throttle_count = 0
+        self.retry_count = 0
+
+    def reserve(self, tokens: float = 0) -> float:
+        """Take one request (and tokens) and return how many seconds to wait before sending"""
+        wait = self.requests.reserve(1)
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    async def acquire(self, tokens: float = 0) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens: float = 0) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def buckets(self):
+        return [bucket for bucket in (self.requests, self.tokens) if bucket is not None]
+
+def estimate_message_tokens(params: Mapping[str, Any]) -> int:
+    """Rough input size of a Messages request (~4 characters per token) used to pace the token budget.
+
+    Document blocks are left out; a caller sending PDFs adds its own estimate for them.
+    """
+    characters = len(str(params.get('system', ''))) + len(str(params.get('tools', '')))
+    for message in params['messages']:
+        content = message['content']
+        if isinstance(content, str):
+            characters += len(content)
+        else:
+            characters += sum(len(str(block)) for block in content if block.get('type') != 'document')
+    return characters // 4
+
+def _first_number(value: Optional[str]) -> Optional[float]:
+    """Parse '1, 15000' style header values, returning the first (shortest window) number"""
+    if not value:
+        return None
+    try:
+        return float(value.split(',')[0].strip())
+    except ValueError:
+        return None
+
+def _seconds_until(value: Optional[str]) -> Optional[float]:
+    """Parse a reset/retry header given either as seconds or as a date"""
+    if not value:
+        return None
+    seconds = _first_number(value)
+    if seconds is not None:
+        return seconds
+    try:
+        when = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+def _status_and_headers(obj: Any):
+    status = getattr(obj, 'status_code', None)
+    headers = getattr(obj, 'headers', None)
+    if headers is None:
+        headers = getattr(getattr(obj, 'response', None), 'headers', None)
+    return status, headers or {}
+
+class RateLimitScheduler:
+    """Central scheduler that paces, adapts and retries calls to each provider"""
+
+    def __init__(self, providers: Dict[str, ProviderBudget], max_retries: int = 6,
+                 base_delay: float = 1.0, max_delay: float = 60.0):
+        self.providers = providers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.logger = logging.getLogger('RateLimitScheduler')
+
+    def update_from_headers(self, provider: str, headers: Mapping[str, str]) -> None:
+        """Match our pacing to the limits and remaining budget the provider reports"""
+        budget = self.providers[provider]
+        headers = {key.lower(): value for key, value in headers.items()}
+        now = time.monotonic()
+
+        if provider == 'brave':
+            # Brave reports "per-second, per-month" pairs
+            limit = _first_number(headers.get('x-ratelimit-limit'))
+            if limit:
+                budget.requests.set_limit(limit)
+            remaining = _first_number(headers.get('x-ratelimit-remaining'))
+            reset = _seconds_until(headers.get('x-ratelimit-reset'))
+            if remaining is not None and remaining <= 0 and reset is not None:
+                budget.requests.pause_until(now + reset)
+        elif provider == 'anthropic':
+            # Anthropic reports per-minute limits and RFC 3339 reset times
+            limit = _first_number(headers.get('anthropic-ratelimit-requests-limit'))
+            if limit:
+                budget.requests.set_limit(limit / 60)
+            remaining = _first_number(headers.get('anthropic-ratelimit-requests-remaining'))
+            reset = _seconds_until(headers.get('anthropic-ratelimit-requests-reset'))
+            if remaining is not None and remaining <= 0 and reset is not None:
+                budget.requests.pause_until(now + reset)
+
+            if budget.tokens is not None:
+                token_limit = _first_number(headers.get('anthropic-ratelimit-input-tokens-limit') or
+                                            headers.get('anthropic-ratelimit-tokens-limit'))
+                if token_limit:
+                    budget.tokens.set_limit(token_limit / 60)
+                token_remaining = _first_number(headers.get('anthropic-ratelimit-input-tokens-remaining') or
+                                                headers.get('anthropic-ratelimit-tokens-remaining'))
+                token_reset = _seconds_until(headers.get('anthropic-ratelimit-input-tokens-reset') or
+                                             headers.get('anthropic-ratelimit-tokens-reset'))
+                if token_remaining is not None and token_remaining <= 0 and token_reset is not None:
+                    budget.tokens.pause_until(now + token_reset)
+
+    def _backoff(self, attempt: int, headers: Mapping[str, str]) -> float:
+        retry_after = _seconds_until({key.lower(): value for key, value in headers.items()}.get('retry-after'))
+        if retry_after is not None:
+            # Small jitter so every waiting task doesn't fire at the same instant
+            return retry_after + random.uniform(0, self.base_delay)
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def call(self, provider: str, send: Callable[[], Awaitable[Any]], tokens: float = 0) -> Any:
+        """Run send() under the provider budget, retrying throttled attempts with backoff.
+
+        send may return a response with status_code/headers (httpx, raw Anthropic
+        responses) or raise an error carrying them (anthropic.RateLimitError).
+        """
+        budget = self.providers[provider]
+        for attempt in range(self.max_retries + 1):
+            await budget.acquire(tokens)
+            try:
+                result = await send()
+            except Exception as e:
+                self._failed(provider, attempt, e)
+            else:
+                if self._finished(provider, attempt, result):
+                    return result
+
+    def call_sync(self, provider: str, send: Callable[[], Any], tokens: float = 0) -> Any:
+        """call() for blocking clients (requests, the sync Anthropic SDK), sleeping the calling thread"""
+        budget = self.providers[provider]
+        for attempt in range(self.max_retries + 1):
+            budget.acquire_sync(tokens)
+            try:
+                result = send()
+            except Exception as e:
+                self._failed(provider, attempt, e)
+            else:
+                if self._finished(provider, attempt, result):
+                    return result
+
+    def _failed(self, provider: str, attempt: int, error: Exception) -> None:
+        """Re-raise an error unless it is a throttle, which is recorded for a retry"""
+        status, headers = _status_and_headers(error)
+        if status not in THROTTLE_STATUS_CODES:
+            raise error
+        self._throttled(provider, attempt, status, headers)
+
+    def _finished(self, provider: str, attempt: int, result: Any) -> bool:
+        """Learn from a response's headers; False when it was throttled and should be retried"""
+        status, headers = _status_and_headers(result)
+        self.update_from_headers(provider, headers)
+        if status not in THROTTLE_STATUS_CODES:
+            for bucket in self.providers[provider].buckets():
+                bucket.succeeded()
+            return True
+        self._throttled(provider, attempt, status, headers)
+        return False
+
+    def _throttled(self, provider: str, attempt: int, status: Optional[int], headers: Mapping[str, str]) -> None:
+        """Slow the provider down and pause it for the backoff, or raise once the retries are used up"""
+        budget = self.providers[provider]
+        budget.throttle_count += 1
+        for bucket in budget.buckets():
+            bucket.throttled()
+        self.update_from_headers(provider, headers)
+        if attempt == self.max_retries:
+            raise RateLimitExceeded(f"{provider} still rate limited after {self.max_retries} retries")
+
+        delay = self._backoff(attempt, headers)
+        budget.retry_count += 1
+        get_metrics().record_retry(provider)
+        budget.requests.pause_until(time.monotonic() + delay)
+        self.logger.warning("%s throttled (status %s), retrying in %.1fs (attempt %d/%d)",
+                            provider, status, delay, attempt + 1, self.max_retries)
+
+    def settle(self, provider: str, estimated_tokens: float, actual_tokens: float) -> None:
+        """Charge the token budget the difference between an estimate and real usage"""
+        budget = self.providers[provider]
+        if budget.tokens is not None:
+            budget.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                "requests_per_second": budget.requests.rate,
+                "throttled": budget.throttle_count,
+                "retries": budget.retry_count,
+            }
+            for name, budget in self.providers.items()
+        }
+
+_scheduler: Optional[RateLimitScheduler] = None
+
+def get_rate_limiter() -> RateLimitScheduler:
+    """Return the process-wide scheduler, configured from the environment on first use"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RateLimitScheduler(
+            providers={
+                'brave': ProviderBudget(
+                    'brave',
+                    requests_per_second=float(os.getenv('BRAVE_REQUESTS_PER_SECOND', '10'))
+                ),
+                'anthropic': ProviderBudget(
+                    'anthropic',
+                    requests_per_second=float(os.getenv('ANTHROPIC_REQUESTS_PER_MINUTE', '50')) / 60,
+                    tokens_per_second=float(os.getenv('ANTHROPIC_TOKENS_PER_MINUTE', '40000')) / 60
+                ),
+            },
+            max_retries=int(os.getenv('RATE_LIMIT_MAX_RETRIES', '6'))
+        )
+    return _scheduler
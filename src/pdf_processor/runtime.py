@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Optional
+
+from config import Config
+from extraction_cache import ExtractionCache, create_extraction_cache
+from pdf_extractor import PDFExtractor
+from transaction_processor import TransactionProcessor
+from transaction_store import TransactionStore, create_transaction_store
+
+class Runtime:
+    """Config, clients and caches built once per process and reused by every invocation.
+
+    A warm Lambda container keeps this object between invocations, so only
+    the first one pays for reading settings, opening caches and building
+    clients. Work runs on one long-lived event loop so the shared HTTP
+    connection pools stay open between invocations too.
+    """
+
+    def __init__(self, config: Optional[Config] = None):
+        self.config = config or Config()
+        self.extractor = PDFExtractor(self.config)
+        self.processor = TransactionProcessor()
+        self.extraction_cache: Optional[ExtractionCache] = create_extraction_cache(self.config)
+        self.store: Optional[TransactionStore] = create_transaction_store(self.config)
+        self.loop = asyncio.new_event_loop()
+        self.logger = logging.getLogger('Runtime')
+
+    def run(self, coroutine: Awaitable[Any]) -> Any:
+        """Run a coroutine to completion on the runtime's event loop"""
+        return self.loop.run_until_complete(coroutine)
+
+_runtime: Optional[Runtime] = None
+_runtime_lock = threading.Lock()
+
+def get_runtime() -> Runtime:
+    """Return the process-wide runtime, building it on first use"""
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = Runtime()
+            _runtime.logger.debug("Built runtime for this container")
+        return _runtime
@@ -0,0 +1,136 @@
+"""The statement pipeline shared by the Lambda handler, the API's job workers and the Celery tasks.
+
+A statement is identified by its content. Its extraction is looked up in the
+extraction cache, then the job journal, then the transaction store, and only
+extracted from the PDF when none of them has it. The journal is keyed on the
+extraction key, so a job that restarts after a crash or timeout resumes from
+the work it had already finished.
+"""
+import asyncio
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from job_journal import JobJournal, create_job_journal
+from models import MerchantInfo
+from runtime import Runtime
+
+def format_merchant_analysis(merchant_results: List[MerchantInfo]) -> List[Dict[str, Any]]:
+    """Shape merchant results for API and batch output"""
+    return [
+        {
+            "merchant_code": result.merchant_code,
+            "merchant_name": result.merchant,
+            "website": result.website,
+            "phone": result.phone,
+            "product_description": result.product_description,
+            "transaction_amount": result.transaction_amount,
+            "original_transaction_description": result.original_transaction_description,
+            "competitor_products": [asdict(product) for product in result.competitor_products]
+        }
+        for result in merchant_results
+    ]
+
+def statement_result(statement_id: Optional[str], transactions: List[Dict[str, Any]],
+                     merchant_results: List[MerchantInfo], notify_email: Optional[str]) -> Dict[str, Any]:
+    """The response every entry point returns for a processed statement"""
+    return {
+        "success": True,
+        "statement_id": statement_id,
+        "num_transactions": len(transactions),
+        "email": notify_email,
+        "transactions": transactions,
+        "merchant_analysis": format_merchant_analysis(merchant_results)
+    }
+
+@dataclass
+class Statement:
+    statement_id: str
+    extraction_key: str
+    journal: Optional[JobJournal]
+    # None until the statement has been extracted
+    transactions: Optional[List[Dict[str, Any]]]
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+
+    def finish(self) -> None:
+        """Delete the journal once the statement's results are stored"""
+        if self.journal is not None:
+            self.journal.discard()
+            self.journal = None
+
+def open_statement(file_path: str, runtime: Runtime) -> Statement:
+    """Hash a statement, open its journal and find any earlier extraction of it"""
+    extractor = runtime.extractor
+    statement_id = extractor.content_hash(file_path)
+    extraction_key = extractor.extraction_key(statement_id)
+    journal = create_job_journal(extraction_key)
+    try:
+        # Resubmitted statements reuse the earlier extraction without any API call
+        transactions = runtime.extraction_cache.get(extraction_key) if runtime.extraction_cache else None
+        if transactions is None and journal is not None:
+            transactions = journal.extraction(extraction_key)
+        # The store keeps statements the extraction cache has since evicted
+        if transactions is None and runtime.store is not None:
+            transactions = runtime.store.statement_transactions(statement_id, extraction_key)
+    except BaseException:
+        if journal is not None:
+            journal.close()
+        raise
+    return Statement(statement_id, extraction_key, journal, transactions)
+
+def save_extraction(statement: Statement, transactions: List[Dict[str, Any]], runtime: Runtime) -> None:
+    """Journal and cache a finished extraction"""
+    statement.transactions = transactions
+    if statement.journal is not None:
+        statement.journal.record_extraction(statement.extraction_key, transactions)
+    if runtime.extraction_cache:
+        runtime.extraction_cache.set(statement.extraction_key, transactions)
+
+def discard_journal(extraction_key: str) -> None:
+    """Delete a statement's journal from a process that didn't open it"""
+    journal = create_job_journal(extraction_key)
+    if journal is not None:
+        journal.discard()
+
+def _save_after(rows: Iterator[Dict[str, Any]], transactions: List[Dict[str, Any]], statement: Statement,
+                runtime: Runtime) -> Iterator[Dict[str, Any]]:
+    """Pass rows through, then save the finished extraction before merchant analysis completes.
+
+    The processor advances this generator with asyncio.to_thread, so the
+    journal and cache writes run on a worker thread, off the event loop.
+    """
+    yield from rows
+    save_extraction(statement, transactions, runtime)
+
+async def analyze_statement(file_path: str, runtime: Runtime, account: Optional[str] = None,
+                            on_result: Optional[Callable[[MerchantInfo], None]] = None
+                            ) -> Tuple[str, List[Dict[str, Any]], List[MerchantInfo]]:
+    """Extract a statement, analyze its merchants and store it.
+
+    Returns the statement id, its transactions and one merchant result per
+    analyzed transaction. on_result(info) is called as each merchant's
+    analysis becomes available.
+    """
+    statement = await asyncio.to_thread(open_statement, file_path, runtime)
+    try:
+        processor = runtime.processor
+        if statement.transactions is not None:
+            transactions = statement.transactions
+            merchant_results = await processor.process_transactions(transactions, statement.journal, on_result)
+        else:
+            # Stream transactions out of the PDF, analyzing merchants as rows arrive
+            transactions = []
+            rows = _save_after(runtime.extractor.stream_transactions_from_pdf(file_path), transactions,
+                               statement, runtime)
+            merchant_results = await processor.process_transaction_stream(rows, transactions, statement.journal,
+                                                                         on_result)
+
+        if runtime.store is not None:
+            await asyncio.to_thread(runtime.store.record_statement, account, statement.statement_id,
+                                    str(file_path), transactions, merchant_results, statement.extraction_key)
+        await asyncio.to_thread(statement.finish)
+    finally:
+        statement.close()
+    return statement.statement_id, transactions, merchant_results
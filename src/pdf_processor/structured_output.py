@@ -0,0 +1,248 @@
+"""Tool schemas that make Claude answer in a fixed JSON shape, and the single parsing pass for them.
+
+Every request forces its tool with tool_choice, so the answer arrives as the
+tool_use block's input, already parsed by the API. A reply that comes back as
+text anyway (prose around the JSON, a ```json fence, a trailing comma) goes
+through repair_json. Either way the payload is checked against the tool's
+schema before use. A payload that still doesn't fit raises
+StructuredOutputError, and the caller re-asks for that one request with
+retry_params instead of dropping the result or failing the whole statement.
+"""
+import json
+import os
+import re
+from typing import Any, Dict, List
+
+# Times a request is re-asked after a reply that doesn't fit its schema
+STRUCTURED_OUTPUT_RETRIES = int(os.getenv('STRUCTURED_OUTPUT_RETRIES', '1'))
+
+class StructuredOutputError(ValueError):
+    """Raised when a response can't be read as its tool's input"""
+    pass
+
+_COMPANY_PROPERTIES = {
+    "company_name": {"type": "string", "description": "Official company name only"},
+    "website": {"type": "string", "description": "Company website URL, or 'Unknown'"},
+    "phone": {"type": "string", "description": "Phone number, or 'Unknown'"},
+    "products": {"type": "string", "description": "Brief description of its products or services"},
+}
+
+_COMPETITOR_PRODUCTS = {
+    "type": "array",
+    "minItems": 1,
+    "maxItems": 3,
+    "items": {
+        "type": "object",
+        "properties": {
+            "product_name": {"type": "string"},
+            "company": {"type": "string"},
+            "price": {"type": "string", "description": "Price, e.g. '$9.99' or '$9.99/month'"},
+            "description": {"type": "string", "description": "Brief description"},
+            "website": {"type": "string", "description": "Website if available, otherwise empty"},
+            "comparison": {"type": "string", "description": "How it compares to the original transaction"},
+        },
+        "required": ["product_name", "company", "price"],
+    },
+}
+
+COMPANY_TOOL = {
+    "name": "record_company",
+    "description": "Record the company behind a credit card transaction.",
+    "input_schema": {
+        "type": "object",
+        "properties": _COMPANY_PROPERTIES,
+        # The rest default to 'Unknown' rather than costing a retry
+        "required": ["company_name"],
+    },
+}
+
+COMPANIES_TOOL = {
+    "name": "record_companies",
+    "description": "Record the company behind each of several credit card transactions.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "companies": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"index": {"type": "integer", "description": "Index from the <merchant> tag"},
+                                   **_COMPANY_PROPERTIES},
+                    "required": ["index", "company_name"],
+                },
+            },
+        },
+        "required": ["companies"],
+    },
+}
+
+# A batch reply is checked one company at a time (see company_entry), so one
+# bad entry doesn't throw away the rest of the batch
+_REPLY_SCHEMAS = {
+    COMPANIES_TOOL["name"]: {**COMPANIES_TOOL["input_schema"], "properties": {"companies": {"type": "array"}}},
+}
+
+def company_entry(entry: Any, path: str = 'companies[]') -> Dict[str, Any]:
+    """One record_companies entry checked against the tool's item schema"""
+    return conform(entry, COMPANIES_TOOL["input_schema"]["properties"]["companies"]["items"], path)
+
+COMPETITORS_TOOL = {
+    "name": "record_competitor_products",
+    "description": "Record less expensive competitor products for a transaction.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "original_transaction": {"type": "string", "description": "Brief description of the original transaction"},
+            "competitor_products": _COMPETITOR_PRODUCTS,
+        },
+        "required": ["original_transaction", "competitor_products"],
+    },
+}
+
+MERCHANT_ANALYSIS_TOOL = {
+    "name": "record_merchant_analysis",
+    "description": "Record the company behind a transaction and less expensive competitor products.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            **_COMPANY_PROPERTIES,
+            "original_transaction": {"type": "string", "description": "Brief description of the original transaction"},
+            "competitor_products": _COMPETITOR_PRODUCTS,
+        },
+        "required": ["company_name", "original_transaction", "competitor_products"],
+    },
+}
+
+TRANSACTIONS_TOOL = {
+    "name": "record_transactions",
+    "description": "Record every transaction on a credit card statement, in statement order.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "transactions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "date": {"type": "string", "description": "YYYY-MM-DD"},
+                        "merchant": {"type": "string", "description": "Merchant description as printed"},
+                        "amount": {"type": "number", "description": "Amount; payments and credits are negative"},
+                    },
+                    "required": ["date", "merchant", "amount"],
+                },
+            },
+        },
+        "required": ["transactions"],
+    },
+}
+
+def tool_params(tool: Dict[str, Any]) -> Dict[str, Any]:
+    """Request parameters that make the model answer through this tool"""
+    return {"tools": [tool], "tool_choice": {"type": "tool", "name": tool["name"]}}
+
+_FENCE = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+def repair_json(text: str) -> Any:
+    """Parse JSON out of a model's text reply, repairing the usual problems.
+
+    Takes the contents of a code fence if there is one, drops prose before the
+    first bracket and after the last, and removes trailing commas. Raises
+    StructuredOutputError if what's left still isn't JSON.
+    """
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [index for index in (text.find('{'), text.find('[')) if index != -1]
+    if not starts:
+        raise StructuredOutputError("reply contains no JSON")
+    start = min(starts)
+    end = text.rfind('}' if text[start] == '{' else ']')
+    candidate = text[start:end + 1]
+    try:
+        return json.loads(candidate)
+    except json.JSONDecodeError:
+        pass
+    try:
+        # Only applied when needed, since it would also touch ",}" inside strings
+        return json.loads(_TRAILING_COMMA.sub(r'\1', candidate))
+    except json.JSONDecodeError as e:
+        raise StructuredOutputError(f"reply is not valid JSON: {e}") from e
+
+def conform(value: Any, schema: Dict[str, Any], path: str = 'input') -> Any:
+    """Check a value against the subset of JSON Schema the tools use, returning it with light coercions.
+
+    Numbers given as strings ("$1,234.56") become numbers, null optional
+    fields are dropped and extra array items beyond maxItems are cut off;
+    anything else that doesn't fit raises StructuredOutputError.
+    """
+    kind = schema.get('type')
+    if kind == 'object':
+        if not isinstance(value, dict):
+            raise StructuredOutputError(f"{path} should be an object")
+        properties = schema.get('properties', {})
+        result = {}
+        for name, item in value.items():
+            if name in properties and item is not None:
+                result[name] = conform(item, properties[name], f"{path}.{name}")
+            elif name not in properties:
+                result[name] = item
+        missing = [name for name in schema.get('required', []) if name not in result]
+        if missing:
+            raise StructuredOutputError(f"{path} is missing {', '.join(missing)}")
+        return result
+    if kind == 'array':
+        if not isinstance(value, list):
+            raise StructuredOutputError(f"{path} should be an array")
+        if len(value) < schema.get('minItems', 0):
+            raise StructuredOutputError(f"{path} should have at least {schema['minItems']} items")
+        items = value[:schema['maxItems']] if 'maxItems' in schema else value
+        return [conform(item, schema.get('items', {}), f"{path}[{index}]") for index, item in enumerate(items)]
+    if kind in ('number', 'integer'):
+        if isinstance(value, str):
+            cleaned = re.sub(r'[^\d.\-]', '', value)
+            try:
+                value = float(cleaned) if kind == 'number' else int(cleaned)
+            except ValueError:
+                raise StructuredOutputError(f"{path} should be a number, got {value!r}")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise StructuredOutputError(f"{path} should be a number")
+        return int(value) if kind == 'integer' else value
+    if kind == 'string':
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return str(value)
+        if not isinstance(value, str):
+            raise StructuredOutputError(f"{path} should be a string")
+        return value
+    return value
+
+def parse_tool_response(message: Any, tool: Dict[str, Any]) -> Dict[str, Any]:
+    """The tool input from a Messages response, repaired and checked against the tool's schema"""
+    payload = None
+    for block in message.content:
+        if block.type == 'tool_use' and block.name == tool['name']:
+            payload = block.input
+            break
+    if payload is None:
+        text = ''.join(block.text for block in message.content if block.type == 'text')
+        payload = repair_json(text)
+    schema = _REPLY_SCHEMAS.get(tool['name'], tool['input_schema'])
+    # A bare array answers a tool whose only required field is that array
+    if isinstance(payload, list) and len(schema.get('required', [])) == 1:
+        payload = {schema['required'][0]: payload}
+    return conform(payload, schema)
+
+def retry_params(params: Dict[str, Any], message: Any, error: StructuredOutputError) -> Dict[str, Any]:
+    """params for re-asking after a bad reply: the reply goes back in, with what was wrong with it"""
+    tool_name = params['tool_choice']['name']
+    reply: List[Dict[str, Any]] = [block.model_dump(exclude_none=True) for block in message.content]
+    tool_use = next((block for block in reply if block['type'] == 'tool_use'), None)
+    correction = f"That answer could not be used: {error}. Call the {tool_name} tool again with corrected input."
+    if tool_use is not None:
+        feedback = [{"type": "tool_result", "tool_use_id": tool_use['id'], "is_error": True, "content": correction}]
+    else:
+        feedback = [{"type": "text", "text": correction}]
+    return {**params, "messages": params['messages'] + [
+        {"role": "assistant", "content": reply or [{"type": "text", "text": "(no answer)"}]},
+        {"role": "user", "content": feedback},
+    ]}
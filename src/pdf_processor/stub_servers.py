@@ -0,0 +1,571 @@
+"""Local stand-ins for the Anthropic Messages API and Brave web search.
+
+benchmark.py runs the pipeline against these so throughput can be measured
+without spending API quota. They also run on their own for manual testing:
+
+    python stub_servers.py --claude-latency-ms 800 --claude-429-rate 0.05
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8701 \\
+        BRAVE_SEARCH_URL=http://127.0.0.1:8702/res/v1/web/search uvicorn api:app
+
+Responses are canned but derived from each request, so the real parsers run
+on every one. Requests that force a tool get a tool_use block, as the real
+API returns; the rest get the same payload as JSON text. Extraction requests get the transactions printed on the PDF
+pages they carry. Identification requests get a company named after the
+descriptor. Competitor requests get products priced below the transaction
+amount. Each stub draws its latency from a log-normal distribution and fails
+a configurable fraction of requests with a 500 or a 429. The Anthropic stub
+also serves the Message Batches endpoints: a batch ends one latency draw
+after it is created, and the error rate applies to its individual requests.
+"""
+import argparse
+import base64
+import io
+import json
+import logging
+import math
+import multiprocessing
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# Roughly what Claude charges for each page of a PDF document block
+TOKENS_PER_PDF_PAGE = 1500
+# Characters of streamed text per content_block_delta event
+STREAM_DELTA_CHARS = 200
+# How long a cached prompt prefix lives after its last use, as on the real API
+PROMPT_CACHE_TTL_SECONDS = 300
+# System prompt the API adds ahead of the tools when a request forces a tool
+TOOL_USE_SYSTEM_TOKENS = 313
+
+@dataclass
+class StubProfile:
+    """How one stub behaves: latency distribution and failure rates"""
+    latency_ms: float = 0.0
+    # Log-normal spread of the latency around latency_ms (its median); 0 means fixed
+    latency_sigma: float = 0.0
+    # Fraction of requests answered with a 500 after the usual latency
+    error_rate: float = 0.0
+    # Fraction of requests answered straight away with a 429 and a Retry-After
+    throttle_rate: float = 0.0
+    retry_after: float = 0.5
+    # Shortest cache_control prefix the Anthropic stub caches (the API's minimum on most models)
+    cache_min_tokens: int = 1024
+
+    def latency(self, rng: random.Random) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        seconds = self.latency_ms / 1000
+        return seconds * math.exp(rng.gauss(0, self.latency_sigma)) if self.latency_sigma else seconds
+
+def company_name(merchant_code: str) -> str:
+    """Deterministic company name for a transaction descriptor"""
+    words = re.sub(r'[^A-Za-z ]', ' ', merchant_code).split()
+    return ' '.join(word.capitalize() for word in words[:3]) or 'Unknown'
+
+def _slug(name: str) -> str:
+    return re.sub(r'[^a-z0-9]', '', name.lower()) or 'merchant'
+
+def _system_blocks(request: Dict[str, Any]) -> List[Dict[str, Any]]:
+    system = request.get('system') or []
+    return [{"type": "text", "text": system}] if isinstance(system, str) else system
+
+def _prompt_text(request: Dict[str, Any], include_system: bool = True) -> str:
+    parts = [block.get('text', '') for block in _system_blocks(request)] if include_system else []
+    for message in request.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get('text', '') for block in content if block.get('type') == 'text')
+    return '\n'.join(parts)
+
+def _documents(request: Dict[str, Any]) -> List[bytes]:
+    return [
+        base64.b64decode(block['source']['data'])
+        for message in request.get('messages', []) if not isinstance(message.get('content'), str)
+        for block in message['content'] if block.get('type') == 'document'
+    ]
+
+def _extraction_payload(documents: List[bytes]) -> Tuple[Dict[str, Any], int]:
+    """The transactions printed on the documents' pages, as the extraction tool asks for"""
+    from PyPDF2 import PdfReader
+    from local_extractor import StatementParser
+
+    rows, pages = [], 0
+    for document in documents:
+        reader = PdfReader(io.BytesIO(document))
+        pages += len(reader.pages)
+        text = '\n'.join(page.extract_text() or '' for page in reader.pages)
+        parser = StatementParser(text)
+        rows.extend(row for row in map(parser.parse_line, text.splitlines()) if row is not None)
+    return {"transactions": rows}, pages * TOKENS_PER_PDF_PAGE
+
+def _competitors(merchant: str, amount: float) -> List[Dict[str, str]]:
+    return [
+        {
+            "product_name": f"{merchant} Alternative {index}",
+            "company": f"Budget {merchant} {index}",
+            "price": f"${amount * factor:.2f}",
+            "description": f"A less expensive alternative to {merchant}",
+            "website": f"https://www.budget{_slug(merchant)}{index}.com",
+            "comparison": f"Costs {100 - factor * 100:.0f}% less"
+        }
+        for index, factor in enumerate((0.8, 0.6), start=1)
+    ]
+
+def _tag(prompt: str, tag: str) -> str:
+    match = re.search(rf'<{tag}>\s*(.*?)\s*</{tag}>', prompt, re.DOTALL)
+    return match.group(1) if match else ''
+
+def _amount(prompt: str) -> float:
+    try:
+        return abs(float(_tag(prompt, 'transaction_amount')))
+    except ValueError:
+        return 10.0
+
+def _company(merchant: str) -> Dict[str, str]:
+    return {"company_name": merchant, "website": f"https://www.{_slug(merchant)}.com",
+            "phone": "1-800-555-0100", "products": f"Products and services from {merchant}"}
+
+def canned_payload(request: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], int]:
+    """Tool input and input token count for a Messages request, chosen by prompt shape"""
+    input_tokens = (len(_prompt_text(request)) + len(json.dumps(request.get('tools', [])))) // 4
+    if request.get('tools'):
+        input_tokens += TOOL_USE_SYSTEM_TOKENS
+    # Values are read from the messages only, since the instructions mention the same tags
+    prompt = _prompt_text(request, include_system=False)
+    documents = _documents(request)
+    if documents:
+        payload, document_tokens = _extraction_payload(documents)
+        return payload, input_tokens + document_tokens
+
+    batch = re.findall(r'<merchant index="(\d+)">\s*Transaction: (.*)', prompt)
+    if batch:
+        return {"companies": [{"index": int(index), **_company(company_name(code))}
+                              for index, code in batch]}, input_tokens
+
+    if '<company_info>' in prompt:
+        merchant = _tag(prompt, 'company_info')
+        return {"original_transaction": f"Purchase from {merchant}",
+                "competitor_products": _competitors(merchant, _amount(prompt))}, input_tokens
+
+    if '<search_results>' in prompt and '<transaction_amount>' in prompt:
+        merchant = company_name(_tag(prompt, 'transaction_description'))
+        return {**_company(merchant), "original_transaction": f"Purchase from {merchant}",
+                "competitor_products": _competitors(merchant, _amount(prompt))}, input_tokens
+
+    match = re.search(r"for the transaction '(.*?)', extract", prompt)
+    if match:
+        return _company(company_name(match.group(1))), input_tokens
+
+    return None, input_tokens
+
+def canned_reply(request: Dict[str, Any]) -> Tuple[str, int]:
+    """Response text and input token count for a request that doesn't force a tool"""
+    payload, input_tokens = canned_payload(request)
+    return ("OK" if payload is None else json.dumps(payload, indent=2)), input_tokens
+
+def _fit_payload(payload: Dict[str, Any], max_chars: int) -> Tuple[Dict[str, Any], bool]:
+    """Drop trailing transactions until the tool input fits in max_chars; True if it had to be cut"""
+    if len(json.dumps(payload)) <= max_chars:
+        return payload, False
+    rows = list(payload.get('transactions', []))
+    while rows and len(json.dumps({**payload, "transactions": rows})) > max_chars:
+        rows.pop()
+    return ({**payload, "transactions": rows} if 'transactions' in payload else payload), True
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so clients' connection pools behave as they do against the real APIs
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, Nagle's algorithm adds ~40ms per response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    @property
+    def profile(self) -> StubProfile:
+        return self.server.profile
+
+    def send_json(self, status: int, body: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def fault(self) -> Optional[int]:
+        """Status of an injected failure for this request, if any"""
+        roll = self.server.rng.random()
+        if roll < self.profile.throttle_rate:
+            return 429
+        if roll < self.profile.throttle_rate + self.profile.error_rate:
+            time.sleep(self.profile.latency(self.server.rng))
+            return 500
+        return None
+
+    def read_json(self) -> Dict[str, Any]:
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+@dataclass
+class StubBatch:
+    """A Message Batch held by the Anthropic stub"""
+    id: str
+    requests: List[Dict[str, Any]]
+    created_at: float
+    ends_at: float
+    results: Optional[List[Dict[str, Any]]] = None
+
+def _timestamp(seconds: float) -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+class AnthropicStubHandler(_StubHandler):
+    def not_found(self) -> None:
+        self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+    def do_POST(self) -> None:
+        path = urlparse(self.path).path
+        if path == '/v1/messages/batches':
+            self.create_batch(self.read_json())
+            return
+        if path != '/v1/messages':
+            self.not_found()
+            return
+        request = self.read_json()
+        status = self.fault()
+        if status == 429:
+            self.send_json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "Stub throttle"}},
+                           {'retry-after': str(self.profile.retry_after)})
+            return
+        if status == 500:
+            self.send_json(500, {"type": "error", "error": {"type": "api_error", "message": "Stub error"}})
+            return
+
+        message, text = self.build_message(request)
+        latency = self.profile.latency(self.server.rng)
+        if request.get('stream'):
+            self.stream(message, text, latency)
+        else:
+            time.sleep(latency)
+            self.send_json(200, message)
+
+    def do_GET(self) -> None:
+        match = re.fullmatch(r'/v1/messages/batches/([\w-]+)(/results)?', urlparse(self.path).path)
+        batch = self.server.batches.get(match.group(1)) if match else None
+        if batch is None:
+            self.not_found()
+        elif match.group(2):
+            self.send_batch_results(batch)
+        else:
+            self.send_json(200, self.batch_object(batch))
+
+    def create_batch(self, body: Dict[str, Any]) -> None:
+        now = time.time()
+        # Requests in a batch run side by side, so the whole batch takes about one request's latency
+        batch = StubBatch(f"msgbatch_{uuid.uuid4().hex[:24]}", body.get('requests', []), now,
+                          now + self.profile.latency(self.server.rng))
+        with self.server.batch_lock:
+            self.server.batches[batch.id] = batch
+        self.send_json(200, self.batch_object(batch))
+
+    def batch_object(self, batch: StubBatch) -> Dict[str, Any]:
+        """The MessageBatch for a stub batch, running its requests once it has ended"""
+        ended = time.time() >= batch.ends_at
+        with self.server.batch_lock:
+            if ended and batch.results is None:
+                batch.results = [self.batch_result(request) for request in batch.requests]
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        if batch.results is None:
+            counts["processing"] = len(batch.requests)
+        else:
+            for result in batch.results:
+                counts[result['result']['type']] += 1
+        host, port = self.server.server_address[:2]
+        return {
+            "id": batch.id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": counts,
+            "created_at": _timestamp(batch.created_at),
+            "expires_at": _timestamp(batch.created_at + 24 * 60 * 60),
+            "ended_at": _timestamp(batch.ends_at) if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"http://{host}:{port}/v1/messages/batches/{batch.id}/results" if ended else None,
+        }
+
+    def batch_result(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        if self.server.rng.random() < self.profile.error_rate:
+            result = {"type": "errored", "error": {"type": "error",
+                                                   "error": {"type": "api_error", "message": "Stub error"}}}
+        else:
+            result = {"type": "succeeded", "message": self.build_message(request['params'])[0]}
+        return {"custom_id": request['custom_id'], "result": result}
+
+    def send_batch_results(self, batch: StubBatch) -> None:
+        if batch.results is None:
+            self.send_json(400, {"type": "error", "error": {"type": "invalid_request_error",
+                                                            "message": "Batch is still processing"}})
+            return
+        data = b''.join(json.dumps(result).encode() + b'\n' for result in batch.results)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/binary')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def build_message(self, request: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+        """The Messages response for a request, and the text or tool input JSON it streams"""
+        cache_read, cache_write = self.prompt_cache_usage(request)
+        # Honour max_tokens so truncation handling is exercised on long extractions
+        max_chars = int(request.get('max_tokens', 4096)) * 4
+        stop_reason = 'end_turn'
+        payload, input_tokens = canned_payload(request)
+        tool_choice = request.get('tool_choice') or {}
+        if request.get('tools') and payload is not None and tool_choice.get('type') in ('tool', 'any'):
+            name = tool_choice.get('name') or request['tools'][0]['name']
+            fitted, truncated = _fit_payload(payload, max_chars)
+            # A truncated stream carries the input JSON cut off mid-row, as the real API does
+            text = json.dumps(payload)[:max_chars] if truncated else json.dumps(fitted)
+            content = [{"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:24]}", "name": name, "input": fitted}]
+            stop_reason = 'max_tokens' if truncated else 'tool_use'
+        else:
+            text, input_tokens = canned_reply(request)
+            if len(text) > max_chars:
+                text, stop_reason = text[:max_chars], 'max_tokens'
+            content = [{"type": "text", "text": text}]
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": request.get('model') or 'stub',
+            "content": content,
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {"input_tokens": max(1, input_tokens - cache_read - cache_write),
+                      "output_tokens": max(1, len(text) // 4),
+                      "cache_read_input_tokens": cache_read,
+                      "cache_creation_input_tokens": cache_write},
+        }, text
+
+    def prompt_cache_usage(self, request: Dict[str, Any]) -> Tuple[int, int]:
+        """(cache read, cache write) tokens for the request's cache_control prefix, as the API reports them"""
+        blocks = [(json.dumps(tool), 'cache_control' in tool) for tool in request.get('tools', [])]
+        blocks += [(block.get('text', ''), 'cache_control' in block) for block in _system_blocks(request)]
+        marked = [index for index, (_, is_marked) in enumerate(blocks) if is_marked]
+        if not marked:
+            return 0, 0
+        prefix = request.get('model', '') + ''.join(text for text, _ in blocks[:marked[-1] + 1])
+        tokens = len(prefix) // 4 + (TOOL_USE_SYSTEM_TOKENS if request.get('tools') else 0)
+        if tokens < self.profile.cache_min_tokens:
+            return 0, 0
+
+        now = time.monotonic()
+        with self.server.prompt_cache_lock:
+            hit = self.server.prompt_cache.get(prefix, 0) > now
+            self.server.prompt_cache[prefix] = now + PROMPT_CACHE_TTL_SECONDS
+        return (tokens, 0) if hit else (0, tokens)
+
+    def stream(self, message: Dict[str, Any], text: str, latency: float) -> None:
+        """Send the message as server-sent events, spreading the latency across the deltas"""
+        deltas = [text[start:start + STREAM_DELTA_CHARS] for start in range(0, len(text), STREAM_DELTA_CHARS)]
+        # About a third of the latency goes to the first token, the rest to generation
+        time.sleep(latency * 0.3)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def event(name: str, data: Dict[str, Any]) -> None:
+            chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.flush()
+
+        usage = message['usage']
+        event('message_start', {"type": "message_start", "message": {
+            **message, "content": [], "stop_reason": None, "usage": {**usage, "output_tokens": 1}}})
+        block = message['content'][0]
+        if block['type'] == 'tool_use':
+            start = {**block, "input": {}}
+            delta_event = lambda delta: {"type": "input_json_delta", "partial_json": delta}
+        else:
+            start = {"type": "text", "text": ""}
+            delta_event = lambda delta: {"type": "text_delta", "text": delta}
+        event('content_block_start', {"type": "content_block_start", "index": 0, "content_block": start})
+        for delta in deltas:
+            time.sleep(latency * 0.7 / len(deltas))
+            event('content_block_delta', {"type": "content_block_delta", "index": 0, "delta": delta_event(delta)})
+        event('content_block_stop', {"type": "content_block_stop", "index": 0})
+        event('message_delta', {"type": "message_delta",
+                                "delta": {"stop_reason": message['stop_reason'], "stop_sequence": None},
+                                "usage": {"output_tokens": usage['output_tokens']}})
+        event('message_stop', {"type": "message_stop"})
+        self.wfile.write(b'0\r\n\r\n')
+
+class BraveStubHandler(_StubHandler):
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path != '/res/v1/web/search':
+            self.send_json(404, {"error": self.path})
+            return
+        status = self.fault()
+        if status == 429:
+            self.send_json(429, {"error": "Stub throttle"}, {'retry-after': str(self.profile.retry_after)})
+            return
+        if status == 500:
+            self.send_json(500, {"error": "Stub error"})
+            return
+
+        query = parse_qs(url.query).get('q', [''])[0]
+        merchant = company_name(query.split(' company ')[0])
+        count = int(parse_qs(url.query).get('count', ['5'])[0])
+        results = [
+            {
+                "title": f"{merchant} - Official Site" if index == 0 else f"{merchant} reviews and contact {index}",
+                "url": f"https://www.{_slug(merchant)}.com/" if index == 0
+                else f"https://www.directory{index}.com/{_slug(merchant)}",
+                "description": f"{merchant} company information, phone number and customer service.",
+            }
+            for index in range(count)
+        ]
+        time.sleep(self.profile.latency(self.server.rng))
+        self.send_json(200, {"type": "search", "web": {"type": "search", "results": results}})
+
+class StubServers:
+    """Both stubs, each serving on its own port from background threads"""
+
+    def __init__(self, claude: StubProfile, brave: StubProfile, host: str = '127.0.0.1',
+                 claude_port: int = 0, brave_port: int = 0, seed: Optional[int] = None):
+        self.servers: List[ThreadingHTTPServer] = []
+        for handler, profile, port in ((AnthropicStubHandler, claude, claude_port),
+                                       (BraveStubHandler, brave, brave_port)):
+            server = ThreadingHTTPServer((host, port), handler)
+            server.daemon_threads = True
+            server.profile = profile
+            server.rng = random.Random(seed)
+            server.prompt_cache = {}
+            server.prompt_cache_lock = threading.Lock()
+            server.batches = {}
+            server.batch_lock = threading.Lock()
+            self.servers.append(server)
+        self._threads: List[threading.Thread] = []
+        self.logger = logging.getLogger('StubServers')
+
+    def _url(self, server: ThreadingHTTPServer) -> str:
+        host, port = server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def anthropic_base_url(self) -> str:
+        return self._url(self.servers[0])
+
+    @property
+    def brave_search_url(self) -> str:
+        return self._url(self.servers[1]) + '/res/v1/web/search'
+
+    def start(self) -> 'StubServers':
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self.logger.info("Anthropic stub on %s, Brave stub on %s", self.anthropic_base_url, self.brave_search_url)
+        return self
+
+    def stop(self) -> None:
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+def _serve(claude: StubProfile, brave: StubProfile, seed: Optional[int], connection) -> None:
+    stubs = StubServers(claude, brave, seed=seed).start()
+    connection.send((stubs.anthropic_base_url, stubs.brave_search_url))
+    # Serve until the parent closes its end (or exits)
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    stubs.stop()
+
+class StubProcess:
+    """The stubs in a child process, so their work doesn't count against the process being measured"""
+
+    def __init__(self, claude: StubProfile, brave: StubProfile, seed: Optional[int] = None):
+        self._connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(claude, brave, seed, child_connection),
+                                                daemon=True)
+        self._process.start()
+        child_connection.close()
+        self.anthropic_base_url, self.brave_search_url = self._connection.recv()
+
+    def stop(self) -> None:
+        self._connection.close()
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def __enter__(self) -> 'StubProcess':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    """Latency and failure options for both stubs"""
+    for name, label, latency in (('claude', 'Anthropic', 800), ('brave', 'Brave', 150)):
+        parser.add_argument(f'--{name}-latency-ms', type=float, default=latency,
+                            help=f'Median {label} stub latency')
+        parser.add_argument(f'--{name}-latency-sigma', type=float, default=0.5,
+                            help=f'Log-normal spread of the {label} stub latency (0 for fixed)')
+        parser.add_argument(f'--{name}-error-rate', type=float, default=0.0,
+                            help=f'Fraction of {label} requests failed with a 500')
+        parser.add_argument(f'--{name}-429-rate', type=float, default=0.0,
+                            help=f'Fraction of {label} requests throttled with a 429')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='Retry-After sent with stub 429s')
+    parser.add_argument('--cache-min-tokens', type=int, default=1024,
+                        help='Shortest prompt prefix the Anthropic stub caches')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the stubs\' latency and failures')
+
+def profiles_from_args(args: argparse.Namespace) -> Tuple[StubProfile, StubProfile]:
+    return tuple(
+        StubProfile(latency_ms=getattr(args, f'{name}_latency_ms'),
+                    latency_sigma=getattr(args, f'{name}_latency_sigma'),
+                    error_rate=getattr(args, f'{name}_error_rate'),
+                    throttle_rate=getattr(args, f'{name}_429_rate'),
+                    retry_after=args.retry_after,
+                    cache_min_tokens=args.cache_min_tokens)
+        for name in ('claude', 'brave')
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve local stand-ins for the Anthropic and Brave APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--claude-port', type=int, default=8701)
+    parser.add_argument('--brave-port', type=int, default=8702)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    claude, brave = profiles_from_args(args)
+    stubs = StubServers(claude, brave, host=args.host, claude_port=args.claude_port,
+                        brave_port=args.brave_port, seed=args.seed).start()
+    print(f"ANTHROPIC_BASE_URL={stubs.anthropic_base_url}")
+    print(f"BRAVE_SEARCH_URL={stubs.brave_search_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stubs.stop()
+
+if __name__ == "__main__":
+    main()
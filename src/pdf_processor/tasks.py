@@ -1,12 +1,169 @@
-from celery import Celery
-import asyncio
+"""Distributed statement processing on Celery.
+
+A statement flows through three tasks:
+
+1. process_pdf_task (extraction queue) extracts the transactions, then
+   replaces itself with a chord over the statement's unique merchants.
+2. analyze_merchant_task (analysis queue) analyzes one merchant. Analysis
+   workers can run on any number of nodes.
+3. assemble_results_task (analysis queue) fans the merchant results back out
+   to the transactions and builds the same response as main.process_pdf.
+   It also appends the statement to the transaction store and deletes its
+   job journal, so TRANSACTION_STORE_DIR and JOB_JOURNAL_DIR should be
+   shared storage when workers run on several nodes.
+
+Run a worker per queue, e.g.
+
+    celery -A tasks worker -Q extraction --concurrency 2
+    celery -A tasks worker -Q analysis --concurrency 8
+
+Setting CELERY_ALWAYS_EAGER=true runs the whole pipeline in-process, and
+CELERY_BROKER_URL=memory:// with CELERY_RESULT_BACKEND=cache+memory:// needs
+no Redis.
+"""
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from celery import Celery, chord
+from celery.result import allow_join_result
+from kombu import Exchange, Queue
+
+from models import merchant_info_from_dict, merchant_info_to_dict
+from pdf_extractor import PDFExtractionError
+from rate_limiter import RateLimitExceeded
+from runtime import get_runtime
+from statement_pipeline import discard_journal, open_statement, save_extraction, statement_result
+
+EXTRACTION_QUEUE = 'extraction'
+ANALYSIS_QUEUE = 'analysis'
+
+logger = logging.getLogger('CeleryTasks')
 
 app = Celery('pdf_processor',
-             broker='redis://localhost:6379/0',
-             backend='redis://localhost:6379/0')
-
-@app.task
-def process_pdf_task(file_path: str, notify_email: str):
-    # Reuse the same processing logic
-    result = asyncio.run(process_pdf_async(file_path, notify_email))
-    return result 
\ No newline at end of file
+             broker=os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0'),
+             backend=os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0'))
+
+exchange = Exchange('pdf_processor', type='direct')
+app.conf.update(
+    task_serializer='json',
+    result_serializer='json',
+    accept_content=['json'],
+    task_queues=[
+        Queue(EXTRACTION_QUEUE, exchange, routing_key=EXTRACTION_QUEUE),
+        Queue(ANALYSIS_QUEUE, exchange, routing_key=ANALYSIS_QUEUE),
+    ],
+    task_default_exchange=exchange.name,
+    task_default_queue=ANALYSIS_QUEUE,
+    task_default_routing_key=ANALYSIS_QUEUE,
+    task_routes={
+        'pdf_processor.process_pdf': {'queue': EXTRACTION_QUEUE, 'routing_key': EXTRACTION_QUEUE},
+        'pdf_processor.analyze_merchant': {'queue': ANALYSIS_QUEUE, 'routing_key': ANALYSIS_QUEUE},
+        'pdf_processor.assemble_results': {'queue': ANALYSIS_QUEUE, 'routing_key': ANALYSIS_QUEUE},
+    },
+    # A task lost with its worker goes back on the queue; workers take one task at a
+    # time so a slow statement doesn't hold merchants that another worker could run
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    worker_prefetch_multiplier=1,
+    task_always_eager=os.getenv('CELERY_ALWAYS_EAGER', 'false').lower() in ('1', 'true', 'yes', 'on'),
+)
+
+TASK_MAX_RETRIES = int(os.getenv('CELERY_TASK_MAX_RETRIES', '3'))
+TASK_RETRY_BACKOFF = float(os.getenv('CELERY_TASK_RETRY_BACKOFF', '5'))
+
+def is_transient(error: BaseException) -> bool:
+    """Whether an error (or anything that caused it) is worth retrying later"""
+    import anthropic
+    import httpx
+    transient = (RateLimitExceeded, httpx.TransportError, anthropic.APIConnectionError,
+                 anthropic.RateLimitError, anthropic.InternalServerError)
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, transient):
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+def retry_countdown(retries: int) -> float:
+    return TASK_RETRY_BACKOFF * 2 ** retries
+
+@app.task(bind=True, name='pdf_processor.process_pdf', max_retries=TASK_MAX_RETRIES)
+def process_pdf_task(self, file_path: str, notify_email: Optional[str],
+                     account: Optional[str] = None) -> Dict[str, Any]:
+    """Extract a statement's transactions and fan its unique merchants out to analysis workers"""
+    runtime = get_runtime()
+    statement = None
+    try:
+        # A retried or redelivered task reuses the extraction journaled by its earlier attempt
+        statement = open_statement(file_path, runtime)
+        transactions = statement.transactions
+        if transactions is None:
+            transactions = runtime.extractor.extract_transactions_from_pdf(file_path)
+            save_extraction(statement, transactions, runtime)
+    except PDFExtractionError as e:
+        if is_transient(e) and self.request.retries < self.max_retries:
+            logger.warning("Retrying extraction of %s: %s", file_path, str(e))
+            raise self.retry(exc=e, countdown=retry_countdown(self.request.retries))
+        return {"success": False, "error": str(e)}
+    finally:
+        if statement is not None:
+            statement.close()
+
+    # One subtask per unique merchant; repeat charges share their merchant's result
+    groups = runtime.processor.group_by_merchant(transactions)
+    keys = list(groups.keys())
+    logger.info("Extracted %d transactions from %s; dispatching %d unique merchants",
+                len(transactions), file_path, len(keys))
+    details = {"statement_id": statement.statement_id, "account": account, "source": file_path,
+               "extraction_key": statement.extraction_key}
+    if not keys:
+        return assemble_results_task([], transactions, keys, notify_email, details)
+
+    header = [analyze_merchant_task.s(group[0]['merchant'], group[0]['amount']) for group in groups.values()]
+    workflow = chord(header, assemble_results_task.s(transactions, keys, notify_email, details))
+    if self.request.is_eager:
+        # Celery can't replace an eagerly run task with a chord, so run the chord in place
+        with allow_join_result():
+            return workflow.apply().get()
+    return self.replace(workflow)
+
+@app.task(bind=True, name='pdf_processor.analyze_merchant', max_retries=TASK_MAX_RETRIES)
+def analyze_merchant_task(self, merchant: str, amount: float) -> Dict[str, Any]:
+    """Analyze one merchant; a merchant that still fails after its retries yields an error entry"""
+    runtime = get_runtime()
+    try:
+        info = runtime.run(runtime.processor.process_transaction(merchant, amount))
+    except Exception as e:
+        if is_transient(e) and self.request.retries < self.max_retries:
+            logger.warning("Retrying analysis of %s: %s", merchant, str(e))
+            raise self.retry(exc=e, countdown=retry_countdown(self.request.retries))
+        # Returned rather than raised so one bad merchant doesn't fail the whole chord
+        return {"error": str(e)}
+    return merchant_info_to_dict(info)
+
+@app.task(name='pdf_processor.assemble_results')
+def assemble_results_task(results: List[Dict[str, Any]], transactions: List[Dict[str, Any]],
+                          keys: List[str], notify_email: Optional[str],
+                          statement: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Chord callback: copy each merchant's analysis onto its transactions and store the statement.
+
+    statement carries the statement_id, account, source and extraction_key for the store.
+    """
+    merchant_results: Dict[str, Any] = {}
+    for key, result in zip(keys, results):
+        if 'error' in result:
+            merchant_results[key] = RuntimeError(result['error'])
+        else:
+            merchant_results[key] = merchant_info_from_dict(result)
+    runtime = get_runtime()
+    merchant_results = runtime.processor.fan_out(transactions, merchant_results)
+    statement = statement or {}
+    if runtime.store is not None and statement.get('statement_id'):
+        runtime.store.record_statement(statement['account'], statement['statement_id'], statement['source'],
+                                       transactions, merchant_results, statement.get('extraction_key'))
+    if statement.get('extraction_key'):
+        discard_journal(statement['extraction_key'])
+
+    return statement_result(statement.get('statement_id'), transactions, merchant_results, notify_email)
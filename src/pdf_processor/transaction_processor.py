@@ -1,74 +1,354 @@
 import asyncio
+import hashlib
 import json
-from typing import List, Dict, Any
+import os
+from dataclasses import replace
+from pathlib import Path
+from typing import List, Dict, Any, Callable, Optional, Tuple, Iterable, AsyncIterable, Union
 import logging
-from merchant_analyzer import MerchantAnalyzer, MerchantInfo
+from merchant_analyzer import ANALYSIS_MODES, MerchantAnalyzer, MerchantInfo
+from async_merchant_analyzer import AsyncMerchantAnalyzer
 from config import Config
+from job_journal import JobJournal, create_job_journal
+from message_batches import MessageBatchAnalysis
+from metrics import get_metrics
 
 class TransactionProcessor:
-    def __init__(self, verbose: bool = False):
+    def __init__(self, verbose: bool = False, max_concurrency: Optional[int] = None,
+                 analysis_mode: Optional[str] = None, analyzer: Optional[AsyncMerchantAnalyzer] = None):
         self.verbose = verbose
+        self.analysis_mode = analysis_mode
+        # Maximum number of merchants analyzed at the same time
+        self.max_concurrency = max_concurrency or int(os.getenv('MERCHANT_CONCURRENCY', '5'))
         self.logger = logging.getLogger('TransactionProcessor')
         level = logging.DEBUG if verbose else logging.INFO
         logging.basicConfig(
             level=level,
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         )
+        self._analyzer: Optional[AsyncMerchantAnalyzer] = analyzer
+        # Analyses currently running, by analysis key, so concurrent statements share them
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    @property
+    def analyzer(self) -> AsyncMerchantAnalyzer:
+        """Single analyzer shared by every transaction this processor handles"""
+        if self._analyzer is None:
+            self._analyzer = AsyncMerchantAnalyzer(verbose=self.verbose, analysis_mode=self.analysis_mode)
+        return self._analyzer
 
     async def process_transaction(self, merchant: str, amount: float) -> MerchantInfo:
         """Process a single transaction asynchronously"""
         self.logger.debug("Processing transaction: %s - $%.2f", merchant, amount)
-        analyzer = MerchantAnalyzer(verbose=self.verbose)
-        
-        # Create a new event loop for the thread
-        loop = asyncio.get_event_loop()
-        # Run the merchant analysis in the executor to prevent blocking
-        merchant_info = await loop.run_in_executor(
-            None, analyzer.analyze_merchant, merchant, amount
-        )
-        return merchant_info
+        return await self.analyzer.analyze_merchant(merchant, amount)
 
-    async def process_transactions(self, transactions: List[Dict[str, Any]]) -> List[MerchantInfo]:
-        """Process all transactions in parallel"""
-        self.logger.info("Processing %d transactions", len(transactions))
+    @staticmethod
+    def merchant_key(transaction: Dict[str, Any]) -> Optional[str]:
+        """Return the grouping key for a transaction, or None if it should be skipped"""
+        # Skip automatic payments or credits (negative amounts)
+        if ('AUTOMATIC PAYMENT' in transaction['merchant'] or 
+            transaction['amount'] < 0):
+            return None
+        
+        key = MerchantAnalyzer._clean_merchant_code(transaction['merchant']).lower()
+        return key or transaction['merchant']
 
-        # Create tasks for all transactions
-        tasks = []
-        processing_count = 0
+    def group_by_merchant(self, transactions: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        """Group analyzable transactions by cleaned merchant code, preserving first-seen order"""
+        groups: Dict[str, List[Dict[str, Any]]] = {}
         for transaction in transactions:
-            # Skip automatic payments or credits (negative amounts)
-            if ('AUTOMATIC PAYMENT' in transaction['merchant'] or 
-                transaction['amount'] < 0):
-                continue
-                
-            task = asyncio.create_task(
-                self.process_transaction(
-                    transaction['merchant'],
-                    transaction['amount']
-                )
+            key = self.merchant_key(transaction)
+            if key is not None:
+                groups.setdefault(key, []).append(transaction)
+        return groups
+
+    @staticmethod
+    def _settle(future: asyncio.Future, result: Any) -> None:
+        if future.done():
+            return
+        if isinstance(result, asyncio.CancelledError):
+            future.cancel()
+        elif isinstance(result, BaseException):
+            future.set_exception(result)
+            # Mark retrieved; nobody may be waiting on it
+            future.exception()
+        else:
+            future.set_result(result)
+
+    async def _await_shared(self, future: asyncio.Future, merchant: str, amount: float) -> MerchantInfo:
+        info = await asyncio.shield(future)
+        return replace(info, merchant_code=merchant, transaction_amount=amount)
+
+    async def _analyze_shared(self, merchant: str, amount: float, analyze) -> MerchantInfo:
+        """Run analyze() unless the same analysis is already running, in which case wait for that one"""
+        key = self.analyzer.analysis_key(merchant, amount)
+        running = self._in_flight.get(key)
+        if running is not None:
+            self.logger.debug("Sharing in-flight analysis for %s", merchant)
+            return await self._await_shared(running, merchant, amount)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await analyze()
+        except BaseException as e:
+            self._settle(future, e)
+            raise
+        else:
+            self._settle(future, result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    async def analyze_unique_merchants(self, merchants: List[Tuple[str, float]],
+                                       journal: Optional[JobJournal] = None,
+                                       on_result: Optional[Callable[[MerchantInfo], None]] = None) -> List[Any]:
+        """Analyze (merchant, amount) pairs under the concurrency limit.
+
+        Returns one MerchantInfo or exception per pair. Merchants whose analysis
+        is already running for another statement wait for that result instead
+        of repeating it. With a journal, merchants it already holds are not
+        analyzed again, and each new result is journaled as soon as it finishes.
+        on_result(info) is called as each merchant's analysis becomes available.
+        """
+        loop = asyncio.get_running_loop()
+        results: List[Any] = [None] * len(merchants)
+        owned: Dict[str, asyncio.Future] = {}
+        shared: Dict[int, asyncio.Future] = {}
+        own_positions: List[int] = []
+        for position, (merchant, amount) in enumerate(merchants):
+            key = self.analyzer.analysis_key(merchant, amount)
+            if journal is not None:
+                results[position] = journal.merchant(key, merchant, amount)
+                if results[position] is not None:
+                    continue
+            running = self._in_flight.get(key)
+            if running is not None:
+                shared[position] = running
+            else:
+                owned[key] = self._in_flight[key] = loop.create_future()
+                own_positions.append(position)
+        if journal is not None and len(own_positions) + len(shared) < len(merchants):
+            self.logger.info("Reusing %d journaled merchant analyses",
+                             len(merchants) - len(own_positions) - len(shared))
+            if on_result is not None:
+                for result in results:
+                    if result is not None:
+                        on_result(result)
+
+        def finished(position: int, info: MerchantInfo) -> None:
+            if journal is not None:
+                journal.record_merchant(self.analyzer.analysis_key(*merchants[position]), info)
+            if on_result is not None:
+                on_result(info)
+
+        own_results: List[Any] = []
+        try:
+            own_results = await self._analyze_merchants(
+                [merchants[position] for position in own_positions],
+                lambda index, info: finished(own_positions[index], info)
+            )
+        except BaseException as e:
+            own_results = [e] * len(own_positions)
+            raise
+        finally:
+            for key, result in zip(owned, own_results):
+                self._settle(owned[key], result)
+                del self._in_flight[key]
+
+        for position, result in zip(own_positions, own_results):
+            results[position] = result
+        if shared:
+            self.logger.debug("Waiting on %d merchants already being analyzed", len(shared))
+            shared_results = await asyncio.gather(
+                *(self._await_shared(future, *merchants[position]) for position, future in shared.items()),
+                return_exceptions=True
             )
-            tasks.append(task)
-            # just process 2 transactions for now
-            processing_count += 1
-            if processing_count == 2:
-                break
-
-        # Wait for all tasks to complete
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+            for position, result in zip(shared, shared_results):
+                results[position] = result
+                if not isinstance(result, BaseException):
+                    finished(position, result)
+        return results
+
+    async def _analyze_merchants(self, merchants: List[Tuple[str, float]],
+                                 on_result: Optional[Callable[[int, MerchantInfo], None]] = None) -> List[Any]:
+        """Analyze (merchant, amount) pairs, batching identification when batch_size is above 1.
+
+        Each batch holds one concurrency slot. on_result(index, info) is called
+        as each merchant finishes.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        batch_size = self.analyzer.batch_size
+
+        async def analyze_one(index: int, merchant: str, amount: float) -> MerchantInfo:
+            async with semaphore:
+                info = await self.process_transaction(merchant, amount)
+            if on_result is not None:
+                on_result(index, info)
+            return info
+
+        if batch_size <= 1:
+            return await asyncio.gather(
+                *(analyze_one(index, merchant, amount) for index, (merchant, amount) in enumerate(merchants)),
+                return_exceptions=True
+            )
+
+        async def analyze_batch(start: int, batch: List[Tuple[str, float]]) -> List[Any]:
+            def on_batch_result(index: int, info: MerchantInfo) -> None:
+                if on_result is not None:
+                    on_result(start + index, info)
+
+            async with semaphore:
+                return await self.analyzer.analyze_merchants(batch, return_exceptions=True,
+                                                             on_result=on_batch_result)
+
+        starts = range(0, len(merchants), batch_size)
+        batches = [merchants[start:start + batch_size] for start in starts]
+        batch_results = await asyncio.gather(*(analyze_batch(start, batch) for start, batch in zip(starts, batches)),
+                                             return_exceptions=True)
+        results = []
+        for batch, batch_result in zip(batches, batch_results):
+            if isinstance(batch_result, BaseException):
+                results.extend([batch_result] * len(batch))
+            else:
+                results.extend(batch_result)
+        return results
+
+    async def analyze_offline(self, merchants: List[Tuple[str, float]], state_path: Path,
+                              journal: Optional[JobJournal] = None) -> List[Any]:
+        """Analyze (merchant, amount) pairs through the Message Batches API.
+
+        Returns one MerchantInfo or exception per pair, like
+        analyze_unique_merchants, but only once every batch has ended, which
+        can take hours. Progress is kept at state_path so a restarted run
+        resumes its batches (see message_batches). With a journal, merchants it
+        already holds are reused and the new results are journaled.
+        """
+        results: List[Any] = [None] * len(merchants)
+        keys = [self.analyzer.analysis_key(merchant, amount) for merchant, amount in merchants]
+        if journal is not None:
+            results = [journal.merchant(key, merchant, amount) for key, (merchant, amount) in zip(keys, merchants)]
+        pending = [position for position, result in enumerate(results) if result is None]
+        self.logger.info("Analyzing %d merchants offline (%d journaled)",
+                         len(pending), len(merchants) - len(pending))
+
+        outcomes = await MessageBatchAnalysis(self.analyzer, state_path).run(
+            [merchants[position] for position in pending]
+        )
+        for position, outcome in zip(pending, outcomes):
+            results[position] = outcome
+            if journal is not None and not isinstance(outcome, BaseException):
+                journal.record_merchant(keys[position], outcome)
+        return results
+
+    async def process_transactions(self, transactions: List[Dict[str, Any]],
+                                   journal: Optional[JobJournal] = None,
+                                   on_result: Optional[Callable[[MerchantInfo], None]] = None) -> List[MerchantInfo]:
+        """Analyze each unique merchant once and fan the result out to its transactions"""
+        groups = self.group_by_merchant(transactions)
+        self.logger.info("Processing %d transactions across %d unique merchants",
+                         sum(len(group) for group in groups.values()), len(groups))
+
+        # Analyze one representative transaction per merchant
+        results = await self.analyze_unique_merchants(
+            [(group[0]['merchant'], group[0]['amount']) for group in groups.values()], journal, on_result
+        )
         
+        return self.fan_out(transactions, dict(zip(groups.keys(), results)))
+
+    def fan_out(self, transactions: List[Dict[str, Any]], results: Dict[str, Any]) -> List[MerchantInfo]:
+        """Copy each merchant's result onto its transactions, in statement order"""
         # Filter out any exceptions and log them
-        processed_results = []
-        for result in results:
+        merchant_results: Dict[str, MerchantInfo] = {}
+        for key, result in results.items():
             if isinstance(result, Exception):
-                self.logger.error("Error processing transaction: %s", str(result))
+                self.logger.error("Error processing merchant %s: %s", key, str(result))
             else:
-                processed_results.append(result)
+                merchant_results[key] = result
+
+        processed_results = []
+        for transaction in transactions:
+            result = merchant_results.get(self.merchant_key(transaction))
+            if result is not None:
+                processed_results.append(replace(
+                    result,
+                    merchant_code=transaction['merchant'],
+                    transaction_amount=transaction['amount']
+                ))
 
         return processed_results
 
-def process_json_file(json_path: str, verbose: bool = False) -> List[MerchantInfo]:
-    """Process transactions from a JSON file"""
-    processor = TransactionProcessor(verbose=verbose)
+    async def process_transaction_stream(
+        self, rows: Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]],
+        transactions: Optional[List[Dict[str, Any]]] = None, journal: Optional[JobJournal] = None,
+        on_result: Optional[Callable[[MerchantInfo], None]] = None
+    ) -> List[MerchantInfo]:
+        """Analyze transactions while they are still being extracted.
+
+        rows may be a plain generator (e.g. PDFExtractor.stream_transactions_from_pdf,
+        which is iterated on a worker thread) or an async iterable. Each new
+        merchant starts its analysis as soon as its first row arrives, so
+        batched identification is not used here. Consumed rows are appended to
+        transactions when a list is given. With a journal, journaled merchants
+        are reused and new results are journaled as they finish. on_result(info)
+        is called as each merchant's analysis becomes available.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        tasks: Dict[str, asyncio.Task] = {}
+        seen: List[Dict[str, Any]] = transactions if transactions is not None else []
+
+        async def analyze(merchant: str, amount: float) -> MerchantInfo:
+            async with semaphore:
+                return await self.process_transaction(merchant, amount)
+
+        async def analyze_shared(merchant: str, amount: float) -> MerchantInfo:
+            key = self.analyzer.analysis_key(merchant, amount)
+            info = journal.merchant(key, merchant, amount) if journal is not None else None
+            if info is None:
+                info = await self._analyze_shared(merchant, amount, lambda: analyze(merchant, amount))
+                if journal is not None:
+                    journal.record_merchant(key, info)
+            if on_result is not None:
+                on_result(info)
+            return info
+
+        def start(transaction: Dict[str, Any]) -> None:
+            seen.append(transaction)
+            key = self.merchant_key(transaction)
+            if key is not None and key not in tasks:
+                self.logger.debug("Starting analysis for %s while extraction continues", key)
+                tasks[key] = asyncio.create_task(analyze_shared(transaction['merchant'], transaction['amount']))
+
+        try:
+            if hasattr(rows, '__aiter__'):
+                async for transaction in rows:
+                    start(transaction)
+            else:
+                iterator = iter(rows)
+                done = object()
+                while True:
+                    # to_thread carries this task's context (e.g. the statement being costed) to the generator
+                    transaction = await asyncio.to_thread(next, iterator, done)
+                    if transaction is done:
+                        break
+                    start(transaction)
+        except BaseException:
+            # Extraction failed; don't leave analyses running in the background
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        self.logger.info("Extraction finished with %d transactions across %d unique merchants",
+                         len(seen), len(tasks))
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return self.fan_out(seen, dict(zip(tasks.keys(), results)))
+
+def process_json_file(json_path: str, verbose: bool = False,
+                      max_concurrency: Optional[int] = None,
+                      analysis_mode: Optional[str] = None) -> List[MerchantInfo]:
+    """Process transactions from a JSON file, resuming from its journal if an earlier run died"""
+    processor = TransactionProcessor(verbose=verbose, max_concurrency=max_concurrency,
+                                     analysis_mode=analysis_mode)
     config = Config()
     
     # Construct full path from uploads directory
@@ -76,14 +356,23 @@ def process_json_file(json_path: str, verbose: bool = False) -> List[MerchantInf
     logging.debug("Processing json: %s", full_path)
     
     # Read JSON file
-    with open(full_path, 'r') as f:
-        try:
-            json_data = json.load(f)
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Invalid JSON file: {str(e)}") from e
+    with open(full_path, 'rb') as f:
+        content = f.read()
+    try:
+        json_data = json.loads(content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON file: {str(e)}") from e
 
-    # Run the async processing
-    return asyncio.run(processor.process_transactions(json_data['transactions']))
+    # The journal is keyed on the file's content, so a rerun of the same file resumes it
+    journal = create_job_journal(hashlib.sha256(content).hexdigest())
+    try:
+        results = asyncio.run(processor.process_transactions(json_data['transactions'], journal))
+    finally:
+        if journal is not None:
+            journal.close()
+    if journal is not None:
+        journal.discard()
+    return results
 
 def main():
     import argparse
@@ -91,11 +380,16 @@ def main():
     parser.add_argument('json_path', help='Path to the JSON file containing transactions')
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Enable verbose logging')
+    parser.add_argument('--max-concurrency', type=int, default=None,
+                        help='Maximum number of merchants to analyze at once')
+    parser.add_argument('--analysis-mode', choices=ANALYSIS_MODES, default=None,
+                        help='How identification and competitor prompts are issued')
     
     args = parser.parse_args()
     
     try:
-        results = process_json_file(args.json_path, args.verbose)
+        results = process_json_file(args.json_path, args.verbose, args.max_concurrency,
+                                    args.analysis_mode)
         
         # Print results
         print(f"\nProcessed {len(results)} transactions successfully")
@@ -116,6 +410,8 @@ def main():
                 print(f"  Description: {product.description}")
                 print(f"  Website: {product.website}")
                 print(f"  Comparison: {product.comparison}")
+        
+        print("\n" + get_metrics().format_summary())
                 
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -0,0 +1,389 @@
+"""Columnar, append-only history of extracted transactions and merchant analyses.
+
+Every processed statement is appended as Parquet files in hive-style
+partitions, so a query for one account or a range of months opens only the
+files it needs and reads only the columns it asks for:
+
+    transactions/account=<account>/month=<YYYY-MM>/<statement_id>.parquet
+    merchant_analyses/account=<account>/month=<YYYY-MM>/<statement_id>.parquet
+    statements/account=<account>/<statement_id>.parquet
+
+The statement id is the SHA-256 of the statement file, so storing a statement
+again replaces its earlier files instead of duplicating its rows. The
+statements entry is written last and marks the statement as complete; only
+complete statements extracted under the same extraction key (PDF hash, model
+and prompt version) are reused in place of re-extracting their PDFs. A
+statement's transactions are split by the month of their date, and its
+merchant analyses go in the month of its latest transaction. Both carry the
+merchant key the analyses were grouped by, one analysis per key.
+"""
+import argparse
+import datetime
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, TYPE_CHECKING
+from urllib.parse import quote
+
+from metrics import get_metrics
+from models import MerchantInfo, StoredStatement
+from transaction_processor import TransactionProcessor
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+DEFAULT_ACCOUNT = 'default'
+# Partition for transactions whose date couldn't be read
+UNKNOWN_MONTH = 'unknown'
+DEFAULT_BATCH_ROWS = 65536
+SPEND_COLUMNS = ['account', 'month', 'merchant', 'count', 'total']
+
+def statement_id(path: Any, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a statement file, the same digest PDFSource.sha256 gives for a PDF"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _parse_date(value: Any) -> Optional[datetime.date]:
+    try:
+        return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+def _schemas() -> Dict[str, 'pa.Schema']:
+    import pyarrow as pa
+    product = pa.struct([(name, pa.string()) for name in
+                         ('name', 'company', 'price', 'description', 'website', 'comparison')])
+    return {
+        'transactions': pa.schema([
+            ('statement_id', pa.string()),
+            ('row', pa.int32()),     # Position on the statement
+            ('date', pa.date32()),
+            ('merchant', pa.string()),
+            ('amount', pa.float64()),
+            ('merchant_key', pa.string()),  # Null for payments and credits, which aren't analyzed
+        ]),
+        'merchant_analyses': pa.schema([
+            ('statement_id', pa.string()),
+            ('merchant_key', pa.string()),
+            ('merchant_code', pa.string()),
+            ('merchant', pa.string()),
+            ('website', pa.string()),
+            ('phone', pa.string()),
+            ('product_description', pa.string()),
+            ('transaction_amount', pa.float64()),  # Of the first charge analyzed
+            ('transactions', pa.int32()),    # Charges on the statement sharing this analysis
+            ('original_transaction_description', pa.string()),
+            ('competitor_products', pa.list_(product)),
+        ]),
+        'statements': pa.schema([
+            ('statement_id', pa.string()),
+            ('source', pa.string()),
+            ('extraction_key', pa.string()),  # Null for statements not extracted from a PDF
+            ('months', pa.list_(pa.string())),
+            ('num_transactions', pa.int32()),
+            ('num_merchants', pa.int32()),
+            ('stored_at', pa.timestamp('ms', tz='UTC')),
+        ]),
+    }
+
+class TransactionStore:
+    """Parquet files of every processed statement, partitioned by account and month"""
+
+    def __init__(self, directory: Path, default_account: str = DEFAULT_ACCOUNT, compression: str = 'zstd'):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.default_account = default_account
+        self.compression = compression
+        self.logger = logging.getLogger('TransactionStore')
+        self._lock = threading.Lock()
+
+    def _partition(self, table: str, account: str, month: Optional[str] = None) -> Path:
+        # Hive partition values are URI-decoded when read, so any account name works
+        path = self.directory / table / f"account={quote(account, safe='')}"
+        return path if month is None else path / f"month={month}"
+
+    def _write(self, table: 'pa.Table', directory: Path, statement: str) -> None:
+        import pyarrow.parquet as pq
+        directory.mkdir(parents=True, exist_ok=True)
+        # The leading dot keeps readers from picking up a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        os.close(fd)
+        try:
+            pq.write_table(table, tmp_path, compression=self.compression)
+            os.replace(tmp_path, directory / f"{statement}.parquet")
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    def append_statement(self, account: Optional[str], statement: str, source: str,
+                         transactions: List[Dict[str, Any]], merchant_results: Sequence[MerchantInfo],
+                         extraction_key: Optional[str] = None) -> StoredStatement:
+        """Store a processed statement, replacing any earlier copy of it in the same account.
+
+        extraction_key identifies how the transactions were extracted; only a
+        lookup with the same key reuses them.
+        """
+        import pyarrow as pa
+        account = account or self.default_account
+        schemas = _schemas()
+
+        by_month: Dict[str, Dict[str, List[Any]]] = {}
+        for row, transaction in enumerate(transactions):
+            date = _parse_date(transaction.get('date'))
+            month = date.strftime('%Y-%m') if date is not None else UNKNOWN_MONTH
+            columns = by_month.setdefault(month, {'row': [], 'date': [], 'merchant': [], 'amount': [],
+                                                  'merchant_key': []})
+            columns['row'].append(row)
+            columns['date'].append(date)
+            columns['merchant'].append(transaction.get('merchant'))
+            columns['amount'].append(transaction.get('amount'))
+            columns['merchant_key'].append(TransactionProcessor.merchant_key(transaction))
+        dated = [month for month in by_month if month != UNKNOWN_MONTH]
+        statement_month = max(dated) if dated else UNKNOWN_MONTH
+
+        # fan_out gives one result per charge; every charge of a merchant shares one row
+        analyses: Dict[str, Dict[str, Any]] = {}
+        for info in merchant_results:
+            key = TransactionProcessor.merchant_key({'merchant': info.merchant_code,
+                                                     'amount': info.transaction_amount})
+            if key in analyses:
+                analyses[key]['transactions'] += 1
+                continue
+            analyses[key] = {
+                'statement_id': statement,
+                'merchant_key': key,
+                'merchant_code': info.merchant_code,
+                'merchant': info.merchant,
+                'website': info.website,
+                'phone': info.phone,
+                'product_description': info.product_description,
+                'transaction_amount': info.transaction_amount,
+                'transactions': 1,
+                'original_transaction_description': info.original_transaction_description,
+                'competitor_products': [
+                    {'name': product.name, 'company': product.company, 'price': product.price,
+                     'description': product.description, 'website': product.website,
+                     'comparison': product.comparison}
+                    for product in info.competitor_products
+                ],
+            }
+
+        record = StoredStatement(statement_id=statement, account=account, source=source,
+                                 extraction_key=extraction_key, months=tuple(sorted(by_month)), num_transactions=len(transactions),
+                                 num_merchants=len(analyses), stored_at=time.time())
+        with self._lock, get_metrics().timer('store_append'):
+            # Until the new entry is written the statement reads as incomplete
+            self._partition('statements', account).joinpath(f"{statement}.parquet").unlink(missing_ok=True)
+            for month, columns in by_month.items():
+                table = pa.table({'statement_id': [statement] * len(columns['row']), **columns},
+                                 schema=schemas['transactions'])
+                self._write(table, self._partition('transactions', account, month), statement)
+            if analyses:
+                table = pa.Table.from_pylist(list(analyses.values()), schema=schemas['merchant_analyses'])
+                self._write(table, self._partition('merchant_analyses', account, statement_month), statement)
+            # Files from an earlier copy whose months no longer apply
+            for name, months in (('transactions', set(by_month)),
+                                 ('merchant_analyses', {statement_month} if analyses else set())):
+                for path in self._partition(name, account).glob(f"month=*/{statement}.parquet"):
+                    if path.parent.name[len('month='):] not in months:
+                        path.unlink(missing_ok=True)
+            table = pa.Table.from_pylist([{
+                'statement_id': statement, 'source': source, 'extraction_key': extraction_key,
+                'months': list(record.months),
+                'num_transactions': record.num_transactions, 'num_merchants': record.num_merchants,
+                'stored_at': datetime.datetime.fromtimestamp(record.stored_at, datetime.timezone.utc),
+            }], schema=schemas['statements'])
+            self._write(table, self._partition('statements', account), statement)
+
+        get_metrics().inc('store_statements_total', help='Statements appended to the transaction store')
+        self.logger.info("Stored %d transactions and %d merchant analyses of %s for account %s in %s",
+                         record.num_transactions, record.num_merchants, source or statement, account,
+                         ', '.join(record.months) or 'no months')
+        return record
+
+    def record_statement(self, account: Optional[str], statement: str, source: str,
+                         transactions: List[Dict[str, Any]], merchant_results: Sequence[MerchantInfo],
+                         extraction_key: Optional[str] = None) -> Optional[StoredStatement]:
+        """append_statement for the processing paths, where a storage failure shouldn't fail the statement"""
+        try:
+            return self.append_statement(account, statement, source, transactions, merchant_results,
+                                         extraction_key)
+        except Exception as e:
+            self.logger.warning("Could not store %s: %s", source or statement, str(e))
+            return None
+
+    def statement_transactions(self, statement: str, extraction_key: str) -> Optional[List[Dict[str, Any]]]:
+        """A complete stored statement's transactions in statement order.
+
+        None if it isn't stored, or was extracted under a different
+        extraction key (another model or prompt version).
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        account_dir = None
+        for entry in sorted(self.directory.glob(f"statements/account=*/{statement}.parquet")):
+            try:
+                # Entries written before extraction keys were recorded have none and never match
+                stored = pq.read_table(entry).to_pylist()[0].get('extraction_key')
+            except (OSError, pa.ArrowException) as e:
+                self.logger.warning("Could not read the stored entry of %s: %s", statement, str(e))
+                continue
+            if stored == extraction_key:
+                account_dir = entry.parent.name
+                break
+        if account_dir is None:
+            get_metrics().record_cache('transaction_store', False)
+            return None
+        paths = sorted(self.directory.glob(f"transactions/{account_dir}/month=*/{statement}.parquet"))
+        try:
+            tables = [pq.read_table(path, columns=['row', 'date', 'merchant', 'amount']) for path in paths]
+        except (OSError, pa.ArrowException) as e:
+            self.logger.warning("Could not read stored transactions of %s: %s", statement, str(e))
+            get_metrics().record_cache('transaction_store', False)
+            return None
+        get_metrics().record_cache('transaction_store', True)
+        rows = sorted((row for table in tables for row in table.to_pylist()), key=lambda row: row['row'])
+        self.logger.info("Reusing %d stored transactions of %s", len(rows), statement)
+        return [{
+            'date': row['date'].isoformat() if row['date'] is not None else None,
+            'merchant': row['merchant'],
+            'amount': row['amount'],
+        } for row in rows]
+
+    def _dataset(self, table: str):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        path = self.directory / table
+        if not path.is_dir():
+            return None
+        fields = [('account', pa.string())] + ([] if table == 'statements' else [('month', pa.string())])
+        partitioning = ds.partitioning(pa.schema(fields), flavor='hive')
+        schema = pa.unify_schemas([_schemas()[table], pa.schema(fields)])
+        return ds.dataset(path, schema=schema, format='parquet', partitioning=partitioning)
+
+    @staticmethod
+    def _filter(account: Optional[str], start_month: Optional[str] = None, end_month: Optional[str] = None):
+        import pyarrow.dataset as ds
+        conditions = []
+        if account is not None:
+            conditions.append(ds.field('account') == account)
+        if start_month is not None:
+            conditions.append(ds.field('month') >= start_month)
+        if end_month is not None:
+            conditions.append(ds.field('month') <= end_month)
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def scan(self, table: str, account: Optional[str] = None, start_month: Optional[str] = None,
+             end_month: Optional[str] = None, columns: Optional[List[str]] = None,
+             batch_rows: int = DEFAULT_BATCH_ROWS) -> Iterator['pd.DataFrame']:
+        """Rows of a table as DataFrames of at most batch_rows, reading only the matching partitions.
+
+        Months are 'YYYY-MM' and inclusive; both tables have account and
+        month columns taken from the partition paths.
+        """
+        dataset = self._dataset(table)
+        if dataset is None:
+            return
+        scanner = dataset.scanner(columns=columns, filter=self._filter(account, start_month, end_month),
+                                  batch_size=batch_rows)
+        for batch in scanner.to_batches():
+            if batch.num_rows:
+                yield batch.to_pandas()
+
+    def _read(self, table: str, account: Optional[str], start_month: Optional[str], end_month: Optional[str],
+              columns: Optional[List[str]]) -> 'pd.DataFrame':
+        import pandas as pd
+        dataset = self._dataset(table)
+        if dataset is None:
+            return pd.DataFrame(columns=columns or [field.name for field in _schemas()[table]] + ['account', 'month'])
+        return dataset.to_table(columns=columns,
+                                filter=self._filter(account, start_month, end_month)).to_pandas()
+
+    def transactions(self, account: Optional[str] = None, start_month: Optional[str] = None,
+                     end_month: Optional[str] = None, columns: Optional[List[str]] = None) -> 'pd.DataFrame':
+        """Stored transactions as one DataFrame; use scan() for histories too large to hold at once"""
+        return self._read('transactions', account, start_month, end_month, columns)
+
+    def merchant_analyses(self, account: Optional[str] = None, start_month: Optional[str] = None,
+                          end_month: Optional[str] = None, columns: Optional[List[str]] = None) -> 'pd.DataFrame':
+        return self._read('merchant_analyses', account, start_month, end_month, columns)
+
+    def statements(self, account: Optional[str] = None) -> List[StoredStatement]:
+        """Every complete stored statement, oldest first"""
+        dataset = self._dataset('statements')
+        if dataset is None:
+            return []
+        records = [StoredStatement(
+            statement_id=row['statement_id'], account=row['account'], source=row['source'],
+            extraction_key=row['extraction_key'], months=tuple(row['months']), num_transactions=row['num_transactions'],
+            num_merchants=row['num_merchants'], stored_at=row['stored_at'].timestamp()
+        ) for row in dataset.to_table(filter=self._filter(account)).to_pylist()]
+        return sorted(records, key=lambda record: record.stored_at)
+
+    def monthly_spend(self, account: Optional[str] = None, start_month: Optional[str] = None,
+                      end_month: Optional[str] = None) -> 'pd.DataFrame':
+        """Charges (amounts > 0) per account, month and merchant, largest total first within each month.
+
+        Aggregated batch by batch, so memory is bounded by the number of
+        merchants per month rather than the length of the history.
+        """
+        import pandas as pd
+        parts: List[pd.DataFrame] = []
+        for batch in self.scan('transactions', account, start_month, end_month,
+                               columns=['account', 'month', 'merchant', 'amount']):
+            batch = batch[batch['amount'] > 0]
+            parts.append(batch.groupby(['account', 'month', 'merchant'], sort=False)['amount']
+                         .agg(['count', 'sum']))
+            if len(parts) > 8:
+                parts = [pd.concat(parts).groupby(level=[0, 1, 2], sort=False).sum()]
+        if not parts:
+            return pd.DataFrame(columns=SPEND_COLUMNS)
+        spend = pd.concat(parts).groupby(level=[0, 1, 2], sort=False).sum().rename(columns={'sum': 'total'})
+        spend = spend.reset_index().sort_values(['account', 'month', 'total'], ascending=[True, True, False],
+                                                kind='stable')
+        return spend[SPEND_COLUMNS].reset_index(drop=True)
+
+def create_transaction_store(config) -> Optional[TransactionStore]:
+    """Build the transaction store described by the config, or None when it is disabled or pyarrow is missing"""
+    if not config.transaction_store:
+        return None
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logging.getLogger('TransactionStore').warning("pyarrow is not installed; processed statements won't be stored")
+        return None
+    return TransactionStore(config.transaction_store_dir, config.transaction_store_account)
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize the stored statement history')
+    parser.add_argument('--store-dir', default=os.getenv('TRANSACTION_STORE_DIR',
+                                                         str(Path(__file__).parent.parent.parent / 'store')))
+    parser.add_argument('--account', help='Only this account (defaults to every account)')
+    parser.add_argument('--start', help='First month, YYYY-MM')
+    parser.add_argument('--end', help='Last month, YYYY-MM')
+    parser.add_argument('--top', type=int, default=10, help='Merchants shown per month')
+    parser.add_argument('--statements', action='store_true', help='List stored statements instead')
+    args = parser.parse_args()
+
+    store = TransactionStore(Path(args.store_dir))
+    if args.statements:
+        for record in store.statements(args.account):
+            print(f"{record.account}\t{record.statement_id[:12]}\t{','.join(record.months)}\t"
+                  f"{record.num_transactions} transactions\t{record.source}")
+        return
+    spend = store.monthly_spend(args.account, args.start, args.end)
+    print(spend.groupby(['account', 'month'], sort=False).head(args.top).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
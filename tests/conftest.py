@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The pipeline's modules import each other by their flat module names
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src' / 'pdf_processor'))
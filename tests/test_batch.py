@@ -0,0 +1,11 @@
+from pathlib import Path
+
+from batch import find_statements
+
+def test_statements_in_a_relative_directory_are_absolute(tmp_path, monkeypatch):
+    (tmp_path / 'in' / 'march').mkdir(parents=True)
+    (tmp_path / 'in' / 'march' / 'visa.pdf').write_bytes(b'%PDF')
+    (tmp_path / 'in' / 'notes.txt').write_text('skip')
+    monkeypatch.chdir(tmp_path)
+
+    assert find_statements(Path('in')) == [tmp_path.resolve() / 'in' / 'march' / 'visa.pdf']
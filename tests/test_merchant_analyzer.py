@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+import pytest
+
+from structured_output import COMPANIES_TOOL, parse_tool_response
+
+@pytest.fixture
+def analyzer(monkeypatch):
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'test')
+    monkeypatch.setenv('MERCHANT_CACHE_BACKEND', 'none')
+    monkeypatch.setenv('MERCHANT_INDEX', 'false')
+    from merchant_analyzer import MerchantAnalyzer
+    return MerchantAnalyzer()
+
+def test_one_bad_batch_entry_leaves_the_rest(analyzer):
+    reply = SimpleNamespace(content=[SimpleNamespace(type='tool_use', name=COMPANIES_TOOL['name'], input={
+        'companies': [
+            {'index': 0, 'company_name': 'Starbucks', 'website': 'starbucks.com'},
+            {'index': 1, 'website': 'unknown'},
+            {'index': 2, 'company_name': 'Target'},
+        ],
+    })])
+
+    companies = analyzer._batch_companies(parse_tool_response(reply, COMPANIES_TOOL), 3)
+
+    assert sorted(companies) == [0, 2]
+    assert companies[2]['company_name'] == 'Target'
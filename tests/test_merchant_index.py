@@ -0,0 +1,50 @@
+import pytest
+
+from merchant_index import MerchantIndex, normalize_descriptor
+from models import MerchantInfo
+
+@pytest.fixture
+def index(tmp_path):
+    return MerchantIndex(tmp_path / 'merchant_index.jsonl')
+
+@pytest.mark.parametrize('descriptor', [
+    'AMAZON WEB SERVICES',
+    'APPLE SPICE JUNCTION',
+    'TARGET OPTICAL 1234',
+])
+def test_prefix_followed_by_other_words_is_not_a_match(index, descriptor):
+    assert index.lookup(descriptor) is None
+
+@pytest.mark.parametrize('descriptor, merchant', [
+    ('STARBUCKS STORE 1234 SEATTLE WA', 'Starbucks'),
+    ('COSTCO WHSE #0123 NEW YORK NY', 'Costco'),
+    ('TARGET T-1234 SAN JOSE CA', 'Target'),
+    ('AMZN MKTP US*2K3AB1', 'Amazon'),
+    ('UBER *TRIP HELP.UBER.COM', 'Uber'),
+])
+def test_prefix_followed_by_location_noise_matches(index, descriptor, merchant):
+    match = index.lookup(descriptor)
+    assert match is not None
+    assert match.record.merchant == merchant
+
+def test_service_name_after_asterisk_is_kept(index):
+    assert normalize_descriptor('UBER *EATS PENDING') == 'UBER EATS'
+    assert index.lookup('UBER *EATS PENDING').record.merchant == 'Uber Eats'
+
+def test_matches_from_the_index_are_not_learned(tmp_path, monkeypatch):
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'test')
+    monkeypatch.setenv('MERCHANT_CACHE_BACKEND', 'none')
+    from merchant_analyzer import MerchantAnalyzer
+    path = tmp_path / 'merchant_index.jsonl'
+    analyzer = MerchantAnalyzer(merchant_index=MerchantIndex(path))
+
+    company = analyzer._indexed_company('TARGET #1234 AUSTIN TX')
+    analyzer._build_merchant_info('TARGET #1234 AUSTIN TX', 25.0, company,
+                                  {'original_transaction': 'Groceries', 'competitor_products': []})
+    assert not path.exists()
+
+def test_identifications_from_claude_are_learned(index):
+    info = MerchantInfo('JOES COFFEE 123 AUSTIN TX', "Joe's Coffee", 'https://joes.example', 'Unknown',
+                        'Coffee shop', 4.5, [], 'Coffee')
+    index.learn(info.merchant_code, info)
+    assert index.lookup('JOES COFFEE AUSTIN TX').record.merchant == "Joe's Coffee"
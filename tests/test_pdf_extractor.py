@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+
+from local_extractor import LocalExtractionResult, StatementParser
+from pdf_extractor import PDFExtractor
+
+def make_extractor(**settings):
+    config = SimpleNamespace(anthropic_api_key='test', anthropic_model='test-model', upload_dir='.',
+                             max_pdf_bytes=None, max_pdf_pages=None, local_extraction=True,
+                             pdf_chunk_pages=5, extraction_concurrency=2, extraction_max_tokens=1024)
+    for name, value in settings.items():
+        setattr(config, name, value)
+    return PDFExtractor(config)
+
+def row(merchant, amount, date='2024-03-01'):
+    return {'date': date, 'merchant': merchant, 'amount': amount}
+
+class FakeSource:
+    def __init__(self, page_count):
+        self.page_count = page_count
+
+    def stream(self):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+def mixed_statement(totals):
+    # Page 1 is scanned; pages 0 and 2 have a text layer
+    return LocalExtractionResult(
+        [row('GROCER', 40.0), row('BOOKS', 10.0)], False, 'generic', '1 page(s) without a text layer',
+        page_transactions=[[row('GROCER', 40.0)], [], [row('BOOKS', 10.0)]],
+        pages_without_text=[1], totals=totals
+    )
+
+def test_mixed_statement_keeps_claude_rows_when_totals_match(monkeypatch):
+    extractor = make_extractor()
+    monkeypatch.setattr(extractor.local_extractor, 'extract', lambda stream: mixed_statement({'purchases': 75.0}))
+    monkeypatch.setattr(extractor, '_pages', lambda source, pages: FakeSource(len(pages)))
+    monkeypatch.setattr(extractor, '_extract_with_claude',
+                        lambda source: [row('FUEL', 25.0)] if source.page_count == 1 else pytest.fail())
+
+    assert [r['merchant'] for r in extractor._extract(FakeSource(3))] == ['GROCER', 'FUEL', 'BOOKS']
+
+def test_mixed_statement_falls_back_to_claude_when_totals_differ(monkeypatch):
+    extractor = make_extractor()
+    monkeypatch.setattr(extractor.local_extractor, 'extract', lambda stream: mixed_statement({'purchases': 99.0}))
+    monkeypatch.setattr(extractor, '_pages', lambda source, pages: FakeSource(len(pages)))
+    full = [row('GROCER', 40.0), row('FUEL', 25.0), row('PHARMACY', 24.0), row('BOOKS', 10.0)]
+    monkeypatch.setattr(extractor, '_extract_with_claude',
+                        lambda source: full if source.page_count == 3 else [row('FUEL', 25.0)])
+
+    assert extractor._extract(FakeSource(3)) == full
+
+def test_local_parse_from_the_caller_is_not_repeated(monkeypatch):
+    extractor = make_extractor()
+    monkeypatch.setattr(extractor, 'open_pdf', lambda pdf: FakeSource(3))
+    monkeypatch.setattr(extractor.local_extractor, 'extract', lambda stream: pytest.fail())
+    monkeypatch.setattr(extractor, '_pages', lambda source, pages: FakeSource(len(pages)))
+    monkeypatch.setattr(extractor, '_extract_with_claude', lambda source: [row('FUEL', 25.0)])
+
+    rows = extractor.extract_transactions_from_pdf('statement.pdf', mixed_statement({'purchases': 75.0}))
+    assert [r['merchant'] for r in rows] == ['GROCER', 'FUEL', 'BOOKS']
+
+def test_impossible_closing_date_is_ignored():
+    parser = StatementParser("Closing Date: 02/30/24\n01/15 COFFEE 4.50")
+    assert parser.closing_date is None
+
+TRANSIT = row('MTA NYCT PAYGO', 2.90)
+
+def test_repeat_charges_across_a_chunk_boundary_are_kept(monkeypatch):
+    extractor = make_extractor(pdf_chunk_pages=1)
+    chunks = {0: [row('GROCER', 40.0), TRANSIT], 1: [TRANSIT, row('BOOKS', 10.0)]}
+    monkeypatch.setattr(extractor, '_pages', lambda source, pages: FakeSource(pages[0]))
+    monkeypatch.setattr(extractor, '_extract_chunk', lambda source, page_count: chunks[source.page_count])
+
+    rows = extractor._extract_with_claude(FakeSource(2))
+    assert [r['merchant'] for r in rows] == ['GROCER', 'MTA NYCT PAYGO', 'MTA NYCT PAYGO', 'BOOKS']
+
+def test_repeat_charges_across_a_streamed_chunk_boundary_are_kept(monkeypatch):
+    extractor = make_extractor(pdf_chunk_pages=1, local_extraction=False)
+    chunks = {0: [row('GROCER', 40.0), TRANSIT], 1: [TRANSIT, row('BOOKS', 10.0)]}
+    monkeypatch.setattr(extractor, 'open_pdf', lambda pdf: FakeSource(2))
+    monkeypatch.setattr(extractor, '_pages', lambda source, pages: FakeSource(pages[0]))
+    monkeypatch.setattr(extractor, '_stream_chunk', lambda source, page_count: iter(chunks[source.page_count]))
+
+    rows = list(extractor.stream_transactions_from_pdf(b'%PDF'))
+    assert [r['merchant'] for r in rows] == ['GROCER', 'MTA NYCT PAYGO', 'MTA NYCT PAYGO', 'BOOKS']
+
+def test_resumed_stream_skips_only_rows_already_sent():
+    emitted = [row('GROCER', 40.0), TRANSIT]
+    # The re-extraction drops a row the stream already sent and finds a second fare
+    again = [TRANSIT, row('FUEL', 25.0), TRANSIT, row('BOOKS', 10.0)]
+    assert PDFExtractor._unsent_rows(again, emitted) == [row('FUEL', 25.0), TRANSIT, row('BOOKS', 10.0)]
+
+def test_stream_sends_only_scanned_pages_to_claude(monkeypatch):
+    extractor = make_extractor()
+    monkeypatch.setattr(extractor, 'open_pdf', lambda pdf: FakeSource(3))
+    monkeypatch.setattr(extractor.local_extractor, 'extract', lambda stream: mixed_statement({'purchases': 75.0}))
+    monkeypatch.setattr(extractor, '_pages', lambda source, pages: FakeSource(len(pages)))
+    monkeypatch.setattr(extractor, '_extract_with_claude', lambda source: [row('FUEL', 25.0)])
+    monkeypatch.setattr(extractor, '_stream_chunk', lambda source, page_count: pytest.fail())
+
+    rows = list(extractor.stream_transactions_from_pdf(b'%PDF'))
+    assert [r['merchant'] for r in rows] == ['GROCER', 'FUEL', 'BOOKS']
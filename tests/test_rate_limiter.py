@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+import pytest
+
+from rate_limiter import ProviderBudget, RateLimitExceeded, RateLimitScheduler
+
+def scheduler(max_retries=3):
+    return RateLimitScheduler({'brave': ProviderBudget('brave', requests_per_second=1000)},
+                              max_retries=max_retries, base_delay=0.001, max_delay=0.001)
+
+def response(status):
+    return SimpleNamespace(status_code=status, headers={})
+
+def test_sync_call_retries_throttles_and_slows_down():
+    limiter = scheduler()
+    replies = [response(429), response(200)]
+
+    assert limiter.call_sync('brave', lambda: replies.pop(0)).status_code == 200
+    budget = limiter.providers['brave']
+    assert budget.throttle_count == 1 and budget.retry_count == 1
+    assert budget.requests.rate < budget.requests.max_rate
+
+def test_sync_call_gives_up_after_its_retries():
+    limiter = scheduler(max_retries=1)
+
+    with pytest.raises(RateLimitExceeded):
+        limiter.call_sync('brave', lambda: response(429))
@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('celery')
+
+import tasks
+from models import MerchantInfo
+from transaction_processor import TransactionProcessor
+
+STATEMENT = [
+    {'date': '2024-03-01', 'merchant': 'STARBUCKS STORE 1234', 'amount': 4.5},
+    {'date': '2024-03-02', 'merchant': 'TARGET T-1234', 'amount': 32.0},
+    {'date': '2024-03-03', 'merchant': 'STARBUCKS STORE 1234', 'amount': 5.25},
+    {'date': '2024-03-04', 'merchant': 'AUTOMATIC PAYMENT - THANK YOU', 'amount': -100.0},
+]
+
+class FakeAnalyzer:
+    def __init__(self):
+        self.calls = []
+
+    async def analyze_merchant(self, merchant, amount):
+        self.calls.append(merchant)
+        return MerchantInfo(merchant, merchant.split()[0].title(), '', '', '', amount, [], merchant)
+
+class FakeExtractor:
+    def content_hash(self, file_path):
+        return 'abc'
+
+    def extraction_key(self, statement_id):
+        return f'{statement_id}-key'
+
+    def extract_transactions_from_pdf(self, file_path):
+        return [dict(row) for row in STATEMENT]
+
+@pytest.fixture
+def runtime(monkeypatch, tmp_path):
+    monkeypatch.setenv('JOB_JOURNAL_DIR', str(tmp_path))
+    monkeypatch.setitem(tasks.app.conf, 'task_always_eager', True)
+    monkeypatch.setitem(tasks.app.conf, 'broker_url', 'memory://')
+    monkeypatch.setitem(tasks.app.conf, 'result_backend', 'cache+memory://')
+    analyzer = FakeAnalyzer()
+    loop = asyncio.new_event_loop()
+    runtime = SimpleNamespace(extractor=FakeExtractor(), extraction_cache=None, store=None,
+                              processor=TransactionProcessor(analyzer=analyzer),
+                              run=loop.run_until_complete, analyzer=analyzer, journal_dir=tmp_path)
+    monkeypatch.setattr(tasks, 'get_runtime', lambda: runtime)
+    yield runtime
+    loop.close()
+
+def test_statement_runs_end_to_end_in_eager_mode(runtime):
+    result = tasks.process_pdf_task.delay('statement.pdf', 'me@example.com').get()
+
+    # One analysis subtask per unique merchant, however often it was charged
+    assert sorted(runtime.analyzer.calls) == ['STARBUCKS STORE 1234', 'TARGET T-1234']
+    assert result['success'] and result['email'] == 'me@example.com'
+    assert result['transactions'] == STATEMENT
+    assert [info['merchant_name'] for info in result['merchant_analysis']] == ['Starbucks', 'Target', 'Starbucks']
+    assert [info['transaction_amount'] for info in result['merchant_analysis']] == [4.5, 32.0, 5.25]
+    # The extraction is journaled until the results are assembled
+    assert result['statement_id'] == 'abc' and not list(runtime.journal_dir.iterdir())
+
+def test_extraction_and_analysis_run_on_separate_queues():
+    route = tasks.app.amqp.router.route
+    assert route({}, 'pdf_processor.process_pdf')['queue'].name == tasks.EXTRACTION_QUEUE
+    assert route({}, 'pdf_processor.analyze_merchant')['queue'].name == tasks.ANALYSIS_QUEUE
+    assert route({}, 'pdf_processor.assemble_results')['queue'].name == tasks.ANALYSIS_QUEUE
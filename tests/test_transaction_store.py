@@ -0,0 +1,47 @@
+from dataclasses import replace
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from models import MerchantInfo
+from transaction_processor import TransactionProcessor
+from transaction_store import TransactionStore
+
+AMOUNTS = [4.5, 5.25, 6.0, 3.75, 7.1, 4.95]
+
+def charge(merchant, amount, date='2024-03-01'):
+    return {'date': date, 'merchant': merchant, 'amount': amount}
+
+def coffee_statement():
+    transactions = [charge('STARBUCKS STORE 1234', amount, f'2024-03-{day + 1:02d}')
+                    for day, amount in enumerate(AMOUNTS)]
+    transactions.append(charge('AUTOMATIC PAYMENT - THANK YOU', -100.0, '2024-03-20'))
+    analysis = MerchantInfo('STARBUCKS STORE 1234', 'Starbucks', 'starbucks.com', '', 'Coffee', AMOUNTS[0], [],
+                            'STARBUCKS STORE 1234')
+    # One result per charge, as fan_out gives them
+    return transactions, [replace(analysis, merchant_code=t['merchant'], transaction_amount=t['amount'])
+                          for t in transactions if t['amount'] > 0]
+
+def test_one_analysis_per_merchant_whatever_the_amounts(tmp_path):
+    store = TransactionStore(tmp_path)
+    transactions, merchant_results = coffee_statement()
+
+    record = store.append_statement('visa', 'abc', 'march.pdf', transactions, merchant_results, 'key-1')
+
+    assert record.num_merchants == 1
+    analyses = store.merchant_analyses('visa')
+    key = TransactionProcessor.merchant_key(transactions[0])
+    assert analyses['merchant_key'].tolist() == [key]
+    assert analyses['transactions'].tolist() == [len(AMOUNTS)]
+    keys = store.transactions('visa').sort_values('row')['merchant_key']
+    assert keys.tolist()[:-1] == [key] * len(AMOUNTS) and keys.isna().tolist()[-1]
+
+def test_stored_rows_are_reused_only_under_the_same_extraction_key(tmp_path):
+    store = TransactionStore(tmp_path)
+    transactions, merchant_results = coffee_statement()
+    store.append_statement('visa', 'abc', 'march.pdf', transactions, merchant_results, 'key-1')
+
+    assert store.statement_transactions('abc', 'key-1') == transactions
+    assert store.statement_transactions('abc', 'key-2') is None
+    assert store.statements()[0].extraction_key == 'key-1'